@@ -0,0 +1,206 @@
+import isa
+
+# instructions that end a basic block
+TERMINATORS = {"JMP", "CALL", "RET", "JZ", "JNZ", "JG", "JL", "JEQ", "JNE", "DJNZ", "JEQI", "JNEI", "HLT", "IN", "OUT", "RENDER"}
+# instructions that run code outside the CPU (devices, on_render), which can halt, pause or restore it
+# they end a block and run after its registers are written back, so nothing the block holds overwrites what they did
+CALLOUTS = {"IN": "cpu._op_in({}, {})", "OUT": "cpu._op_out({}, {})", "RENDER": "cpu.render()"}
+# instructions that can raise, the PC has to be correct if they do
+FAULTING = {"LOAD", "STR", "PUSH", "POP", "DIV", "DRW", "RECT", "RNDMAP", "MEMCPY", "MEMSET", "BLIT"}
+# instructions that take their addresses from registers, a block ends after them in case they wrote into its own code
+# STR ends one only when its address is in the ROM
+BULK_MEMORY = {"MEMCPY", "MEMSET", "BLIT"}
+# instructions with a code template, anything else is left to the interpreter
+SUPPORTED = TERMINATORS | FAULTING | {"NOP", "MOV", "ADD", "SUB", "MUL", "CLR", "RND", "SEED"}
+
+MAX_BLOCK_INSTRUCTIONS = 256
+
+class Block:
+    def __init__(self, start: int, end: int, count: int, function, source: str) -> None:
+        self.start = start
+        self.end = end
+        self.count = count
+        self.function = function
+        self.source = source
+
+class BlockCompiler:
+    """Compiles straight-line runs of guest code into a single Python function.
+
+    Registers are loaded into locals when the block is entered and written back
+    once when it exits, either at the terminating jump or when an instruction raises.
+    """
+
+    def __init__(self, cpu, helpers: dict | None = None) -> None:
+        self.cpu = cpu
+        # functions generated code calls by name, map_to_range_int for RNDMAP
+        self.helpers = helpers or {}
+        self.blocks: dict[int, Block | None] = {}
+
+    def lookup(self, pc: int) -> Block | None:
+        try:
+            return self.blocks[pc]
+        except KeyError:
+            block = self.blocks[pc] = self.compile(pc)
+            return block
+
+    def invalidate(self, start: int, end: int) -> None:
+        for pc in [pc for pc, block in self.blocks.items() if block is None or (block.start < end and start < block.end)]:
+            del self.blocks[pc]
+    def clear(self) -> None:
+        self.blocks.clear()
+
+    def _instructions(self, pc: int) -> list[tuple[isa.Instruction, tuple, int, int]]:
+        cpu = self.cpu
+        rom_end = cpu.rom_base + cpu.rom_size
+        instructions = []
+
+        while cpu.rom_base <= pc < rom_end and len(instructions) < MAX_BLOCK_INSTRUCTIONS:
+            instruction = isa.BY_OPCODE[cpu.memory[pc]]
+            if instruction is None or instruction.mnemonic not in SUPPORTED or cpu._handlers[instruction.opcode] is None:
+                break # left for the interpreter
+            operand_struct, size = instruction.encoding(cpu.wide_addresses)
+            if pc + size > len(cpu.memory):
+                break
+
+            operands = operand_struct.unpack_from(cpu.memory, pc + 1)
+            instructions.append((instruction, operands, pc, pc + size))
+            pc += size
+
+            if instruction.mnemonic in TERMINATORS or instruction.mnemonic in BULK_MEMORY:
+                break
+            if instruction.mnemonic == "STR" and cpu.rom_base <= operands[0] < rom_end:
+                # the rest of the block may be what it just overwrote
+                break
+
+        return instructions
+
+    def compile(self, start: int) -> Block | None:
+        instructions = self._instructions(start)
+        if not instructions:
+            return None
+
+        mask = self.cpu.word_mask
+        sign = self.cpu.sign_bit
+        rom_base = self.cpu.rom_base
+
+        body = []
+        read, written = [], []
+        can_fault = False # a fault from here on writes back registers assigned further down, so they're loaded too
+        def use(reg: int) -> str:
+            if reg not in read and reg not in written:
+                read.append(reg)
+            return f"R{reg}"
+        def assign(reg: int) -> str:
+            if reg not in written:
+                if can_fault and reg not in read:
+                    read.append(reg)
+                written.append(reg)
+            return f"R{reg}"
+
+        end = instructions[-1][3]
+        exit_pc = end
+        callout = None
+        for instruction, operands, _, next_pc in instructions:
+            mnemonic = instruction.mnemonic
+            if mnemonic in FAULTING:
+                body.append(f"_pc = {next_pc}")
+                can_fault = True
+
+            if mnemonic == "NOP":
+                continue
+            elif mnemonic == "MOV":
+                body.append(f"{assign(operands[0])} = {operands[1] & mask}")
+            elif mnemonic in ("ADD", "SUB", "MUL", "DIV"):
+                a, b = use(operands[0]), use(operands[1])
+                assign(operands[0])
+                if mnemonic == "ADD":
+                    body.append(f"{a} = ({a} + {b}) & {mask}")
+                elif mnemonic == "SUB":
+                    body.append(f"{a} = ({a} - {b}) & {mask}")
+                elif mnemonic == "MUL":
+                    body.append(f"{a} = ({a} * {b}) & {mask}")
+                else:
+                    body.append(f"{a} = cpu.divide({a}, {b})")
+            elif mnemonic == "LOAD":
+                reg, addr = operands
+                body.append(f"{assign(reg)} = cpu.get_memory({addr})")
+            elif mnemonic == "STR":
+                addr, reg = operands
+                body.append(f"cpu.set_memory({addr}, {use(reg)})")
+            elif mnemonic == "PUSH":
+                body.append(f"cpu.push_stack({use(operands[0])})")
+            elif mnemonic == "POP":
+                body.append(f"{assign(operands[0])} = cpu.pop_stack() & {mask}")
+            elif mnemonic == "DRW":
+                body.append(f"cpu.draw_pixel({', '.join(use(reg) for reg in operands)})")
+            elif mnemonic == "RECT":
+                body.append(f"cpu.draw_rectangle({', '.join(use(reg) for reg in operands)})")
+            elif mnemonic == "MEMCPY":
+                body.append(f"cpu.copy_memory({', '.join(use(reg) for reg in operands)})")
+            elif mnemonic == "MEMSET":
+                body.append(f"cpu.fill_memory({', '.join(use(reg) for reg in operands)})")
+            elif mnemonic == "BLIT":
+                body.append(f"cpu.draw_sprite({', '.join(use(reg) for reg in operands)})")
+            elif mnemonic == "CLR":
+                body.append("cpu.clear_display()")
+            elif mnemonic == "RND":
+                body.append(f"{assign(operands[0])} = cpu.step_random() & {mask}")
+            elif mnemonic == "SEED":
+                body.append(f"cpu.rng.seed({operands[0]})")
+            elif mnemonic == "RNDMAP":
+                reg = use(operands[0])
+                assign(operands[0])
+                body.append(f"{reg} = map_to_range_int({reg}, {operands[1]}, {operands[2]}) & {mask}")
+            elif mnemonic == "JMP":
+                exit_pc = rom_base + operands[0]
+            elif mnemonic == "CALL":
+                body.append(f"cpu.push_stack({next_pc})")
+                exit_pc = rom_base + operands[0]
+            elif mnemonic == "RET":
+                body.append("_pc = cpu.pop_stack()")
+                exit_pc = "_pc"
+            elif mnemonic in ("JZ", "JNZ", "JG", "JL"):
+                reg = use(operands[0])
+                condition = {"JZ": f"{reg} == 0", "JNZ": f"{reg} != 0", "JG": f"0 < {reg} < {sign}", "JL": f"{reg} >= {sign}"}[mnemonic]
+                exit_pc = f"{rom_base + operands[1]} if {condition} else {next_pc}"
+            elif mnemonic in ("JEQ", "JNE"):
+                condition = "==" if mnemonic == "JEQ" else "!="
+                exit_pc = f"{rom_base + operands[2]} if {use(operands[0])} {condition} {use(operands[1])} else {next_pc}"
+            elif mnemonic == "DJNZ":
+                reg = use(operands[0])
+                assign(operands[0])
+                body.append(f"{reg} = ({reg} - 1) & {mask}")
+                exit_pc = f"{rom_base + operands[1]} if {reg} != 0 else {next_pc}"
+            elif mnemonic in ("JEQI", "JNEI"):
+                condition = "==" if mnemonic == "JEQI" else "!="
+                exit_pc = f"{rom_base + operands[2]} if {use(operands[0])} {condition} {operands[1] & mask} else {next_pc}"
+            elif mnemonic in CALLOUTS:
+                callout = CALLOUTS[mnemonic].format(*operands)
+                exit_pc = next_pc
+            elif mnemonic == "HLT":
+                exit_pc = None
+
+        write_back = [f"registers[{reg}] = R{reg}" for reg in written]
+        lines = [f"def block(cpu, registers):"]
+        lines.extend(f"    R{reg} = registers[{reg}]" for reg in read)
+        lines.append(f"    _pc = {start}")
+        lines.append("    try:")
+        lines.extend(f"        {line}" for line in body or ["pass"])
+        lines.append("    except BaseException:")
+        lines.extend(f"        {line}" for line in write_back)
+        lines.append("        cpu.pc = _pc")
+        lines.append("        raise")
+        lines.extend(f"    {line}" for line in write_back)
+        if exit_pc is None:
+            lines.append(f"    cpu.pc = {end}")
+            lines.append("    cpu.halt(\"HLT by program\")")
+        else:
+            lines.append(f"    cpu.pc = {exit_pc}")
+        if callout is not None:
+            lines.append(f"    {callout}")
+        lines.append(f"    return {len(instructions)}")
+
+        source = "\n".join(lines)
+        namespace = dict(self.helpers)
+        exec(compile(source, f"<block 0x{start:04X}>", "exec"), namespace)
+        return Block(start, end, len(instructions), namespace["block"], source)
@@ -0,0 +1,205 @@
+"""Build a program split across files, incrementally, and reload it into a running CPU.
+
+Every file is assembled on its own into a compiler.Module, which is cached in
+memory and on disk under the SHA-256 of its source, so a rebuild only
+assembles the files that changed and links the rest from the cache. Linking
+lays the modules out and patches the label operands, nothing is re-parsed.
+
+    python build.py game.s -o game.rom --watch --reload
+
+rebuilds game.rom whenever one of its files changes and loads it into the CPU
+behind the debug server (main.py starts one) with LOAD_ROM. Registers, the PC
+and the rest of memory are left alone, so code that moved under the PC has to
+be restarted by hand (spc in remote.py).
+"""
+import os
+import time
+import struct
+import hashlib
+import argparse
+
+import isa
+import protocol
+from isa import ROM_BASE
+from compiler import Compiler, Module, AssemblyError
+
+CACHE_DIR = "__asmcache__"
+CACHE_VERSION = 2
+# a module only depends on its source, the operand sizes and the instruction set
+ISA_DIGEST = hashlib.sha256(repr([(i.opcode, i.mnemonic, i.operands) for i in isa.INSTRUCTIONS]).encode()).digest()
+
+class Build:
+    def __init__(self, root: str, rom_base: int = ROM_BASE, wide_addresses: bool = False, cache_dir: str | None = CACHE_DIR,
+                 optimize: bool = False) -> None:
+        # cache_dir is relative to the root file's directory, None to keep modules in memory only
+        self.root = os.path.normpath(root)
+        self.compiler = Compiler(rom_base, wide_addresses, optimize)
+        self.cache_dir = cache_dir and os.path.join(os.path.dirname(self.root), cache_dir)
+        # optimized modules depend on rom_base, numbers at or above it are left alone
+        self.key = hashlib.sha256(ISA_DIGEST + struct.pack("<BBBQ", CACHE_VERSION, wide_addresses, optimize, rom_base if optimize else 0)).digest()
+        self.modules: dict[str, tuple[tuple[int, int], bytes, Module]] = {} # path -> (stat stamp, source digest, module)
+        self.files: dict[str, tuple[int, int] | None] = {} # stamps of the files the last build read, None if missing
+        self.assembled = 0 # modules assembled by the last build, the others came from a cache
+        self.linked = 0
+        self.optimizations: list[tuple[str, int, str]] = [] # (path, line, what the optimizer did) for the last build
+
+    def build(self) -> bytearray:
+        """Assemble what changed and link the ROM, raises AssemblyError for mistakes in any file."""
+        self.files = {}
+        self.assembled = 0
+        order = [] # (path, module), root first and then each include the first time it's seen
+        seen = {self.root}
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            module = self._module(path)
+            order.append((path, module))
+            # pushed in reverse so they're linked in the order they're included
+            for line, included in reversed(module.includes):
+                included = os.path.normpath(os.path.join(os.path.dirname(path), included))
+                if included not in seen:
+                    if not os.path.isfile(included):
+                        self.files[included] = None
+                        raise AssemblyError(line, f"can't include {included}, it doesn't exist", path)
+                    seen.add(included)
+                    pending.append(included)
+        self.linked = len(order)
+        self.optimizations = [(path, line, change) for path, module in order for line, change in module.optimizations]
+        return self.compiler.link(order)
+
+    def changed(self) -> bool:
+        """Whether any file the last build read was touched since."""
+        return not self.files or any(_stamp(path) != stamp for path, stamp in self.files.items())
+
+    def _module(self, path: str) -> Module:
+        stamp = _stamp(path)
+        self.files[path] = stamp
+        cached = self.modules.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[2]
+
+        with open(path, "rb") as f:
+            source = f.read()
+        digest = hashlib.sha256(self.key + source).digest()
+        if cached is not None and cached[1] == digest:
+            # touched but not changed
+            self.modules[path] = (stamp, digest, cached[2])
+            return cached[2]
+
+        module = self._load(digest)
+        if module is None:
+            module = self.compiler.compile_module(source.decode(), path)
+            self.assembled += 1
+            self._store(digest, module)
+        self.modules[path] = (stamp, digest, module)
+        return module
+
+    def _load(self, digest: bytes) -> Module | None:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, digest.hex()), "rb") as f:
+                return Module.load(f.read())
+        except FileNotFoundError:
+            return None
+        except (ValueError, EOFError, TypeError):
+            # written by something else or cut short, assemble it again
+            return None
+
+    def _store(self, digest: bytes, module: Module) -> None:
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        filename = os.path.join(self.cache_dir, digest.hex())
+        # renamed into place so a concurrent build never reads half a module
+        temporary = f"{filename}.{os.getpid()}"
+        with open(temporary, "wb") as f:
+            f.write(module.dump())
+        os.replace(temporary, filename)
+
+def _stamp(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def print_report(optimizations: list[tuple[str, int, str]]) -> None:
+    for path, line, change in optimizations:
+        print(f"{path}:{line}: {change}")
+    print(f"{len(optimizations)} optimizations")
+
+def reload_cpu(cpu, rom: bytes) -> None:
+    """Load rom into a CPU that may be running on another thread, at its next batch boundary."""
+    response = cpu.submit_debug_request(memoryview(protocol.REQUEST.pack(0, protocol.LOAD_ROM) + bytes(rom))).result()
+    _, status = protocol.RESPONSE.unpack_from(response, protocol.LENGTH.size)
+    if status != protocol.OK:
+        raise ValueError(bytes(response[protocol.LENGTH.size + protocol.RESPONSE.size:]).decode())
+
+def watch(build: Build, output: str, reload=None, interval: float = 0.2) -> None:
+    """Rebuild output whenever a file changes, until interrupted. reload(rom) gets every new ROM."""
+    while True:
+        if build.changed():
+            # editors often truncate and then write, give the save a moment to finish
+            time.sleep(interval)
+            try:
+                rom = build.build()
+            except (AssemblyError, OSError, UnicodeDecodeError) as e:
+                print(e)
+            else:
+                with open(output, "wb") as f:
+                    f.write(rom)
+                print(f"Wrote {len(rom)} bytes! {build.assembled} of {build.linked} modules assembled")
+                if reload is not None:
+                    try:
+                        reload(rom)
+                        print("Reloaded")
+                    except Exception as e:
+                        print(f"Reload failed: {e}")
+        time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a program from its files, optionally on every change")
+    parser.add_argument("source", nargs="?", default="test.s")
+    parser.add_argument("-o", "--output", help="ROM to write, the source with .rom instead of its extension by default")
+    parser.add_argument("--rom-base", type=lambda value: int(value, 0), default=ROM_BASE, help="where the ROM is loaded, label addresses depend on it")
+    parser.add_argument("--wide-addresses", action="store_true", help="4 byte addresses and jump targets, see memorymap.py")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help=f"where assembled modules are kept, next to the source, {CACHE_DIR} by default")
+    parser.add_argument("--no-cache", action="store_true", help="don't keep assembled modules on disk")
+    parser.add_argument("-O", "--optimize", action="store_true", help="run the peephole optimizer, see optimizer.py")
+    parser.add_argument("--report", action="store_true", help="list what the optimizer changed")
+    parser.add_argument("--watch", action="store_true", help="rebuild whenever a file changes")
+    parser.add_argument("--reload", action="store_true", help="load every rebuilt ROM into the CPU behind the debug server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--socket", metavar="PATH", help="connect to a debug server on a Unix socket")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.source)[0] + ".rom"
+    build = Build(args.source, args.rom_base, args.wide_addresses, None if args.no_cache else args.cache_dir, args.optimize)
+    reload = None
+    if args.reload:
+        from remote import DebugClient
+        reload = DebugClient(args.host, args.port, args.socket).load_rom_bytes
+
+    if args.watch:
+        try:
+            watch(build, output, reload)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    try:
+        rom = build.build()
+    except AssemblyError as e:
+        parser.exit(1, f"{e}\n")
+    with open(output, "wb") as f:
+        f.write(rom)
+    print(f"Wrote {len(rom)} bytes! {build.assembled} of {build.linked} modules assembled")
+    if args.report:
+        print_report(build.optimizations)
+    if reload is not None:
+        reload(rom)
+
+if __name__ == "__main__":
+    main()
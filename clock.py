@@ -0,0 +1,82 @@
+import time
+
+# What Clock does when the host falls behind the target frequency
+CATCH_UP = "catch_up" # run without sleeping until caught up, as long as the lag stays under max_lag_ns
+SKIP     = "skip"     # forget time missed beyond one timeslice
+
+NS_PER_SECOND = 1_000_000_000
+
+class Clock:
+    """Paces a CPU at a fixed emulated frequency.
+
+    The CPU runs timeslice() instructions at a time and reports them to throttle(),
+    which compares them against a time.perf_counter_ns() budget measured from a fixed
+    origin, so sleep granularity doesn't accumulate into drift.
+    """
+
+    def __init__(self, frequency: float = float("inf"), timeslice_ns: int = 2_000_000,
+                 policy: str = CATCH_UP, max_lag_ns: int = 100_000_000) -> None:
+        if policy not in (CATCH_UP, SKIP):
+            raise ValueError(f"Unknown clock policy: {policy}")
+        self.timeslice_ns = timeslice_ns
+        self.policy = policy
+        self.max_lag_ns = max_lag_ns
+        self.skipped_ns = 0
+        self.frequency = frequency
+
+    @property
+    def frequency(self) -> float:
+        return self._frequency
+    @frequency.setter
+    def frequency(self, value: float) -> None:
+        if value <= 0:
+            raise ValueError(f"Clock frequency must be positive, got {value}")
+        self._frequency = value
+        self._slice = 0 if value == float("inf") else max(1, int(value * self.timeslice_ns // NS_PER_SECOND))
+        self.reset()
+
+    @property
+    def unlimited(self) -> bool:
+        return self._slice == 0
+
+    def reset(self) -> None:
+        """Restart the budget from now, e.g. after the CPU was paused."""
+        self.origin_ns = time.perf_counter_ns()
+        self.cycles = 0
+
+    def timeslice(self) -> int | None:
+        """Instructions to run before the next throttle(), None when unlimited."""
+        return self._slice or None
+
+    def throttle(self, executed: int) -> None:
+        if not self._slice:
+            return
+
+        self.cycles += executed
+        deadline_ns = self.origin_ns + int(self.cycles * NS_PER_SECOND / self._frequency)
+        now_ns = time.perf_counter_ns()
+        if deadline_ns > now_ns:
+            time.sleep((deadline_ns - now_ns) / NS_PER_SECOND)
+            return
+
+        lag_ns = now_ns - deadline_ns
+        if lag_ns > (self.max_lag_ns if self.policy == CATCH_UP else self.timeslice_ns):
+            self.skipped_ns += lag_ns
+            self.reset()
+
+class FrameClock:
+    """Frame-locked pacing: exactly instructions_per_frame instructions per display frame.
+
+    The frontend calls run_frame once per frame, so guest time advances in lockstep with
+    the display and runs are deterministic regardless of host speed.
+    """
+
+    def __init__(self, instructions_per_frame: int) -> None:
+        if instructions_per_frame <= 0:
+            raise ValueError(f"instructions_per_frame must be positive, got {instructions_per_frame}")
+        self.instructions_per_frame = instructions_per_frame
+        self.frames = 0
+
+    def run_frame(self, cpu) -> str:
+        self.frames += 1
+        return cpu.run(self.instructions_per_frame)
@@ -1,225 +1,258 @@
+"""Assembler for the instruction set in isa.py.
+
+Every instruction is sized, encoded and checked from its isa.Instruction entry,
+so new opcodes only need a line there. It's single pass: instructions are
+encoded as they're read and operands that name a label are patched in once
+every label is known.
+
+    from compiler import assemble
+    rom = assemble(open("test.s").read())
+
+Syntax is one instruction per line, optionally after a "label:", operands
+separated by commas or spaces and ";" starting a comment. Registers are R0-R7,
+numbers anything int(x, 0) takes. Jump operands take a label or an offset from
+the ROM base, address operands a label (its address in memory) or an address.
+
+`include "file.s"` pulls in another file, relative to the one including it.
+Included files are separate modules placed after the includer, each one once
+however often it's included, and labels are shared between all of them.
+Building files, with includes and a cache of assembled modules, is in build.py.
+"""
+import os
 import re
+import struct
+import marshal
+import argparse
+
+import isa
+import optimizer
+from isa import ROM_BASE, REGISTER_COUNT
+from optimizer import Statement
+
+# label, mnemonic and operands of a line, anything after ; is a comment
+LINE = re.compile(r"\s*(?:([A-Za-z_.$][\w.$]*)\s*:)?\s*(?:([A-Za-z]\w*)\b\s*([^;]*?))?\s*(?:;.*)?")
+OPERAND_SEPARATOR = re.compile(r"\s*,\s*|\s+")
+INCLUDE = "include"
+REGISTERS = {f"{prefix}{index}": index for index in range(REGISTER_COUNT) for prefix in "Rr"}
+
+# (lowest, highest) value an operand of each kind can hold, negative numbers wrap
+NARROW_RANGES = {isa.REG: (0, REGISTER_COUNT - 1), isa.IMM: (-0x8000, 0xFFFF), isa.ADDR: (0, 0xFFFF),
+                 isa.JUMP: (0, 0xFFFF), isa.INT: (-0x80000000, 0xFFFFFFFF)}
+WIDE_RANGES = {**NARROW_RANGES, isa.ADDR: (0, 0xFFFFFFFF), isa.JUMP: (0, 0xFFFFFFFF)}
+OPERAND_MASKS = {isa.REG: 0xFF, isa.IMM: 0xFFFF, isa.ADDR: 0xFFFFFFFF, isa.JUMP: 0xFFFFFFFF, isa.INT: 0xFFFFFFFF}
+
+class AssemblyError(ValueError):
+    def __init__(self, line: int, message: str, path: str | None = None) -> None:
+        super().__init__(f"{path}:{line}: {message}" if path else f"line {line}: {message}")
+        self.line = line
+        self.message = message
+        self.path = path
 
-instruction_sizes = {
-    "MOV": 1 + 1 + 2,     # 3 bytes (1 for opcode, 1 for register, 2 for immediate)
-    "ADD": 1 + 2,         # 3 bytes (1 for opcode, 2 for registers)
-    "SUB": 1 + 2,         # 3 bytes (1 for opcode, 2 for registers)
-    "LOAD": 1 + 1 + 2,    # 4 bytes (1 for opcode, 1 for register, 2 for address)
-    "STR": 1 + 2 + 1,     # 4 bytes (1 for opcode, 2 for address, 1 for register)
-    "JMP": 1 + 2,         # 3 bytes (1 for opcode, 2 for address)
-    "CALL": 1 + 2,        # 3 bytes (1 for opcode, 2 for address)
-    "RET": 1,             # 1 byte (1 for opcode)
-    "PUSH": 1 + 1,        # 2 bytes (1 for opcode, 1 for register)
-    "POP": 1 + 1,         # 2 bytes (1 for opcode, 1 for register)
-    "HLT": 1,             # 1 byte (1 for opcode)
-
-    "JEQ": 1 + 1 + 2,     # 3 bytes (1 for opcode, 1 for register, 2 for address)
-    "JNE": 1 + 1 + 2,     # 3 bytes (1 for opcode, 1 for register, 2 for address)
-    "JG": 1 + 1 + 2,      # 3 bytes (1 for opcode, 1 for register, 2 for address)
-    "JL": 1 + 1 + 2,      # 3 bytes (1 for opcode, 1 for register, 2 for address)
-    "DRW": 1 + 1 + 1 + 1, # 4 bytes (1 for opcode, 1 for xPosition, 1 for yPosition, 1 for color)
-    "CLR": 1, # opcode
-    "RENDER": 1, # opcode
-
-    "DIV": 1 + 1 + 1, # 4 bytes (1 for opcode, 2 for registers)
-    "MUL": 1 + 1 + 1, # 4 bytes (1 for opcode, 2 for registers)
-    "RECT": 1 + 1 + 1 + 1 + 1 + 1, # 6 bytes (1 for opcode, 1 for xPosition, 1 for yPosition, 1 for width, 1 for height, 1 for color)
-
-    "RND": 1 + 1,  # 2 bytes (1 for opcode, 1 for register)
-    "SEED": 1 + 4, # 5 bytes (1 for opcode, 4 for seed)
-    "RNDMAP": 1 + 1 + 2 + 2 # 4 bytes (1 for opcode, 1 for register, 2 for min, max immediates)
-}
+class Module:
+    """One source file encoded on its own, with its labels and includes still unresolved.
+
+    Label operands are zero in code and listed in relocations, so a module
+    doesn't depend on where it's placed or on any other module. See build.py.
+    """
+
+    def __init__(self, code: bytes, labels: dict[str, tuple[int, int]], relocations: list[tuple[int, int, str, str]],
+                 includes: list[tuple[int, str]], optimizations: list[tuple[int, str]] = ()) -> None:
+        self.code = code
+        self.labels = labels           # name -> (offset in code, line)
+        self.relocations = relocations # (line, offset in code, operand kind, label)
+        self.includes = includes       # (line, path as written)
+        self.optimizations = list(optimizations) # (line, what the optimizer did there)
+
+    def dump(self) -> bytes:
+        return marshal.dumps((self.code, self.labels, self.relocations, self.includes, self.optimizations))
+
+    @classmethod
+    def load(cls, data: bytes) -> "Module":
+        return cls(*marshal.loads(data))
 
 class Compiler:
-    def __init__(self):
-        self.registers = {
-            "R0": 0, "R1": 1, "R2": 2, "R3": 3,
-            "R4": 4, "R5": 5, "R6": 6, "R7": 7
-        }
-        self.labels = {}
-        self.instructions = []
-        self.bytecode = []
-
-    def compile(self, code):
-        lines = code.strip().split("\n")
-        position = 0
-        
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith(";"):
+    def __init__(self, rom_base: int = ROM_BASE, wide_addresses: bool = False, optimize: bool = False) -> None:
+        self.rom_base = rom_base
+        self.wide_addresses = wide_addresses
+        self.optimize = optimize # run optimizer.py over every module
+        self.ranges = WIDE_RANGES if wide_addresses else NARROW_RANGES
+        self.formats = isa.WIDE_OPERAND_FORMATS if wide_addresses else isa.OPERAND_FORMATS
+        # mnemonic -> (opcode byte, operand kinds, operand struct, offset of each operand)
+        self.encodings = {}
+        for instruction in isa.INSTRUCTIONS:
+            operand_struct, _ = instruction.encoding(wide_addresses)
+            offsets, offset = [], 1
+            for kind in instruction.operands:
+                offsets.append(offset)
+                offset += struct.calcsize("<" + self.formats[kind])
+            self.encodings[instruction.mnemonic] = (bytes((instruction.opcode,)), instruction.operands, operand_struct, offsets)
+        self.labels: dict[str, int] = {} # offsets from the start of the ROM
+
+    def compile(self, code: str) -> bytearray:
+        module = self.compile_module(code)
+        if module.includes:
+            raise AssemblyError(module.includes[0][0], "include needs to know which file it's relative to, build files with build.py")
+        return self.link([(None, module)])
+
+    def compile_module(self, code: str, path: str | None = None) -> Module:
+        labels = {}
+        bytecode = bytearray()
+        relocations = []
+        includes = []
+        # (mnemonic, operands) -> what _pack made of them, or _parse when optimizing, source repeats itself a lot
+        encoded = {}
+        # labels as (name, line) and Statements, encoded after the optimizer went over them
+        program = [] if self.optimize else None
+
+        for number, line in enumerate(code.split("\n"), 1):
+            match = LINE.fullmatch(line)
+            if match is None:
+                raise AssemblyError(number, f"can't parse {line.strip()!r}", path)
+            label, mnemonic, operands = match.groups()
+            if label is not None:
+                if label in labels:
+                    raise AssemblyError(number, f"label {label!r} is already defined", path)
+                labels[label] = (len(bytecode), number)
+                if program is not None:
+                    program.append((label, number))
+            if mnemonic is None:
                 continue
 
-            if ":" in line:
-                label = line.split(":")[0].strip()
-                self.labels[label] = position
-                line = line.split(":")[1].strip()
-                # print(f"{label=} estimation is 0x{position:02X}")
-            
-            if line:
-                instruction = line.split(" ")[0]
-                if instruction in instruction_sizes:
-                    position += instruction_sizes[instruction]
-                    self.instructions.append(line)
-                    # print(f"Added {instruction_sizes[instruction]} from '{line}'")
-                else:
-                    print(f"idk this instruction {instruction=}")
-        
-        for line in self.instructions:
-            line = line.strip()
-            if not line or line.startswith(";"):
+            key = (mnemonic, operands)
+            instruction = encoded.get(key)
+            if instruction is None:
+                if mnemonic.lower() == INCLUDE:
+                    included = operands.strip('"')
+                    if not included:
+                        raise AssemblyError(number, "include needs a file", path)
+                    includes.append((number, included))
+                    continue
+                instruction = self._parse(number, mnemonic, operands, path)
+                encoded[key] = instruction = instruction if program is not None else self._pack(*instruction)
+            if program is not None:
+                # the optimizer changes operands in place
+                program.append(Statement(number, instruction[0], list(instruction[1])))
                 continue
-            
-            tokens = re.split(r"\s+", line)
-            instruction = tokens[0].upper()
-            args = [arg.strip(",") for arg in tokens[1:]]
-            
-            if instruction == "MOV":
-                self.bytecode.append(0x01)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.extend(self.encode_immediate(self.parse_immediate(args[1])))
-            elif instruction == "ADD":
-                self.bytecode.append(0x02)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.append(self.get_register_code(args[1]))
-            elif instruction == "SUB":
-                self.bytecode.append(0x03)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.append(self.get_register_code(args[1]))
-            elif instruction == "LOAD":
-                self.bytecode.append(0x04)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.extend(self.encode_address(self.parse_address(args[1])))
-            elif instruction == "STR":
-                self.bytecode.append(0x05)
-                self.bytecode.extend(self.encode_address(self.parse_address(args[0])))
-                self.bytecode.append(self.get_register_code(args[1]))
-            elif instruction == "JMP":
-                self.bytecode.append(0x06)
-                self.bytecode.extend(self.encode_address(self.parse_label(args[0])))
-            elif instruction == "CALL":
-                self.bytecode.append(0x07)
-                self.bytecode.extend(self.encode_address(self.parse_label(args[0])))
-            elif instruction == "RET":
-                self.bytecode.append(0x08)
-            elif instruction == "PUSH":
-                self.bytecode.append(0x09)
-                self.bytecode.append(self.get_register_code(args[0]))
-            elif instruction == "POP":
-                self.bytecode.append(0x0A)
-                self.bytecode.append(self.get_register_code(args[0]))
-            elif instruction == "JZ":
-                self.bytecode.append(0x0B)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.extend(self.encode_address(self.parse_address(args[1])))
-            elif instruction == "JNZ":
-                self.bytecode.append(0x0C)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.extend(self.encode_address(self.parse_address(args[1])))
-            elif instruction == "JG":
-                self.bytecode.append(0x0D)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.extend(self.encode_address(self.parse_address(args[1])))
-            elif instruction == "JL":
-                self.bytecode.append(0x0E)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.extend(self.encode_address(self.parse_address(args[1])))
-            elif instruction == "JEQ":
-                self.bytecode.append(0x0F)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.append(self.get_register_code(args[1]))
-                self.bytecode.extend(self.encode_address(self.parse_label(args[2])))
-            elif instruction == "JNE":
-                self.bytecode.append(0x10)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.append(self.get_register_code(args[1]))
-                self.bytecode.extend(self.encode_address(self.parse_label(args[2])))
-            elif instruction == "DRW":
-                self.bytecode.append(0x11)
-                self.bytecode.append(self.get_register_code(args[0])) # x
-                self.bytecode.append(self.get_register_code(args[1])) # y
-                self.bytecode.append(self.get_register_code(args[2])) # color
-            elif instruction == "CLR":
-                self.bytecode.append(0x12)
-            elif instruction == "RENDER":
-                self.bytecode.append(0x13)
-            elif instruction == "DIV":
-                self.bytecode.append(0x14)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.append(self.get_register_code(args[1]))
-            elif instruction == "MUL":
-                self.bytecode.append(0x15)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.append(self.get_register_code(args[1]))
-            elif instruction == "RECT":
-                self.bytecode.append(0x16)
-                self.bytecode.append(self.get_register_code(args[0])) # x
-                self.bytecode.append(self.get_register_code(args[1])) # y
-                self.bytecode.append(self.get_register_code(args[2])) # w
-                self.bytecode.append(self.get_register_code(args[3])) # h
-                self.bytecode.append(self.get_register_code(args[4])) # color
-            elif instruction == "RND":
-                self.bytecode.append(0x17)
-                self.bytecode.append(self.get_register_code(args[0]))
-            elif instruction == "SEED":
-                self.bytecode.append(0x18)
-                self.bytecode.extend(self.encode_int(self.parse_int(args[0])))
-            elif instruction == "RNDMAP":
-                self.bytecode.append(0x19)
-                self.bytecode.append(self.get_register_code(args[0]))
-                self.bytecode.extend(self.encode_immediate(self.parse_immediate(args[1])))
-                self.bytecode.extend(self.encode_immediate(self.parse_immediate(args[2])))
-            elif instruction == "IN":
-                self.bytecode.append(0x1A)
-                self.bytecode.append(self.encode_immediate(self.parse_immediate(args[0])))
-                self.bytecode.append(self.encode_address(self.parse_address(args[1])))
-            elif instruction == "OUT":
-                self.bytecode.append(0x1B)
-                self.bytecode.append(self.encode_immediate(self.parse_immediate(args[0])))
-                self.bytecode.append(self.encode_address(self.parse_address(args[1])))
-            # IN DEV, ADDR
-            # OUT DEV, ADDR
-            elif instruction == "HLT":
-                self.bytecode.append(0xFF)
-            else:
-                raise ValueError(f"Unknown instruction: {instruction}")
-
-        if len(self.bytecode) != position:
-            print(f"[FATAL] Expected bytecode length to be {position} bytes but instead got {len(self.bytecode)} bytes!")
-            print(self.bytecode)
-        
-
-        return bytearray(self.bytecode)
-
-    def get_register_code(self, reg_name):
-        reg_name = reg_name.strip(",")
-        if reg_name in self.registers:
-            return self.registers[reg_name]
-        raise ValueError(f"Unknown register: {reg_name}")
-
-    def parse_immediate(self, value):
-        return int(value, 0)
-    def parse_address(self, addr):
-        return int(addr, 0)
-    def parse_int(self, addr):
-        return int(addr, 0)
-
-    def encode_immediate(self, value):
-        return [value & 0xFF, (value >> 8) & 0xFF]
-    def encode_address(self, value):
-        return [value & 0xFF, (value >> 8) & 0xFF]
-    def encode_int(self, value):
-        return [value & 0xFF, (value >> 8) & 0xFF, (value >> 16) & 0xFF, (value >> 24) & 0xFF]
-
-    def parse_label(self, label):
-        label = label.strip()
-        if label in self.labels:
-            return self.labels[label]
-        else:
-            raise ValueError(f"Unknown label: {label}")
-
-assembly_code = open("test.s").read()
-
-compiler = Compiler()
-bytecode = compiler.compile(assembly_code)
-open("test.rom", "wb").write(bytecode)
-print(f"Wrote {len(bytecode)} bytes!")
+            code_bytes, label_operands = instruction
+            for offset, kind, name in label_operands:
+                relocations.append((number, len(bytecode) + offset, kind, name))
+            bytecode += code_bytes
+
+        if program is None:
+            return Module(bytes(bytecode), labels, relocations, includes)
+
+        optimizations = optimizer.optimize(program, self.rom_base)
+        labels = {}
+        bytecode = bytearray()
+        for statement in program:
+            if not isinstance(statement, Statement):
+                name, number = statement
+                labels[name] = (len(bytecode), number)
+                continue
+            code_bytes, label_operands = self._pack(statement.mnemonic, statement.operands)
+            for offset, kind, name in label_operands:
+                relocations.append((statement.line, len(bytecode) + offset, kind, name))
+            bytecode += code_bytes
+        return Module(bytes(bytecode), labels, relocations, includes, optimizations)
+
+    def link(self, modules: list[tuple[str | None, Module]]) -> bytearray:
+        """Lay (path, module) pairs out one after another and resolve every label operand.
+
+        Labels are shared by all modules, defining one twice is an error.
+        """
+        bytecode = bytearray()
+        labels = {} # name -> (offset in bytecode, path of the module defining it)
+        bases = []
+        for path, module in modules:
+            base = len(bytecode)
+            for name, (offset, line) in module.labels.items():
+                if name in labels:
+                    raise AssemblyError(line, f"label {name!r} is already defined in {labels[name][1]}", path)
+                labels[name] = (base + offset, path)
+            bases.append(base)
+            bytecode += module.code
+
+        for (path, module), base in zip(modules, bases):
+            for number, offset, kind, label in module.relocations:
+                if label not in labels:
+                    raise AssemblyError(number, f"unknown label {label!r}", path)
+                value = labels[label][0] if kind == isa.JUMP else self.rom_base + labels[label][0]
+                if value > self.ranges[kind][1]:
+                    raise AssemblyError(number, f"label {label!r} at {value} is out of reach, try wide addresses", path)
+                struct.pack_into("<" + self.formats[kind], bytecode, base + offset, value)
+
+        self.labels = {name: offset for name, (offset, _) in labels.items()}
+        return bytecode
+
+    def _parse(self, number: int, mnemonic: str, operands: str, path: str | None = None) -> tuple[str, list[int | str]]:
+        """The mnemonic and operand values of one instruction, operands that name a label are the label."""
+        mnemonic = mnemonic.upper()
+        encoding = self.encodings.get(mnemonic)
+        if encoding is None:
+            raise AssemblyError(number, f"unknown instruction {mnemonic!r}", path)
+        kinds = encoding[1]
+        tokens = OPERAND_SEPARATOR.split(operands) if operands else []
+        if len(tokens) != len(kinds):
+            raise AssemblyError(number, f"{mnemonic} takes {len(kinds)} operands, got {len(tokens)}", path)
+
+        values = []
+        for kind, token in zip(kinds, tokens):
+            if kind == isa.REG:
+                value = REGISTERS.get(token)
+                if value is None:
+                    raise AssemblyError(number, f"unknown register {token!r}", path)
+                values.append(value)
+                continue
+            try:
+                value = int(token, 0)
+            except ValueError:
+                if kind == isa.JUMP or kind == isa.ADDR:
+                    values.append(token)
+                    continue
+                raise AssemblyError(number, f"expected a number, got {token!r}", path) from None
+            lowest, highest = self.ranges[kind]
+            if not (lowest <= value <= highest):
+                raise AssemblyError(number, f"{value} doesn't fit in a {kind!r} operand ({lowest} to {highest})", path)
+            values.append(value & OPERAND_MASKS[kind])
+        return mnemonic, values
+
+    def _pack(self, mnemonic: str, values: list[int | str]) -> tuple[bytes, list[tuple[int, str, str]]]:
+        """The bytes of one instruction and (offset, kind, label) for each operand that names a label."""
+        opcode, kinds, operand_struct, offsets = self.encodings[mnemonic]
+        # label operands are patched in link once every label is known
+        label_operands = [(offset, kind, value) for kind, value, offset in zip(kinds, values, offsets) if isinstance(value, str)]
+        if label_operands:
+            values = [0 if isinstance(value, str) else value for value in values]
+        return opcode + operand_struct.pack(*values), label_operands
+
+def assemble(source: str, rom_base: int = ROM_BASE, wide_addresses: bool = False, optimize: bool = False) -> bytes:
+    """Assemble source into a ROM image, raises AssemblyError on the first mistake."""
+    return bytes(Compiler(rom_base, wide_addresses, optimize).compile(source))
+
+def main():
+    # files can include others, which build.py resolves
+    from build import Build, print_report
+
+    parser = argparse.ArgumentParser(description="Assemble a program into a ROM")
+    parser.add_argument("source", nargs="?", default="test.s")
+    parser.add_argument("-o", "--output", help="ROM to write, the source with .rom instead of its extension by default")
+    parser.add_argument("--rom-base", type=lambda value: int(value, 0), default=ROM_BASE, help="where the ROM is loaded, label addresses depend on it")
+    parser.add_argument("--wide-addresses", action="store_true", help="4 byte addresses and jump targets, see memorymap.py")
+    parser.add_argument("-O", "--optimize", action="store_true", help="run the peephole optimizer, see optimizer.py")
+    parser.add_argument("--report", action="store_true", help="list what the optimizer changed")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.source)[0] + ".rom"
+    build = Build(args.source, args.rom_base, args.wide_addresses, cache_dir=None, optimize=args.optimize)
+    try:
+        bytecode = build.build()
+    except AssemblyError as e:
+        parser.exit(1, f"{e}\n")
+    with open(output, "wb") as f:
+        f.write(bytecode)
+    print(f"Wrote {len(bytecode)} bytes!")
+    if args.report:
+        print_report(build.optimizations)
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,3 @@
 from .test import *
+from .disk import *
+from .rng import *
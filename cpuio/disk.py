@@ -0,0 +1,86 @@
+"""File-backed disk that transfers sectors without stalling the CPU.
+
+OUT PORT, ADDR starts a transfer described by the command at ADDR: a u8
+operation (DISK_READ or DISK_WRITE), a u16 sector and a u16 buffer address.
+The transfer runs on the CPU's I/O threads and the disk's interrupt line is
+raised when it's done. IN PORT, ADDR writes the u8 status at ADDR.
+"""
+import os
+import struct
+
+from emulator import IODevice
+
+SECTOR_SIZE = 256
+DISK_COMMAND = struct.Struct("<BHH") # operation, sector, buffer address
+
+# Operations
+DISK_READ  = 1
+DISK_WRITE = 2
+
+# Status
+DISK_READY  = 0 # the last transfer finished
+DISK_BUSY   = 1
+DISK_FAILED = 2 # the last transfer couldn't read or write the file
+
+class Disk(IODevice):
+    def __init__(self, cpu, path: str, interrupt: int | None = 0) -> None:
+        super().__init__(cpu)
+        self.path = path
+        self.interrupt = interrupt
+        self.status = DISK_READY
+        self.busy = 0 # transfers in flight
+
+    def _in(self, addr: int) -> None:
+        self.cpu.dma_write(addr, bytes([DISK_BUSY if self.busy else self.status]))
+
+    def _out(self, addr: int) -> None:
+        operation, sector, buffer = DISK_COMMAND.unpack(self.cpu.dma_read(addr, DISK_COMMAND.size))
+        offset = sector * SECTOR_SIZE
+        if operation == DISK_READ:
+            self.submit(lambda: self._read(offset), lambda result: self._finish(result, buffer))
+        elif operation == DISK_WRITE:
+            # copied now, the guest can reuse the buffer while the write runs
+            data = bytes(self.cpu.dma_read(buffer, SECTOR_SIZE))
+            self.submit(lambda: self._write(offset, data), lambda result: self._finish(result, None))
+        else:
+            raise ValueError(f"Unknown disk operation {operation}")
+        self.busy += 1
+
+    # Run on the I/O threads, the result is the status followed by the sector for reads
+    def _read(self, offset: int) -> bytes:
+        if self.cpu.replaying:
+            return b"" # the recorded result is used
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                data = os.pread(fd, SECTOR_SIZE, offset)
+            finally:
+                os.close(fd)
+        except OSError:
+            return bytes([DISK_FAILED])
+        # past the end of the file reads as zeros
+        return bytes([DISK_READY]) + data.ljust(SECTOR_SIZE, b"\0")
+    def _write(self, offset: int, data: bytes) -> bytes:
+        if self.cpu.replaying:
+            return b""
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, data, offset)
+            finally:
+                os.close(fd)
+        except OSError:
+            return bytes([DISK_FAILED])
+        return bytes([DISK_READY])
+
+    def cancel(self, future) -> None:
+        # dropped by a restore, the status stays what it was
+        self.busy -= 1
+
+    # Back on the CPU thread
+    def _finish(self, result: bytes, buffer: int | None) -> None:
+        result = self.cpu.external_input(lambda: result)
+        self.busy -= 1
+        self.status = result[0]
+        if buffer is not None and self.status == DISK_READY:
+            self.cpu.dma_write(buffer, result[1:])
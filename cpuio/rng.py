@@ -0,0 +1,116 @@
+"""Random number device, fills memory or the screen with LCG output in one OUT.
+
+It draws from the CPU's own LCG, so N values from the device are the values N
+RNDs would have produced and the generator ends up in the same state either
+way. Mapped values are what RNDMAP gives for them. With NumPy installed a block
+of values is computed at once by jumping ahead, without it they're generated
+one at a time in Python, which is still far cheaper than RND/RNDMAP/STR per
+value in the guest.
+
+OUT PORT, ADDR runs the command at ADDR, a u8 operation, u16 min and u16 max
+followed by
+  FILL_BYTES: u32 address, u32 count, count values mapped to [min, max], stored as their low byte
+  FILL_WORDS: u32 address, u32 count, count raw values as little-endian u32s, min and max are unused
+  FILL_RECT:  u16 x, u16 y, u16 width, u16 height, a mapped value per pixel, row by row, drawn like DRW
+"""
+import struct
+
+from emulator import IODevice, map_to_range_int
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RANDOM_COMMAND = struct.Struct("<BHH") # operation, min, max
+FILL_RANGE = struct.Struct("<II")      # address, count
+FILL_AREA = struct.Struct("<HHHH")     # x, y, width, height
+
+# Operations
+FILL_BYTES = 1
+FILL_WORDS = 2
+FILL_RECT  = 3
+
+# values computed per NumPy step, each one is a multiply-add against a precomputed jump
+JUMP_BLOCK = 1 << 16
+_jumps: dict[tuple[int, int, int], tuple] = {}
+
+def _jump_table(a: int, c: int, size: int) -> tuple:
+    """a**k and c * (1 + a + ... + a**(k-1)) mod 2**32 for k = 1..size, x_k = A_k * x_0 + C_k."""
+    key = (a, c, size)
+    if key not in _jumps:
+        # uint32 arithmetic wraps, which is the mod 2**32
+        multipliers = numpy.cumprod(numpy.full(size, a, dtype=numpy.uint32), dtype=numpy.uint32)
+        powers = numpy.concatenate((numpy.ones(1, dtype=numpy.uint32), multipliers[:-1]))
+        increments = numpy.cumsum(powers, dtype=numpy.uint32) * numpy.uint32(c)
+        _jumps[key] = (multipliers, increments)
+    return _jumps[key]
+
+def generate(rng, count: int):
+    """The next count outputs of rng, which ends up past them.
+
+    A uint32 NumPy array when NumPy is installed and the LCG is mod 2**32, a list otherwise.
+    """
+    if numpy is not None and rng.m == 1 << 32:
+        values = numpy.empty(count, dtype=numpy.uint32)
+        multipliers, increments = _jump_table(rng.a, rng.c, min(max(count, 1), JUMP_BLOCK))
+        state = rng.state % rng.m
+        for start in range(0, count, len(multipliers)):
+            n = min(len(multipliers), count - start)
+            values[start:start + n] = multipliers[:n] * numpy.uint32(state) + increments[:n]
+            state = int(values[start + n - 1])
+        rng.state = state
+        return values
+
+    a, c, m, state = rng.a, rng.c, rng.m, rng.state
+    values = [0] * count
+    for i in range(count):
+        state = (a * state + c) % m
+        values[i] = state
+    rng.state = state
+    return values
+
+def mapped(values, min_val: int, max_val: int, word_mask: int = 0xFFFFFFFF, m: int = 2**32):
+    """RNDMAP R, min_val, max_val for every value, after RND masked it to the word size."""
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        values = values.astype(numpy.int64) & word_mask
+        scaled, remainder = numpy.divmod(values * (max_val - min_val), m - 1)
+        result = min_val + scaled
+        # same float fallback as map_to_range_int, numpy does the same IEEE operations in the same order
+        exact = remainder == 0
+        if exact.any():
+            result[exact] = (min_val + (values[exact] / (m - 1)) * (max_val - min_val)).astype(numpy.int64)
+        return result
+    return [map_to_range_int(value & word_mask, min_val, max_val, m) for value in values]
+
+class RandomDevice(IODevice):
+    def _out(self, addr: int) -> None:
+        cpu = self.cpu
+        operation, min_val, max_val = RANDOM_COMMAND.unpack(cpu.dma_read(addr, RANDOM_COMMAND.size))
+        arguments = addr + RANDOM_COMMAND.size
+
+        if operation == FILL_BYTES:
+            target, count = FILL_RANGE.unpack(cpu.dma_read(arguments, FILL_RANGE.size))
+            values = mapped(generate(cpu.rng, count), min_val, max_val, cpu.word_mask, cpu.rng.m)
+            if numpy is not None and isinstance(values, numpy.ndarray):
+                cpu.dma_write(target, (values & 0xFF).astype(numpy.uint8))
+            else:
+                cpu.dma_write(target, bytes(value & 0xFF for value in values))
+        elif operation == FILL_WORDS:
+            target, count = FILL_RANGE.unpack(cpu.dma_read(arguments, FILL_RANGE.size))
+            values = generate(cpu.rng, count)
+            if numpy is not None and isinstance(values, numpy.ndarray):
+                cpu.dma_write(target, (values & numpy.uint32(cpu.word_mask)).astype("<u4"))
+            else:
+                cpu.dma_write(target, struct.pack(f"<{count}I", *(value & cpu.word_mask for value in values)))
+        elif operation == FILL_RECT:
+            x, y, width, height = FILL_AREA.unpack(cpu.dma_read(arguments, FILL_AREA.size))
+            # every pixel draws a value, even the clipped ones, like a DRW loop would
+            values = mapped(generate(cpu.rng, width * height), min_val, max_val, cpu.word_mask, cpu.rng.m)
+            if numpy is not None and isinstance(values, numpy.ndarray):
+                pixels = numpy.minimum(values, 255).astype(numpy.uint8)
+            else:
+                pixels = bytes(min(value, 255) for value in values)
+            cpu.framebuffer.blit(x, y, width, height, pixels)
+        else:
+            raise ValueError(f"Unknown random device operation {operation}")
@@ -2,11 +2,11 @@ from emulator import IODevice
 
 class TestDevice(IODevice):
     def _in(self, addr: int) -> None:
-        self.cpu.set_memory(addr, bytearray([
+        self.cpu.dma_write(addr, bytes([
             69, 42, 69, 42
         ]))
     
     def _out(self, addr: int) -> None:
-        self.cpu.set_memory(addr, bytearray([
+        self.cpu.dma_write(addr, bytes([
             42, 69, 42, 69
         ]))
@@ -0,0 +1,127 @@
+"""asyncio debug server, speaks the protocol in protocol.py.
+
+The server runs its own event loop on a thread that sleeps until a client does
+something. It never touches the CPU itself: requests are queued on the CPU
+(submit_debug_request), which answers them between batches, or right away when
+the CPU isn't inside run().
+"""
+import os
+import socket
+import asyncio
+import threading
+
+import protocol
+
+class DebugServer:
+    def __init__(self, cpu, host: str = "localhost", port: int = 12345, path: str | None = None) -> None:
+        self.cpu = cpu
+        self.host = host
+        self.port = port
+        self.path = path # listen on a Unix socket instead of TCP
+        self.thread: threading.Thread | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._stopping: asyncio.Event | None = None
+        self._ready = threading.Event()
+        self._error: BaseException | None = None
+        self._clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self._detached = threading.Event() # set while no client is connected
+        self._detached.set()
+
+    @property
+    def address(self) -> str:
+        return self.path if self.path is not None else f"{self.host}:{self.port}"
+
+    def start(self) -> None:
+        """Start serving on a background thread, raises if the address can't be bound."""
+        self.thread = threading.Thread(target=self._serve, name="debug-server", daemon=True)
+        self.thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self.thread.join()
+            raise self._error
+        self.cpu.log(f"Debug server started on {self.address}")
+
+    def stop(self) -> None:
+        if self.thread is None:
+            return
+        if self.loop is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._stopping.set)
+            except RuntimeError:
+                pass # the loop closed in between
+        # a HALT sent by a client runs on the server thread
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+        self.thread = None
+
+    @property
+    def attached(self) -> bool:
+        """Whether a client is connected."""
+        return not self._detached.is_set()
+
+    def wait_detached(self) -> None:
+        """Block until no client is connected or the server stops, returns right away if none is."""
+        self._detached.wait()
+
+    def _serve(self) -> None:
+        try:
+            asyncio.run(self._main())
+        except BaseException as e:
+            self._error = e
+            self._ready.set()
+
+    async def _main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        if self.path is not None:
+            server = await asyncio.start_unix_server(self._client, self.path)
+        else:
+            server = await asyncio.start_server(self._client, self.host, self.port)
+            if self.port == 0:
+                self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+
+        async with server:
+            await self._stopping.wait()
+            for writer in self._clients.values():
+                writer.close()
+            # give the handlers a moment to see the end of their streams
+            if self._clients:
+                await asyncio.wait(list(self._clients), timeout=0.1)
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+        self._detached.set()
+        self.cpu.log("Debug server stopped.")
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        messages = protocol.MessageReader()
+        self._clients[asyncio.current_task()] = writer
+        self._detached.clear()
+        try:
+            while data := await reader.read(65536):
+                try:
+                    requests = messages.feed(data)
+                except protocol.ProtocolError as e:
+                    self.cpu.log(f"Debug client sent a bad message: {e}")
+                    break
+                # queue everything that arrived before waiting, pipelined requests share a batch boundary
+                # a STEP runs the CPU, when no thread is running it it's answered on a worker thread, not the event loop
+                steps = any(protocol.runs_cpu(message) for message in requests)
+                pending = [self.cpu.submit_debug_request(message, process=not steps) for message in requests]
+                if steps:
+                    self.loop.run_in_executor(None, self.cpu.process_debug_requests)
+                for future in pending:
+                    # answered on the spot when the CPU wasn't running
+                    writer.write(future.result() if future.done() else await asyncio.wrap_future(future))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.pop(asyncio.current_task(), None)
+            if not self._clients:
+                self._detached.set()
+            writer.close()
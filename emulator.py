@@ -1,192 +1,609 @@
 import os
+import mmap
 import time
-import socket
+import struct
+from array import array
 import threading
-import pickle
+import operator
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List
 
-DISPLAY_WIDTH  = 256
-DISPLAY_HEIGHT = 256
+import isa
+import protocol
+import replay
+from isa import STACK_WORD, REGISTER_COUNT
+from blocks import BlockCompiler
+from clock import Clock
+from debugserver import DebugServer
+from profiler import Profiler
+from tracer import TraceRecorder, REGISTER_INTERVAL
+from framebuffer import Framebuffer, DISPLAY_WIDTH, DISPLAY_HEIGHT
+from memorymap import MemoryMap, MappedFile
 
-def lcg_random(seed: int, a=1664525, c=1013904223, m=2**32):
-    """Linear Congruential Generator (LCG) function with seed setting."""
-    state = seed
-    def set_seed(new_seed):
-        nonlocal state
-        state = new_seed
+# CPU.run exit reasons
+EXIT_HALTED  = "halted"
+EXIT_PAUSED  = "paused"
+EXIT_STOPPED = "stopped"
+EXIT_BUDGET  = "budget"
+EXIT_UNTIL   = "until"
+EXIT_INTERRUPTED = "interrupted"
+
+STACK_ENTRY = struct.Struct("<I")
+PORT_COUNT = 0x10000 # IN/OUT take a 16-bit port number
+INTERRUPT_LINES = 16 # bits in the pending mask
+IO_WORKERS = 4       # threads asynchronous device work runs on
+REGISTER_TYPECODE = "I" if array("I").itemsize >= 4 else "L"
+
+# Snapshot format, a header followed by length prefixed memory, registers and framebuffer sections
+SNAPSHOT_MAGIC = b"ECSS"
+SNAPSHOT_VERSION = 4
+# magic, version, word bits, pc, sp, rom size, LCG state, instructions executed, flags,
+# interrupt vector, pending interrupts, interrupt line being served, ROM base, next device operation number
+SNAPSHOT_HEADER = struct.Struct("<4sHHIIIQQBIHBII")
+SNAPSHOT_SECTION = struct.Struct("<I")
+SNAPSHOT_HALTED = 1
+SNAPSHOT_PAUSED = 2
+SNAPSHOT_INTERRUPTS_ENABLED = 4
+SNAPSHOT_WIDE_ADDRESSES = 8
+
+# Breakpoint conditions compare a register (unsigned) against a value
+COMPARISONS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+
+# Why execution stopped for the debugger, see CPU.stop_reason
+STOP_BREAKPOINT  = "breakpoint"
+STOP_WATCH_READ  = "watch_read"
+STOP_WATCH_WRITE = "watch_write"
+STOP_STEP        = "step"
+
+class LCG:
+    """Linear Congruential Generator (LCG) with an inspectable state."""
+
+    def __init__(self, seed: int, a=1664525, c=1013904223, m=2**32) -> None:
+        self.state = seed
+        self.a = a
+        self.c = c
+        self.m = m
 
-    def nextv():
-        nonlocal state
-        state = (a * state + c) % m
-        return state
+    def seed(self, new_seed: int) -> None:
+        self.state = new_seed
 
-    return nextv, set_seed
+    def next(self) -> int:
+        self.state = (self.a * self.state + self.c) % self.m
+        return self.state
+
+def lcg_random(seed: int, a=1664525, c=1013904223, m=2**32):
+    """Linear Congruential Generator (LCG) function with seed setting."""
+    generator = LCG(seed, a, c, m)
+    return generator.next, generator.seed
 
 def map_to_range(lcg_value: int, min_val: int, max_val: int, m=2**32):
     """Map LCG value to a specified range [min_val, max_val]."""
     return min_val + (lcg_value / (m - 1)) * (max_val - min_val)
 
+def map_to_range_int(lcg_value: int, min_val: int, max_val: int, m=2**32) -> int:
+    """int(map_to_range(...)) without floats, what RNDMAP computes.
+
+    The float version is off by less than the 1 / (m - 1) steps the exact value
+    moves in, so flooring the exact value agrees with it, except where the exact
+    value is a whole number and the float one can land just below it. Those
+    points take the float path.
+    """
+    scaled, remainder = divmod(lcg_value * (max_val - min_val), m - 1)
+    if remainder:
+        return min_val + scaled
+    return int(map_to_range(lcg_value, min_val, max_val, m))
+
 class IODevice:
+    """A device on the port bus, IN PORT, ADDR calls _in(ADDR) and OUT calls _out(ADDR).
+
+    Devices move data with CPU.dma_read/dma_write and take anything that comes
+    from outside the machine through CPU.external_input, so recordings replay it.
+    Slow work goes through submit, which runs it off the CPU thread, cancel
+    hears about work that was dropped before it completed.
+    """
+    port: int | None = None      # port to attach on, None takes the lowest free one
+    interrupt: int | None = None # line raised when submitted work completes
+
     def __init__(self, cpu: 'CPU'):
         self.cpu = cpu
-    
+
+    def submit(self, work, complete=None) -> Future:
+        """Run work() on the I/O threads, see CPU.run_async."""
+        return self.cpu.run_async(self, work, complete)
+    def cancel(self, future: Future) -> None:
+        """Submitted work that will never complete, CPU.restore drops whatever is in flight."""
+        pass
+
     def _in(self, addr: int) -> None:
         raise NotImplementedError("This device does not support input.")
     def _out(self, addr: int) -> None:
         raise NotImplementedError("This device does not support output.")
 
 class CPU:
-    def __init__(self, rom_filename: str, devices: List[type[IODevice]], ips_limit: float = float("inf")) -> None:
-        self.memory = bytearray(8192)
-        self.display = bytearray(DISPLAY_WIDTH*DISPLAY_HEIGHT)
-
-        # display test
-        # for x in range(DISPLAY_WIDTH*DISPLAY_HEIGHT):
-        #     self.display[x] = 1
-        #     if x >= 32768:
-        #         self.display[x] = 2
-        
-        self.display2 = bytearray(DISPLAY_WIDTH*DISPLAY_HEIGHT) # double buffer
-        self.stack = []
-        self.pc = 0x1000
-        self.registers = {
-            "R0": 0, "R1": 0, "R2": 0, "R3": 0,
-            "R4": 0, "R5": 0, "R6": 0, "R7": 0,
-        }
-        self.instructions_executed = 0
-        self.start_time = time.time()
+    def __init__(self, rom: str | bytes, devices: List[type[IODevice]], ips_limit: float = float("inf"), backend: str = "interpreter", word_bits: int = 32,
+                 framebuffer: Framebuffer | None = None, debug_port: int | None = None, verbose: bool = True,
+                 memory_map: MemoryMap | None = None) -> None:
+        # the debug server only runs when asked for, with debug_port here or start_debug_server
+        # verbose=False keeps stdout quiet, so many CPUs can live in one process
+        self.verbose = verbose
+
+        # the address space, 8 KiB of RAM with the ROM at 0x1000 unless memory_map says otherwise
+        self.memory_map = MemoryMap() if memory_map is None else memory_map
+        self.memory = bytearray(self.memory_map.size)
+        self.rom_base = self.memory_map.rom_base
+        self.stack_top = self.memory_map.stack_top
+        self.stack_base = self.memory_map.stack_base
+        self.wide_addresses = self.memory_map.wide_addresses
+        self.address_size = self.memory_map.address_size
+        self.mapped_files: list[MappedFile] = [] # above RAM, see map_file
+        self._max_instruction_size = isa.MAX_WIDE_INSTRUCTION_SIZE if self.wide_addresses else isa.MAX_INSTRUCTION_SIZE
+
+        # pass a framebuffer to share the display, e.g. one from Framebuffer.create_shared
+        self.framebuffer = Framebuffer(DISPLAY_WIDTH, DISPLAY_HEIGHT) if framebuffer is None else framebuffer
+        self.pc = self.rom_base
+        self.sp = self.stack_top
+
+        # registers wrap around at word_bits, JG/JL/DIV read them as two's complement
+        if word_bits not in (16, 32):
+            raise ValueError(f"word_bits must be 16 or 32, got {word_bits}")
+        self.word_bits = word_bits
+        self.word_mask = (1 << word_bits) - 1
+        self.sign_bit = 1 << (word_bits - 1)
+        # 32-bit storage for both widths, the trace ring copies registers straight out of it
+        self.registers = array(REGISTER_TYPECODE, bytes(REGISTER_COUNT * array(REGISTER_TYPECODE).itemsize))
+        self.instructions_executed = 0 # since power on, up to the batch run() is in, see instruction_count
+        self._batch_executed = 0 # how far into that batch, published by the run loops
+        self._restored = False # restore() already set the count during this batch
+        self.start_time = time.perf_counter()
+        self._ips_mark = 0
         self.halted = False
         self.paused = False
         self.rom_size = 0
         self.stop_requested = False
-        self.ips_limit = ips_limit
-        self.devices = []
-        for d in self.devices:
-            self.devices.append(d(self))
+        self.clock = Clock(ips_limit)
 
-        self.load_rom(rom_filename)
+        # instructions run() executes between checking flags, IPS and throttling
+        self.batch_size = 10000
+        # makes run() leave its inner loop early, set by halt/pause/stop/interrupt
+        self._interrupted = False
+        self._interrupt_requested = False
 
-        self.debug_server_thread = threading.Thread(target=self.debug_server)
-        self.debug_server_thread.start()
+        # called with the CPU after every RENDER
+        self.on_render = None
+
+        # predecoded instructions keyed by PC, only ever holds PCs in the ROM
+        self._decoded: dict[int, tuple] = {}
+        self._handlers = [
+            getattr(self, f"_op_{instruction.mnemonic.lower()}", None) if instruction else None
+            for instruction in isa.BY_OPCODE
+        ]
+
+        # "interpreter" runs one predecoded instruction per step, "blocks" runs a compiled basic block
+        if backend not in ("interpreter", "blocks"):
+            raise ValueError(f"Unknown backend: {backend}")
+        self.backend = backend
+        self._blocks = BlockCompiler(self, {"map_to_range_int": map_to_range_int})
+        # ring of recently executed instructions, see enable_tracer
+        self.tracer: TraceRecorder | None = None
+
+        # IN/OUT find their device by indexing this with the port number
+        self.ports: list[IODevice | None] = [None] * PORT_COUNT
+        self.devices: list[IODevice] = []
+        for device in devices:
+            self.attach_device(device)
+
+        # rom is a filename or the ROM itself
+        if isinstance(rom, str):
+            self.load_rom(rom)
+        else:
+            self.load_rom_bytes(rom)
+
+        # requests from the debug server, answered between batches while run() holds _execution_lock
+        self.debug_server: DebugServer | None = None
+        self._debug_requests: deque[tuple[memoryview, Future]] = deque()
+        self._execution_lock = threading.RLock() # STEP runs the CPU from inside a request
+
+        # Breakpoints and watchpoints, checked by trap entries in _decoded so other instructions don't pay for them
+        self.breakpoints: dict[int, list[tuple[int, str, int] | None]] = {} # pc -> conditions, None always stops
+        self.watchpoints: list[tuple[int, int, bool, bool]] = []            # start, end, read, write
+        self.stop_reason: tuple[str, int, int] | None = None                # reason, pc, address
+        self._trapped: dict[int, tuple[tuple, tuple]] = {} # the decoded instruction under each trap, and what to run for it
+        self._stopped_at: int | None = None  # trap to let through once when execution continues
+
+        self.profiler: Profiler | None = None
+        self.trace_on_halt = 32 # trace records the traceback prints
+
+        # see replay.py, replay_inputs holds recorded device input while replaying
+        self.recorder: replay.Recorder | None = None
+        self.replay_inputs: deque[bytes] | None = None
+
+        # Interrupts, taken between batches: the PC is pushed, interrupts are disabled and execution goes to the vector
+        self.interrupt_vector = 0 # set by IVEC, 0 until then
+        self.interrupts_enabled = False
+        self.interrupt_pending = 0 # bit per line
+        self.interrupt_line = 0    # line being served, IACK reads it
+        # asynchronous device work, numbered in submission order so replay can deliver it at the same point
+        self._io_pool: ThreadPoolExecutor | None = None
+        self._io_sequence = 0
+        self._io_operations: dict[int, tuple[IODevice, Future, object]] = {}
+        self._completions: deque[tuple[int, Future]] = deque() # finished operations, appended by the I/O threads
+        if debug_port is not None:
+            self.start_debug_server(port=debug_port)
 
         self.clear_display()
 
-        self._step_random, self._set_seed = lcg_random(42)
+        self.rng = LCG(42)
 
     def load_rom(self, filename: str) -> None:
         with open(filename, "rb") as f:
-            self.memory[0x1000:] = f.read()
-        self.rom_size = os.path.getsize(filename)
-        print(f"Loaded {self.rom_size} bytes for ROM")
+            if os.fstat(f.fileno()).st_size == 0:
+                return self.load_rom_bytes(b"")
+            # copied from the page cache straight into memory, no intermediate bytes object
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.load_rom_bytes(data)
+    def load_rom_bytes(self, data: bytes) -> None:
+        if self.rom_base + len(data) > len(self.memory):
+            raise ValueError(f"ROM is {len(data)} bytes but only {len(self.memory) - self.rom_base} bytes fit in memory")
+        # assigning the exact slice keeps memory at a fixed size
+        self.memory[self.rom_base:self.rom_base + len(data)] = data
+        self.rom_size = len(data)
+        self._decoded.clear()
+        self._blocks.clear()
+        if self.tracer is not None:
+            self.tracer.clear() # formatting reads the instructions from the ROM
+        self.log(f"Loaded {self.rom_size} bytes for ROM")
 
-    # Display
-    def draw_pixel(self, x: int, y: int, color: int) -> None:
-        if x < 0 or x >= DISPLAY_WIDTH or y < 0 or y >= DISPLAY_HEIGHT:
-            return
-
-        # index = y * DISPLAY_WIDTH + x
-        index = x * DISPLAY_WIDTH + y
-        self.display2[index] = min(color, 255)
-    def draw_rectangle(self, x: int, y: int, width: int, height: int, color: int) -> None:
-        color = min(color, 255)
-        x_end = min(x + width, DISPLAY_WIDTH)
-        y_end = min(y + height, DISPLAY_HEIGHT)
-        
-        if x >= DISPLAY_WIDTH or y >= DISPLAY_HEIGHT or x_end <= 0 or y_end <= 0:
-            return
-        
-        row_data = [color] * (x_end - x)
-        
-        for _y in range(y, y_end):
-            start_index = _y * DISPLAY_WIDTH + x
-            end_index = start_index + (x_end - x)
-            self.display2[start_index:end_index] = row_data
-    def clear_display(self):
-        self.display2 = bytearray(DISPLAY_WIDTH*DISPLAY_HEIGHT)
+    # Save states
+    def snapshot(self) -> bytearray:
+        """Capture the whole machine: memory, registers, pc, sp, the LCG, the framebuffer, interrupt state and the halted/paused flags.
 
-    # Fetch
-    def bytelist_to_int(self, bytelist: bytearray) -> int:
-        return int.from_bytes(bytelist, byteorder="little")
-    def fetch(self) -> int:
-        self.pc += 1
-        return self.memory[self.pc-1]
-    def fetch_bytes(self, n) -> bytearray:
-        if self.pc + n > len(self.memory):
-            raise IndexError("Read beyond memory bounds")
+        Device work still in flight and mapped files aren't part of it, restoring
+        drops the work in flight.
+        """
+        memory = memoryview(self.memory)
+        registers = memoryview(self.registers).cast("B")
+        framebuffer_size = self.framebuffer.state_size
 
-        data = self.memory[self.pc:self.pc + n]
-        self.pc += n
+        data = bytearray(SNAPSHOT_HEADER.size + 3 * SNAPSHOT_SECTION.size + len(memory) + len(registers) + framebuffer_size)
+        flags = ((SNAPSHOT_HALTED if self.halted else 0) | (SNAPSHOT_PAUSED if self.paused else 0)
+                 | (SNAPSHOT_INTERRUPTS_ENABLED if self.interrupts_enabled else 0) | (SNAPSHOT_WIDE_ADDRESSES if self.wide_addresses else 0))
+        SNAPSHOT_HEADER.pack_into(data, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.word_bits, self.pc, self.sp,
+                                  self.rom_size, self.rng.state, self.instruction_count, flags,
+                                  self.interrupt_vector, self.interrupt_pending, self.interrupt_line, self.rom_base,
+                                  self._io_sequence)
 
+        view = memoryview(data)
+        offset = SNAPSHOT_HEADER.size
+        for section in (memory, registers):
+            SNAPSHOT_SECTION.pack_into(data, offset, len(section))
+            offset += SNAPSHOT_SECTION.size
+            view[offset:offset + len(section)] = section
+            offset += len(section)
+        SNAPSHOT_SECTION.pack_into(data, offset, framebuffer_size)
+        offset += SNAPSHOT_SECTION.size
+        self.framebuffer.save(view[offset:offset + framebuffer_size])
         return data
-    def fetch_register(self) -> str:
-        return f"R{self.fetch()}"
-    def fetch_immediate(self) -> int:
-        return self.bytelist_to_int(self.fetch_bytes(2))
-    def fetch_addr(self) -> int:
-        return self.bytelist_to_int(self.fetch_bytes(2))
-    def fetch_int(self) -> int:
-        return self.bytelist_to_int(self.fetch_bytes(4))
+
+    def restore(self, data) -> None:
+        """Go back to a state made by snapshot, in place. Anything run() is doing stops after the current instruction."""
+        view = memoryview(data).cast("B")
+        if len(view) < SNAPSHOT_HEADER.size:
+            raise ValueError("Snapshot is truncated")
+        magic, version = struct.unpack_from("<4sH", view, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+        (_, _, word_bits, pc, sp, rom_size, rng_state, instructions_executed, flags,
+         interrupt_vector, interrupt_pending, interrupt_line, rom_base, io_sequence) = SNAPSHOT_HEADER.unpack_from(view, 0)
+        if word_bits != self.word_bits:
+            raise ValueError(f"Snapshot was taken with {word_bits}-bit registers, this CPU has {self.word_bits}")
+        if rom_base != self.rom_base or bool(flags & SNAPSHOT_WIDE_ADDRESSES) != self.wide_addresses:
+            raise ValueError("Snapshot was taken with a different memory map")
+
+        sections = []
+        offset = SNAPSHOT_HEADER.size
+        for expected in (len(self.memory), len(self.registers) * self.registers.itemsize, self.framebuffer.state_size):
+            if offset + SNAPSHOT_SECTION.size > len(view):
+                raise ValueError("Snapshot is truncated")
+            (size,) = SNAPSHOT_SECTION.unpack_from(view, offset)
+            offset += SNAPSHOT_SECTION.size
+            if size != expected or offset + size > len(view):
+                raise ValueError(f"Snapshot section is {size} bytes, expected {expected}")
+            sections.append(view[offset:offset + size])
+            offset += size
+        memory, registers, framebuffer = sections
+        # stamped with the count the restore happens at, before it goes back to the snapshot's
+        if self.recorder is not None:
+            self.recorder.event(replay.RESTORE, bytes(view))
+
+        # rewinding within the same program keeps the decoded instructions and compiled blocks
+        rom = slice(self.rom_base, self.rom_base + max(rom_size, self.rom_size))
+        if rom_size != self.rom_size or memory[rom] != memoryview(self.memory)[rom]:
+            self._decoded.clear()
+            self._blocks.clear()
+            if self.tracer is not None:
+                self.tracer.clear()
+
+        self.memory[:] = memory
+        memoryview(self.registers).cast("B")[:] = registers
+        self.framebuffer.restore(framebuffer)
+        self.pc = pc
+        self.sp = sp
+        self.rom_size = rom_size
+        self.rng.state = rng_state
+        self.instructions_executed = instructions_executed
+        self._batch_executed = 0
+        self._restored = True
+        self.halted = bool(flags & SNAPSHOT_HALTED)
+        self.paused = bool(flags & SNAPSHOT_PAUSED)
+        self.interrupts_enabled = bool(flags & SNAPSHOT_INTERRUPTS_ENABLED)
+        self.interrupt_vector = interrupt_vector
+        self.interrupt_pending = interrupt_pending
+        self.interrupt_line = interrupt_line
+        # work submitted before the restore would complete into a machine that never asked for it
+        for device, future, _ in self._io_operations.values():
+            future.cancel()
+            device.cancel(future)
+        self._io_operations.clear()
+        self._completions.clear()
+        self._io_sequence = io_sequence
+        self._interrupted = True
+        self._ips_mark = instructions_executed
+        self.clock.reset()
+
+    def save_state(self, filename: str) -> None:
+        with open(filename, "wb") as f:
+            f.write(self.snapshot())
+    def load_state(self, filename: str) -> None:
+        with open(filename, "rb") as f:
+            self.restore(f.read())
+
+    # Display
+    @property
+    def display(self) -> memoryview:
+        return self.framebuffer.front
+    @property
+    def display2(self) -> memoryview: # back buffer
+        return self.framebuffer.back
+    def draw_pixel(self, x: int, y: int, color: int) -> None:
+        self.framebuffer.plot(x, y, color)
+    def draw_rectangle(self, x: int, y: int, width: int, height: int, color: int) -> None:
+        self.framebuffer.fill_rect(x, y, width, height, color)
+    def draw_sprite(self, x: int, y: int, width: int, height: int, addr: int) -> None:
+        """Copy the width x height pixels stored row by row at addr into the back buffer."""
+        self.framebuffer.blit(x, y, width, height, self.dma_read(addr, width * height))
+    def clear_display(self):
+        self.framebuffer.clear()
+    def render(self) -> None:
+        self.framebuffer.swap()
+        if self.on_render is not None:
+            self.on_render(self)
 
     # Registers
-    def set_register(self, name: str, value: int) -> None:
-        self.registers[name] = value
-    def get_register(self, name: str) -> int:
-        return self.registers[name]
+    def register_index(self, name: str | int) -> int:
+        index = name if isinstance(name, int) else int(str(name).upper().removeprefix("R"))
+        if not (0 <= index < REGISTER_COUNT):
+            raise IndexError(f"Unknown register: {name}")
+        return index
+    def set_register(self, name: str | int, value: int) -> None:
+        self.registers[self.register_index(name)] = value & self.word_mask
+    def get_register(self, name: str | int) -> int:
+        return self.registers[self.register_index(name)]
+    def get_registers(self) -> dict[str, int]:
+        return {f"R{i}": value for i, value in enumerate(self.registers)}
+    def to_signed(self, value: int) -> int:
+        return value - (1 << self.word_bits) if value & self.sign_bit else value
+    def divide(self, a: int, b: int) -> int:
+        # truncates toward zero like the old int(a / b), without going through floats
+        a, b = self.to_signed(a), self.to_signed(b)
+        quotient = abs(a) // abs(b)
+        return (-quotient if (a < 0) != (b < 0) else quotient) & self.word_mask
 
     # Memory
     def get_memory(self, addr: int) -> int:
         if 0 <= addr < len(self.memory):
             return self.memory[addr]
-        else:
+        mapped = self.mapped_file(addr, 1)
+        if mapped is None:
             raise IndexError(f"Address {addr} is out of bounds. Valid range is 0 to {len(self.memory) - 1}.")
+        return mapped.data[addr - mapped.start]
     def set_memory(self, addr: int, value: int | bytearray) -> None:
-        if not (0 <= addr < len(self.memory)):
-            raise IndexError(f"Address {addr} is out of bounds. Valid range is 0 to {len(self.memory) - 1}.")
-
         if isinstance(value, int):
-            self.memory[addr] = value
+            end_addr = addr + 1
         elif isinstance(value, (bytes, bytearray)):
             end_addr = addr + len(value)
-            if end_addr > len(self.memory):
-                raise IndexError(f"Write operation exceeds memory bounds. Valid range is 0 to {len(self.memory) - 1}.")
+        else:
+            return
+
+        if not (0 <= addr and end_addr <= len(self.memory)):
+            mapped = self.mapped_file(addr, end_addr - addr)
+            if mapped is None:
+                raise IndexError(f"Write of {end_addr - addr} bytes at {addr} is out of bounds. Valid range is 0 to {len(self.memory) - 1}.")
+            if not mapped.writable:
+                raise IndexError(f"Address {addr} is in read-only {mapped}")
+            mapped.data[addr - mapped.start:end_addr - mapped.start] = value if isinstance(value, (bytes, bytearray)) else bytes((value,))
+            return
+        if self.memory_map.read_only and self.memory_map.is_read_only(addr, end_addr):
+            raise IndexError(f"Address {addr} is read-only")
+
+        if isinstance(value, int):
+            self.memory[addr] = value
+        else:
             self.memory[addr:end_addr] = value
 
+        if end_addr > self.rom_base and addr < self.rom_base + self.rom_size:
+            self._invalidate(addr, end_addr)
+
+    # Mapped files
+    def map_file(self, path: str, start: int | None = None, writable: bool = False) -> MappedFile:
+        """mmap a file into the address space above RAM, at start or right after the last mapping.
+
+        LOAD, DMA and the debugger read it in place. Writes fault unless writable,
+        which keeps them in a private copy.
+        """
+        if start is None:
+            start = max([len(self.memory)] + [mapped.end for mapped in self.mapped_files])
+        mapped = MappedFile(path, start, writable)
+        overlaps = start < len(self.memory) or any(start < other.end and other.start < mapped.end for other in self.mapped_files)
+        if overlaps:
+            mapped.close()
+            raise ValueError(f"{mapped} overlaps memory or another mapped file")
+        self.mapped_files.append(mapped)
+        if self.recorder is not None:
+            self.recorder.event(replay.MAP, replay.MAPPING.pack(start, writable) + path.encode())
+        return mapped
+    def unmap_file(self, start: int) -> None:
+        for mapped in self.mapped_files:
+            if mapped.start == start:
+                self.mapped_files.remove(mapped)
+                mapped.close()
+                if self.recorder is not None:
+                    self.recorder.event(replay.UNMAP, replay.UNMAPPING.pack(start))
+                return
+        raise ValueError(f"No file is mapped at 0x{start:X}")
+    def mapped_file(self, addr: int, length: int) -> MappedFile | None:
+        """The mapped file holding all of [addr, addr + length), None if there isn't one."""
+        for mapped in self.mapped_files:
+            if mapped.start <= addr and addr + length <= mapped.end:
+                return mapped
+        return None
+
+    # DMA, devices copy whole ranges through memoryview slices instead of a set_memory per byte
+    def dma_read(self, addr: int, length: int) -> memoryview:
+        """A view of memory[addr:addr + length], or of a mapped file. Copy it if you keep it past the IN/OUT."""
+        if not (0 <= addr and addr + length <= len(self.memory)):
+            mapped = self.mapped_file(addr, length)
+            if mapped is None:
+                raise IndexError(f"DMA read of {length} bytes at {addr} is out of bounds. Valid range is 0 to {len(self.memory) - 1}.")
+            return memoryview(mapped.data)[addr - mapped.start:addr - mapped.start + length]
+        return memoryview(self.memory)[addr:addr + length]
+    def dma_write(self, addr: int, data) -> None:
+        data = memoryview(data).cast("B")
+        end_addr = addr + len(data)
+        if not (0 <= addr and end_addr <= len(self.memory)):
+            # set_memory handles mapped files and the errors
+            return self.set_memory(addr, bytes(data))
+        if self.memory_map.read_only and self.memory_map.is_read_only(addr, end_addr):
+            raise IndexError(f"DMA write of {len(data)} bytes at {addr} hits read-only memory")
+        memoryview(self.memory)[addr:end_addr] = data
+        if end_addr > self.rom_base and addr < self.rom_base + self.rom_size:
+            self._invalidate(addr, end_addr)
+
+    def copy_memory(self, dest: int, src: int, length: int) -> None:
+        """memmove within the address space, with the checks of a guest store."""
+        self.dma_write(dest, self.dma_read(src, length))
+    def fill_memory(self, dest: int, value: int, length: int) -> None:
+        self.dma_write(dest, bytes((value & 0xFF,)) * length)
+
+    # Devices
+    def attach_device(self, device: type[IODevice], port: int | None = None, **options) -> IODevice:
+        """Create a device with device(cpu, **options) and put it on port, or on the device's own port, or on the lowest free one."""
+        if port is None:
+            port = device.port
+        if port is None:
+            if None not in self.ports:
+                raise ValueError("Every port is taken")
+            port = self.ports.index(None)
+        if not (0 <= port < PORT_COUNT):
+            raise IndexError(f"Port {port} is out of range. Valid range is 0 to {PORT_COUNT - 1}.")
+        if self.ports[port] is not None:
+            raise ValueError(f"Port {port} is already taken by {type(self.ports[port]).__name__}")
+
+        instance = device(self, **options)
+        instance.port = port
+        self.ports[port] = instance
+        self.devices.append(instance)
+        return instance
+    def detach_device(self, port: int) -> IODevice:
+        device = self.ports[port]
+        if device is None:
+            raise ValueError(f"No device on port {port}")
+        self.ports[port] = None
+        self.devices.remove(device)
+        return device
+
     # Stack
     def push_stack(self, value: int):
-        self.stack.append(value)
+        sp = self.sp - STACK_WORD
+        if sp < self.stack_base:
+            raise IndexError(f"Stack overflow, the stack holds {(self.stack_top - self.stack_base) // STACK_WORD} entries")
+        if self.memory_map.read_only and self.memory_map.is_read_only(sp, sp + STACK_WORD):
+            raise IndexError(f"Stack address {sp} is read-only")
+        STACK_ENTRY.pack_into(self.memory, sp, value & 0xFFFFFFFF)
+        self.sp = sp
     def pop_stack(self) -> int:
-        return self.stack.pop()
-    def pop_stack_into_register(self, into_register: str):
+        sp = self.sp
+        if sp >= self.stack_top:
+            raise IndexError("Stack underflow, pop from an empty stack")
+        self.sp = sp + STACK_WORD
+        return STACK_ENTRY.unpack_from(self.memory, sp)[0]
+    def pop_stack_into_register(self, into_register: str | int):
         self.set_register(into_register, self.pop_stack())
 
     # Random
     def step_random(self) -> int:
-        return self._step_random()
+        return self.rng.next()
     def set_random(self, seed: int):
-        self._set_seed(seed)
+        """Seed the LCG from outside the guest, SEED instructions seed it directly."""
+        self.rng.seed(seed)
+        if self.recorder is not None:
+            self.recorder.event(replay.SEED, replay.SEED_VALUE.pack(seed))
 
     # Debug commands
     def set_stack(self, index: int, value: int) -> None:
-        if index < len(self.stack):
-            self.stack[-(index + 1)] = value
-        else:
+        addr = self.sp + index * STACK_WORD
+        if not (0 <= index and addr < self.stack_top):
             raise IndexError("Stack index out of range")
+        if self.memory_map.read_only and self.memory_map.is_read_only(addr, addr + STACK_WORD):
+            raise IndexError(f"Stack address {addr} is read-only")
+        STACK_ENTRY.pack_into(self.memory, addr, value & 0xFFFFFFFF)
     def get_stack(self) -> list[int]:
-        return self.stack
+        # bottom of the stack first, like a list you append to
+        return [STACK_ENTRY.unpack_from(self.memory, addr)[0] for addr in range(self.stack_top - STACK_WORD, self.sp - 1, -STACK_WORD)]
+    @property
+    def stack(self) -> list[int]:
+        return self.get_stack()
     def set_pc(self, value: int) -> None:
         self.pc = value
+        self._stopped_at = None
     def halt(self, message: str) -> None:
         self.halted = True
-        self.traceback(message)
-        self.stop()
+        self._interrupted = True
+        if self.verbose:
+            self.traceback(message)
+    def pause(self) -> None:
+        self.paused = True
+        self._interrupted = True
+    def interrupt(self) -> None:
+        """Make the current run() return EXIT_INTERRUPTED after the instruction being executed."""
+        self._interrupt_requested = True
+        self._interrupted = True
+    def resume(self) -> None:
+        # the instruction we're paused at runs even if it has a breakpoint
+        self._stopped_at = self.pc if self.paused else None
+        self.paused = False
+        self.stop_reason = None
+        self.clock.reset()
+    def step(self, count: int = 1) -> str:
+        """Execute count instructions and pause again, unless a breakpoint or HLT stops it first."""
+        self._stopped_at = self.pc
+        self.paused = False
+        self.stop_reason = None
+        reason = self.run(count)
+        if not self.paused and not self.halted:
+            self.paused = True
+            self.stop_reason = (STOP_STEP, self.pc, 0)
+        return reason
     def traceback(self, message: str) -> None:
         print("TRACEBACK:")
         print(f"Program Counter (PC): 0x{self.pc:04X}")
         print("Registers:")
-        for reg, value in self.registers.items():
+        for reg, value in self.get_registers().items():
             print(f"  {reg}: 0x{value:02X}")
         print("Stack:")
-        for i, value in enumerate(reversed(self.stack)):
+        for i, value in enumerate(reversed(self.get_stack())):
             print(f"  {i}: 0x{value:02X}")
         print("Memory (showing 16 bytes around PC):")
         start = max(0, self.pc - 8)
@@ -196,217 +613,743 @@ class CPU:
                 print()
             print(f"  0x{addr:04X}: 0x{self.memory[addr]:02X}", end="\n")
         print()
+        if self.tracer is not None and self.tracer.recorded:
+            print(f"Trace (last {min(self.trace_on_halt, self.tracer.recorded, self.tracer.size)} instructions, oldest first):")
+            print(self.tracer.format(self.memory, self.trace_on_halt, self.rom_base, self.wide_addresses))
         print(f"Message: {message}")
 
-    def cycle(self) -> None:
-        if self.halted or self.paused:
-            return
-        
-        if self.pc-0x1000 >= self.rom_size:
-            return self.halt(f"Program Counter has exceeded the ROM size {self.pc=} {self.rom_size=}")
-        instruction = self.fetch()
-
-        if instruction == 0x00: # NOP
-            pass
-        elif instruction == 0x01: # MOV R, IMM
-            self.set_register(self.fetch_register(), self.fetch_immediate())
-        elif instruction == 0x02: # ADD R1, R2
-            R1 = self.fetch_register()
-            self.set_register(R1, self.get_register(R1) + self.get_register(self.fetch_register()))
-        elif instruction == 0x03: # SUB R1, R2
-            R1 = self.fetch_register()
-            self.set_register(R1, self.get_register(R1) - self.get_register(self.fetch_register()))
-        elif instruction == 0x04: # LOAD R, ADDR
-            self.set_register(self.fetch_register(), self.get_memory(self.fetch_addr()))
-        elif instruction == 0x05: # STORE ADDR, R
-            self.set_memory(self.fetch_addr(), self.get_register(self.fetch_register()))
-        elif instruction == 0x06: # JMP ADDR
-            self.pc = 0x1000 + self.fetch_addr()
-        elif instruction == 0x07: # CALL ADDR
-            return_address = self.pc + 3
-            self.push_stack(return_address)
-            self.pc = 0x1000 + self.fetch_addr()
-        elif instruction == 0x08: # RET
-            self.pc = self.pop_stack()
-        elif instruction == 0x09: # PUSH R
-            self.push_stack(self.get_register(self.fetch_register()))
-        elif instruction == 0x0A: # POP R
-            self.pop_stack_into_register(self.fetch_register())
-        elif instruction == 0x0B: # JZ R1, ADDR
-            if self.get_register(self.fetch_register()) == 0:
-                self.pc = 0x1000 + self.fetch_addr()
-        elif instruction == 0x0C: # JNZ R1, ADDR
-            if self.get_register(self.fetch_register()) != 0:
-                self.pc = 0x1000 + self.fetch_addr()
-        elif instruction == 0x0D: # JG R1, ADDR
-            if self.get_register(self.fetch_register()) > 0:
-                self.pc = 0x1000 + self.fetch_addr()
-        elif instruction == 0x0E: # JL R1, ADDR
-            if self.get_register(self.fetch_register()) < 0:
-                self.pc = 0x1000 + self.fetch_addr()
-        elif instruction == 0x0F: # JEQ R1, R2
-            reg1 = self.fetch_register()
-            reg2 = self.fetch_register()
-            if self.get_register(reg1) == self.get_register(reg2):
-                self.pc = 0x1000 + self.fetch_addr()
-        elif instruction == 0x10: # JNE R1, R2
-            reg1 = self.fetch_register()
-            reg2 = self.fetch_register()
-            if self.get_register(reg1) != self.get_register(reg2):
-                self.pc = 0x1000 + self.fetch_addr()
-        # TODO seperate display into an IO device
-        elif instruction == 0x11: # DRW R1, R2, R3
-            self.draw_pixel(self.get_register(self.fetch_register()), self.get_register(self.fetch_register()), self.get_register(self.fetch_register()))
-        elif instruction == 0x12: # CLR
-            self.clear_display()
-        elif instruction == 0x13: # RENDER
-            self.display  = self.display2
-            self.display2 = bytearray(DISPLAY_WIDTH*DISPLAY_HEIGHT)
-        
-        # TODO change the opcodes of these 2
-        elif instruction == 0x14: # DIV R1, R2
-            R1 = self.fetch_register()
-            reg2 = self.fetch_register()
-            self.set_register(R1, int(self.get_register(R1) / self.get_register(reg2)))
-        elif instruction == 0x15: # MUL R1, R2
-            R1 = self.fetch_register()
-            reg2 = self.fetch_register()
-            self.set_register(R1, int(self.get_register(R1) * self.get_register(reg2)))
-        
-        # TODO change the opcode of this
-        elif instruction == 0x16: # RECT R1, R2, R3, R4, R5
-            self.draw_rectangle(self.get_register(self.fetch_register()), self.get_register(self.fetch_register()), self.get_register(self.fetch_register()), self.get_register(self.fetch_register()), self.get_register(self.fetch_register()))
-        
-        # TODO seperate random into an IO device
-        elif instruction == 0x17: # RND R1
-            self.set_register(self.fetch_register(), self.step_random())
-        elif instruction == 0x18: # SEED INT
-            self.set_random(self.fetch_int())
-        elif instruction == 0x19: # RNDMAP R1, IMM, IMM
-            R1 = self.fetch_register()
-            self.set_register(R1, int(map_to_range(
-                self.get_register(R1),
-                self.fetch_immediate(),
-                self.fetch_immediate()
-            )))
-        # IN 0x1A
-        # OUT 0x1B
-        elif instruction == 0xFF: # HLT
-            self.halt("HLT by program")
+    # Breakpoints
+    def add_breakpoint(self, pc: int, register: str | int | None = None, comparison: str = "==", value: int = 0) -> None:
+        """Pause before the instruction at pc, only when the register compares true against value if one is given."""
+        if register is None:
+            condition = None
+        else:
+            if comparison not in COMPARISONS:
+                raise ValueError(f"Unknown comparison: {comparison}")
+            condition = (self.register_index(register), comparison, value)
+        self.breakpoints.setdefault(pc, []).append(condition)
+        self._redecode(pc)
+    def remove_breakpoint(self, pc: int) -> None:
+        if self.breakpoints.pop(pc, None) is None:
+            raise ValueError(f"No breakpoint at 0x{pc:04X}")
+        self._redecode(pc)
+    def add_watchpoint(self, start: int, end: int, read: bool = False, write: bool = True) -> None:
+        """Pause before an instruction reads or writes memory in [start, end)."""
+        if not (0 <= start < end <= len(self.memory)):
+            raise IndexError(f"Watchpoint 0x{start:04X}-0x{end:04X} is out of bounds")
+        if not (read or write):
+            raise ValueError("A watchpoint has to watch reads, writes or both")
+        self.watchpoints.append((start, end, read, write))
+        self._redecode()
+    def remove_watchpoint(self, start: int, end: int) -> None:
+        remaining = [watch for watch in self.watchpoints if watch[:2] != (start, end)]
+        if len(remaining) == len(self.watchpoints):
+            raise ValueError(f"No watchpoint at 0x{start:04X}-0x{end:04X}")
+        self.watchpoints = remaining
+        self._redecode()
+
+    def _redecode(self, pc: int | None = None) -> None:
+        # decoding again puts traps where they're needed and takes them out elsewhere
+        if pc is None:
+            self._decoded.clear()
+            self._trapped.clear()
+        else:
+            self._decoded.pop(pc, None)
+            self._trapped.pop(pc, None)
+
+    def _accesses(self, entry: tuple) -> list[tuple[int, int, bool]]:
+        """The memory an instruction is about to access as (address, length, write) ranges."""
+        handler, operands, _ = entry
+        if handler == self._op_load:
+            return [(operands[1], 1, False)]
+        if handler == self._op_str:
+            return [(operands[0], 1, True)]
+        if handler == self._op_push or handler == self._op_call:
+            return [(self.sp - STACK_WORD, STACK_WORD, True)]
+        if handler == self._op_pop or handler == self._op_ret or handler == self._op_iret:
+            return [(self.sp, STACK_WORD, False)]
+        registers = self.registers
+        if handler == self._op_memcpy:
+            dest, src, length = (registers[reg] for reg in operands)
+            return [(src, length, False), (dest, length, True)]
+        if handler == self._op_memset:
+            return [(registers[operands[0]], registers[operands[2]], True)]
+        if handler == self._op_blit:
+            return [(registers[operands[4]], registers[operands[2]] * registers[operands[3]], False)]
+        return []
+    def _watch_hit(self, address: int, length: int, write: bool) -> bool:
+        for start, end, read_watched, write_watched in self.watchpoints:
+            if address < end and start < address + length and (write_watched if write else read_watched):
+                return True
+        return False
+
+    def _needs_trap(self, pc: int, entry: tuple) -> bool:
+        if pc in self.breakpoints:
+            return True
+        handler = entry[0]
+        if handler == self._op_load or handler == self._op_str:
+            return self._watch_hit(*self._accesses(entry)[0])
+        if handler in (self._op_memcpy, self._op_memset, self._op_blit):
+            # the ranges are in registers, look at them when the instruction is about to run
+            return True
+        if handler in (self._op_push, self._op_pop, self._op_call, self._op_ret, self._op_iret):
+            # the stack pointer moves, trap if any watchpoint could be on the stack
+            stack_size = self.stack_top - self.stack_base
+            return self._watch_hit(self.stack_base, stack_size, True) or self._watch_hit(self.stack_base, stack_size, False)
+        return False
+
+    def _trap(self, pc: int) -> bool:
+        entry, runnable = self._trapped[pc]
+        if self._stopped_at == pc:
+            # continuing from this trap
+            self._stopped_at = None
+        else:
+            reason, address = None, 0
+            for condition in self.breakpoints.get(pc, ()):
+                if condition is None or COMPARISONS[condition[1]](self.registers[condition[0]], condition[2]):
+                    reason = STOP_BREAKPOINT
+                    break
+            if reason is None and self.watchpoints:
+                for access in self._accesses(entry):
+                    if self._watch_hit(*access):
+                        reason, address = STOP_WATCH_WRITE if access[2] else STOP_WATCH_READ, access[0]
+                        break
+            if reason is not None:
+                self.stop_reason = (reason, pc, address)
+                self._stopped_at = pc
+                self.pause()
+                self.instructions_executed -= 1 # run() counts the trap, but the instruction didn't run
+                return True
+
+        handler, operands, self.pc = runnable
+        handler(*operands)
+        return False
+
+    # Profiling
+    def enable_profiler(self) -> Profiler:
+        """Start collecting per-opcode and per-PC statistics, see profiler.py."""
+        if self.profiler is None:
+            self.profiler = Profiler(self)
+            self._redecode()
+        return self.profiler
+    def disable_profiler(self) -> Profiler | None:
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            self._redecode()
+        return profiler
+
+    # Record/replay
+    def start_recording(self, filename: str) -> replay.Recorder:
+        """Log the current state and every change from outside from now on, see replay.py."""
+        if self.recorder is not None:
+            raise ValueError("Already recording")
+        # the starting snapshot can't hold device work in flight, replay would never see it submitted
+        for sequence in sorted(self._io_operations):
+            self.complete_io(sequence)
+        self.recorder = replay.Recorder(self, filename)
+        return self.recorder
+    def stop_recording(self) -> None:
+        if self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            recorder.close()
+    @property
+    def replaying(self) -> bool:
+        return self.replay_inputs is not None
+    def external_input(self, read) -> bytes:
+        """Bytes a device takes from outside the machine, read() is only called when not replaying."""
+        if self.replaying:
+            if not self.replay_inputs:
+                raise IndexError("The recording has no more device input")
+            return self.replay_inputs.popleft()
+        data = read()
+        if self.recorder is not None:
+            self.recorder.event(replay.INPUT, data)
+        return data
+
+    # Interrupts
+    def raise_interrupt(self, line: int) -> None:
+        """Mark an interrupt line pending, on the CPU thread (a device's _in/_out or completion)."""
+        if not (0 <= line < INTERRUPT_LINES):
+            raise IndexError(f"Interrupt line {line} is out of range. Valid range is 0 to {INTERRUPT_LINES - 1}.")
+        self.interrupt_pending |= 1 << line
+        self._interrupted = True
+    def _take_interrupt(self) -> None:
+        pending = self.interrupt_pending
+        line = (pending & -pending).bit_length() - 1 # lowest line first
+        self.interrupt_pending = pending & ~(1 << line)
+        self.interrupt_line = line
+        self.interrupts_enabled = False
+        self.push_stack(self.pc)
+        self.pc = self.interrupt_vector
+
+    # Asynchronous devices
+    def run_async(self, device: IODevice, work, complete=None) -> Future:
+        """Run work() on the I/O threads and let the CPU keep executing.
+
+        When it finishes, complete(result) runs on the CPU thread at the next batch
+        boundary and the device's interrupt line is raised. Exceptions raised by
+        work come out of run() at that point.
+        """
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(IO_WORKERS, thread_name_prefix="io")
+        sequence = self._io_sequence
+        self._io_sequence += 1
+        future = self._io_pool.submit(work)
+        self._io_operations[sequence] = (device, future, complete)
+        future.add_done_callback(lambda done: self._io_done(sequence, done))
+        return future
+    def _io_done(self, sequence: int, future: Future) -> None:
+        # on an I/O thread
+        self._completions.append((sequence, future))
+        self._interrupted = True
+    def _complete_io(self) -> None:
+        if self.replaying:
+            return # replay delivers completions at their recorded instruction counts
+        while self._completions:
+            sequence, future = self._completions.popleft()
+            operation = self._io_operations.get(sequence)
+            # work dropped by a restore can finish after its number was handed out again
+            if operation is not None and operation[1] is future:
+                self.complete_io(sequence)
+    def complete_io(self, sequence: int) -> None:
+        """Deliver a submitted operation, waiting for it if it's still running."""
+        device, future, complete = self._io_operations.pop(sequence)
+        if self.recorder is not None:
+            self.recorder.event(replay.COMPLETE, replay.SEQUENCE.pack(sequence))
+        result = future.result()
+        if complete is not None:
+            complete(result)
+        if device.interrupt is not None:
+            self.raise_interrupt(device.interrupt)
+
+    # Tracing
+    def enable_tracer(self, size: int = 4096) -> TraceRecorder:
+        """Keep the last size executed instructions in a ring buffer, see tracer.py."""
+        self.tracer = TraceRecorder(size, self.registers.typecode)
+        return self.tracer
+    def disable_tracer(self) -> TraceRecorder | None:
+        tracer, self.tracer = self.tracer, None
+        return tracer
+
+    def _interpreter_only(self) -> bool:
+        # compiled blocks skip the traps and profiling wrappers in _decoded
+        return bool(self.breakpoints or self.watchpoints or self.profiler)
+
+    # Decode
+    def _decode(self, pc: int) -> tuple:
+        if not (self.rom_base <= pc < self.rom_base + self.rom_size):
+            # not cached, the ROM can grow when it's reloaded
+            return (self.halt, (f"Program Counter has exceeded the ROM size self.pc={pc} self.rom_size={self.rom_size}",), pc)
+
+        opcode = self.memory[pc]
+        instruction = isa.BY_OPCODE[opcode]
+        handler = self._handlers[opcode]
+        if handler is None:
+            entry = (self.halt, (f"Unknown instruction! instruction={opcode}",), pc + 1)
+        else:
+            operand_struct, size = instruction.encoding(self.wide_addresses)
+            if pc + size > len(self.memory):
+                raise IndexError("Read beyond memory bounds")
+
+            operands = []
+            for kind, value in zip(instruction.operands, operand_struct.unpack_from(self.memory, pc + 1)):
+                if kind == isa.JUMP:
+                    value += self.rom_base
+                operands.append(value)
+            entry = (handler, tuple(operands), pc + size)
+
+        runnable = entry if self.profiler is None else self.profiler.wrap(pc, entry)
+        if (self.breakpoints or self.watchpoints) and self._needs_trap(pc, entry):
+            self._trapped[pc] = (entry, runnable)
+            runnable = (self._trap, (pc,), pc)
+        entry = runnable
+        self._decoded[pc] = entry
+        return entry
+    def _invalidate(self, start: int, end: int) -> None:
+        self._blocks.invalidate(start, end)
+
+        # an instruction that starts up to MAX_INSTRUCTION_SIZE - 1 bytes before the write can overlap it
+        start = max(start - self._max_instruction_size + 1, self.rom_base)
+        end = min(end, self.rom_base + self.rom_size)
+        decoded = self._decoded
+        if end - start > len(decoded):
+            # a big write, e.g. a whole new ROM through SET_MEMORY, has fewer decoded instructions in it than addresses
+            for pc in [pc for pc in decoded if start <= pc < end]:
+                del decoded[pc]
+        else:
+            for pc in range(start, end):
+                decoded.pop(pc, None)
+
+    # Instructions
+    def _op_nop(self) -> None:
+        pass
+    def _op_mov(self, R1: int, imm: int) -> None:
+        self.registers[R1] = imm & self.word_mask
+    def _op_add(self, R1: int, R2: int) -> None:
+        registers = self.registers
+        registers[R1] = (registers[R1] + registers[R2]) & self.word_mask
+    def _op_sub(self, R1: int, R2: int) -> None:
+        registers = self.registers
+        registers[R1] = (registers[R1] - registers[R2]) & self.word_mask
+    def _op_load(self, R1: int, addr: int) -> None:
+        self.registers[R1] = self.get_memory(addr)
+    def _op_str(self, addr: int, R1: int) -> None:
+        self.set_memory(addr, self.registers[R1])
+    def _op_jmp(self, addr: int) -> None:
+        self.pc = addr
+    def _op_call(self, addr: int) -> None:
+        self.push_stack(self.pc)
+        self.pc = addr
+    def _op_ret(self) -> None:
+        self.pc = self.pop_stack()
+    def _op_push(self, R1: int) -> None:
+        self.push_stack(self.registers[R1])
+    def _op_pop(self, R1: int) -> None:
+        self.registers[R1] = self.pop_stack() & self.word_mask
+    def _op_jz(self, R1: int, addr: int) -> None:
+        if self.registers[R1] == 0:
+            self.pc = addr
+    def _op_jnz(self, R1: int, addr: int) -> None:
+        if self.registers[R1] != 0:
+            self.pc = addr
+    def _op_jg(self, R1: int, addr: int) -> None:
+        if 0 < self.registers[R1] < self.sign_bit:
+            self.pc = addr
+    def _op_jl(self, R1: int, addr: int) -> None:
+        if self.registers[R1] >= self.sign_bit:
+            self.pc = addr
+    def _op_jeq(self, R1: int, R2: int, addr: int) -> None:
+        if self.registers[R1] == self.registers[R2]:
+            self.pc = addr
+    def _op_jne(self, R1: int, R2: int, addr: int) -> None:
+        if self.registers[R1] != self.registers[R2]:
+            self.pc = addr
+    # TODO seperate display into an IO device
+    def _op_drw(self, R1: int, R2: int, R3: int) -> None:
+        registers = self.registers
+        self.draw_pixel(registers[R1], registers[R2], registers[R3])
+    def _op_clr(self) -> None:
+        self.clear_display()
+    def _op_render(self) -> None:
+        self.render()
+    # TODO change the opcodes of these 2
+    def _op_div(self, R1: int, R2: int) -> None:
+        registers = self.registers
+        registers[R1] = self.divide(registers[R1], registers[R2])
+    def _op_mul(self, R1: int, R2: int) -> None:
+        registers = self.registers
+        registers[R1] = (registers[R1] * registers[R2]) & self.word_mask
+    # TODO change the opcode of this
+    def _op_rect(self, R1: int, R2: int, R3: int, R4: int, R5: int) -> None:
+        registers = self.registers
+        self.draw_rectangle(registers[R1], registers[R2], registers[R3], registers[R4], registers[R5])
+    # TODO seperate random into an IO device
+    def _op_rnd(self, R1: int) -> None:
+        self.registers[R1] = self.step_random() & self.word_mask
+    def _op_seed(self, seed: int) -> None:
+        self.rng.seed(seed)
+    def _op_rndmap(self, R1: int, min_val: int, max_val: int) -> None:
+        registers = self.registers
+        registers[R1] = map_to_range_int(registers[R1], min_val, max_val) & self.word_mask
+    def _op_in(self, port: int, addr: int) -> None:
+        device = self.ports[port]
+        if device is None:
+            self.halt(f"IN from port {port}, no device is attached to it")
         else:
-            self.halt(f"Unknown instruction! {instruction=}")
+            device._in(addr)
+    def _op_out(self, port: int, addr: int) -> None:
+        device = self.ports[port]
+        if device is None:
+            self.halt(f"OUT to port {port}, no device is attached to it")
+        else:
+            device._out(addr)
+    def _op_ivec(self, addr: int) -> None:
+        self.interrupt_vector = addr
+    def _op_ei(self) -> None:
+        self.interrupts_enabled = True
+        if self.interrupt_pending:
+            self._interrupted = True
+    def _op_di(self) -> None:
+        self.interrupts_enabled = False
+    def _op_iret(self) -> None:
+        self.pc = self.pop_stack()
+        self._op_ei()
+    def _op_iack(self, R1: int) -> None:
+        self.registers[R1] = self.interrupt_line
+    def _op_djnz(self, R1: int, addr: int) -> None:
+        registers = self.registers
+        registers[R1] = value = (registers[R1] - 1) & self.word_mask
+        if value != 0:
+            self.pc = addr
+    def _op_jeqi(self, R1: int, imm: int, addr: int) -> None:
+        if self.registers[R1] == imm & self.word_mask:
+            self.pc = addr
+    def _op_jnei(self, R1: int, imm: int, addr: int) -> None:
+        if self.registers[R1] != imm & self.word_mask:
+            self.pc = addr
+    def _op_memcpy(self, R1: int, R2: int, R3: int) -> None:
+        registers = self.registers
+        self.copy_memory(registers[R1], registers[R2], registers[R3])
+    def _op_memset(self, R1: int, R2: int, R3: int) -> None:
+        registers = self.registers
+        self.fill_memory(registers[R1], registers[R2], registers[R3])
+    def _op_blit(self, R1: int, R2: int, R3: int, R4: int, R5: int) -> None:
+        registers = self.registers
+        self.draw_sprite(registers[R1], registers[R2], registers[R3], registers[R4], registers[R5])
+    def _op_hlt(self) -> None:
+        self.halt("HLT by program")
+
+    def cycle(self) -> None:
+        self.run(1)
+
+    def run(self, max_instructions: int, until=None) -> str:
+        """Execute up to max_instructions and return why execution stopped (one of the EXIT_* reasons).
+
+        Flags, IPS accounting and throttling are only looked at between batches of
+        batch_size instructions. until is an optional predicate taking the CPU, checked
+        after every instruction. Debug requests are answered, finished device work is
+        delivered and pending interrupts are taken between batches too.
+        """
+        with self._execution_lock:
+            reason = self._run(max_instructions, until)
+        # a request queued while the last batch was finishing
+        if self._debug_requests:
+            self.process_debug_requests()
+        return reason
+    def _run(self, max_instructions: int, until) -> str:
+        remaining = max_instructions
+        while True:
+            if self._debug_requests:
+                self._answer_debug_requests()
+            if self.halted:
+                return EXIT_HALTED
+            if self.stop_requested:
+                return EXIT_STOPPED
+            if self.paused:
+                return EXIT_PAUSED
+            if self._interrupt_requested:
+                self._interrupt_requested = False
+                return EXIT_INTERRUPTED
+            if remaining <= 0:
+                return EXIT_BUDGET
+            if self._completions:
+                self._complete_io()
+            if self.interrupt_pending and self.interrupts_enabled and self.interrupt_vector:
+                self._take_interrupt()
+
+            budget = min(remaining, self.clock.timeslice() or self.batch_size)
+
+            self._interrupted = False
+            self._restored = False
+            try:
+                if until is not None:
+                    executed, matched = self._run_until(budget, until)
+                elif self.backend == "blocks" and not self._interpreter_only():
+                    executed, matched = self._run_blocks(budget), False
+                elif self.tracer is not None:
+                    executed, matched = self._run_traced(budget), False
+                else:
+                    executed, matched = self._run_interpreter(budget), False
+            finally:
+                self._batch_executed = 0
+
+            remaining -= executed
+            if not self._restored:
+                # a restore during the batch took the count from the snapshot, and ended the batch
+                self.instructions_executed += executed
+            self.print_ips()
+            self.clock.throttle(executed)
 
-        self.instructions_executed += 1
-        self.print_ips()
+            if matched:
+                return EXIT_UNTIL
+    def run_until(self, address: int, max_instructions: int) -> str:
+        return self.run(max_instructions, until=lambda cpu: cpu.pc == address)
 
-        if self.ips_limit != float('inf'):
-            elapsed_time = time.time() - self.start_time
-            expected_time = self.instructions_executed / self.ips_limit
-            if elapsed_time < expected_time:
-                time.sleep(expected_time - elapsed_time)
+    def _run_interpreter(self, budget: int, executed: int = 0) -> int:
+        """Run until executed reaches budget, _run_blocks passes how far into the batch it is."""
+        decoded = self._decoded
+        decode = self._decode
+        while executed < budget:
+            try:
+                handler, operands, self.pc = decoded[self.pc]
+            except KeyError:
+                # not decoded yet, or outside the ROM and _decode halts on it
+                handler, operands, self.pc = decode(self.pc)
+            # counted before it runs, events it causes happen after it in the count
+            executed += 1
+            self._batch_executed = executed
+            handler(*operands)
+            if self._interrupted:
+                break
+        return executed
+    def _run_traced(self, budget: int, executed: int = 0) -> int:
+        """_run_interpreter that also records every instruction into the trace ring, see TraceRecorder.record."""
+        decoded = self._decoded
+        decode = self._decode
+        registers = self.registers
+        tracer = self.tracer
+        ring = tracer.ring
+        snapshots = tracer.registers
+        size = tracer.size
+        interval = REGISTER_INTERVAL
+        position = tracer.position
+        first = executed
+        trapped = 0
+        try:
+            while executed < budget:
+                pc = self.pc
+                try:
+                    handler, operands, self.pc = decoded[pc]
+                except KeyError:
+                    handler, operands, self.pc = decode(pc)
+                self._batch_executed = executed + 1
+                if handler(*operands):
+                    # only _trap returns anything, it paused before the instruction ran
+                    executed += 1
+                    trapped = 1
+                    break
+                executed += 1
+                ring[position] = pc
+                position += 1
+                if not position % interval:
+                    start = (position // interval - 1) * REGISTER_COUNT
+                    snapshots[start:start + REGISTER_COUNT] = registers
+                    if position == size:
+                        position = 0
+                if self._interrupted:
+                    break
+        finally:
+            # keep what was recorded when an instruction raises
+            tracer.position = position
+            tracer.recorded += executed - first - trapped
+        return executed
+    def _run_blocks(self, budget: int) -> int:
+        lookup = self._blocks.lookup
+        registers = self.registers
+        tracer = self.tracer
+        step = self._run_interpreter if tracer is None else self._run_traced
+        executed = 0
+        while executed < budget:
+            pc = self.pc
+            block = lookup(pc)
+            if block is None or block.count > budget - executed:
+                # not compilable, or it would overshoot the budget
+                executed = step(executed + 1, executed)
+            else:
+                # only a block's last instruction can call out of it, see blocks.CALLOUTS
+                self._batch_executed = executed + block.count
+                count = block.function(self, registers)
+                executed += count
+                if tracer is not None:
+                    tracer.record(pc, count, registers)
+            if self._interrupted:
+                break
+        return executed
+    def _run_until(self, budget: int, until) -> tuple[int, bool]:
+        decoded = self._decoded
+        decode = self._decode
+        executed = 0
+        while executed < budget:
+            try:
+                handler, operands, self.pc = decoded[self.pc]
+            except KeyError:
+                handler, operands, self.pc = decode(self.pc)
+            executed += 1
+            self._batch_executed = executed
+            handler(*operands)
+            if until(self):
+                return executed, True
+            if self._interrupted:
+                break
+        return executed, False
+
+    @property
+    def instruction_count(self) -> int:
+        """Instructions executed so far, including the one running and the rest of run()'s current batch."""
+        return self.instructions_executed + self._batch_executed
+
+    @property
+    def ips_limit(self) -> float:
+        return self.clock.frequency
+    @ips_limit.setter
+    def ips_limit(self, value: float) -> None:
+        self.clock.frequency = value
+
+    def log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
 
     def print_ips(self) -> None:
-        elapsed_time = time.time() - self.start_time
+        if not self.verbose:
+            return
+        elapsed_time = time.perf_counter() - self.start_time
         if elapsed_time >= 1.0:
-            ips = self.instructions_executed / elapsed_time
+            ips = (self.instructions_executed - self._ips_mark) / elapsed_time
             print(f"Instructions Per Second: {ips:.2f}")
-            self.start_time = time.time()
-            self.instructions_executed = 0
+            self.start_time = time.perf_counter()
+            self._ips_mark = self.instructions_executed
 
-    def debug_server(self) -> None:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(("localhost", 12345))
-        server_socket.listen(1)
-        server_socket.setblocking(False)
-        print("Debug server started on port 12345")
+    def start_debug_server(self, host: str = "localhost", port: int = 12345, path: str | None = None) -> DebugServer:
+        """Serve the debug protocol on host:port, or on a Unix socket at path."""
+        if self.debug_server is not None:
+            raise ValueError(f"The debug server is already running on {self.debug_server.address}")
+        self.debug_server = DebugServer(self, host, port, path)
+        try:
+            self.debug_server.start()
+        except BaseException:
+            self.debug_server = None
+            raise
+        return self.debug_server
+
+    def submit_debug_request(self, message: memoryview, process: bool = True) -> Future:
+        """Queue a request from another thread, the future gets the encoded response.
 
-        while not self.stop_requested:
+        The CPU answers it at its next batch boundary, or right away if it isn't
+        running, unless process is False, then it's left for process_debug_requests.
+        """
+        future = Future()
+        self._debug_requests.append((message, future))
+        self._interrupted = True
+        if process:
+            self.process_debug_requests()
+        return future
+    def process_debug_requests(self) -> None:
+        """Answer queued requests unless run() is executing, which answers them itself."""
+        if self._execution_lock.acquire(blocking=False):
             try:
-                client_socket, _ = server_socket.accept()
-                with client_socket:
-                    while not self.stop_requested:
-                        try:
-                            data = client_socket.recv(2048)
-                            if not data:
-                                break
-                            command = pickle.loads(data)
-                            self.handle_debug_command(command, client_socket)
-                        except EOFError:
-                            break
-                        except Exception as e:
-                            print(f"Error while handling command: {e}")
-            except OSError:
-                if not self.stop_requested:
-                    time.sleep(0.5)
-
-        server_socket.close()
-        print("Debug server stopped.")
-
-    def handle_debug_command(self, command, client_socket) -> None:
-        cmd_type = command["type"]
-        response = {}
-        
+                self._answer_debug_requests()
+            finally:
+                self._execution_lock.release()
+    def _answer_debug_requests(self) -> None:
+        requests = self._debug_requests
+        while requests:
+            message, future = requests.popleft()
+            future.set_result(self.handle_debug_request(message))
+
+    def handle_debug_request(self, message: memoryview) -> bytes:
+        """Answer one request message, returns the encoded response."""
+        if len(message) < protocol.REQUEST.size:
+            return protocol.encode_response(0, protocol.ERROR, b"Truncated request")
+        request_id, command = protocol.REQUEST.unpack_from(message, 0)
+        status, result = self._debug_command(command, message[protocol.REQUEST.size:])
+        return protocol.encode_response(request_id, status, result)
+
+    def _debug_command(self, command: int, arguments: memoryview) -> tuple[int, bytes]:
         try:
-            if cmd_type == "GET_REGISTERS":
-                response["data"] = self.registers
-            elif cmd_type == "SET_REGISTER":
-                reg = command["register"]
-                value = command["value"]
-                self.set_register(reg, value)
-            elif cmd_type == "GET_MEMORY":
-                addr = command["address"]
-                response["data"] = self.get_memory(addr)
-            elif cmd_type == "SET_MEMORY":
-                addr = command["address"]
-                value = command["value"]
-                self.set_memory(addr, value)
-            elif cmd_type == "GET_STACK":
-                response["data"] = self.get_stack()
-            elif cmd_type == "SET_STACK":
-                index = command["index"]
-                value = command["value"]
-                self.set_stack(index, value)
-            elif cmd_type == "PC":
-                response["data"] = self.pc
-            elif cmd_type == "SET_PC":
-                value = command["value"]
-                self.set_pc(value)
-            elif cmd_type == "PAUSE":
-                response["data"] = "OK"
-                self.paused = True
-            elif cmd_type == "RESUME":
-                response["data"] = "OK"
-                self.paused = False
-            elif cmd_type == "HALT":
-                message = command.get("message", "Remote Debugger requested HLT")
-                response["data"] = "OK"
-                self.halt(message)
+            if command == protocol.GET_REGISTERS:
+                result = struct.pack(f"<{REGISTER_COUNT}I", *self.registers)
+            elif command == protocol.SET_REGISTER:
+                register, value = protocol.REGISTER_VALUE.unpack(arguments)
+                self.set_register(register, value)
+                result = b""
+            elif command == protocol.GET_MEMORY:
+                result = bytes(self.dma_read(*protocol.MEMORY_RANGE.unpack(arguments)))
+            elif command == protocol.SET_MEMORY:
+                (addr,) = protocol.U32.unpack_from(arguments, 0)
+                self.set_memory(addr, bytes(arguments[protocol.U32.size:]))
+                result = b""
+            elif command == protocol.LOAD_ROM:
+                self.load_rom_bytes(bytes(arguments))
+                result = b""
+            elif command == protocol.GET_STACK:
+                stack = self.get_stack()
+                result = struct.pack(f"<{len(stack)}I", *stack)
+            elif command == protocol.SET_STACK:
+                self.set_stack(*protocol.STACK_VALUE.unpack(arguments))
+                result = b""
+            elif command == protocol.GET_PC:
+                result = protocol.U32.pack(self.pc)
+            elif command == protocol.SET_PC:
+                self.set_pc(*protocol.U32.unpack(arguments))
+                result = b""
+            elif command == protocol.PAUSE:
+                self.pause()
+                result = b""
+            elif command == protocol.RESUME:
+                self.resume()
+                result = b""
+            elif command == protocol.HALT:
+                self.halt(bytes(arguments).decode() or "Remote Debugger requested HLT")
+                result = b""
+            elif command == protocol.GET_FRAMEBUFFER:
+                framebuffer = self.framebuffer
+                result = protocol.FRAME_SIZE.pack(framebuffer.width, framebuffer.height) + framebuffer.front.tobytes()
+            elif command == protocol.SET_BREAKPOINT:
+                pc, register, comparison, value = protocol.BREAKPOINT.unpack(arguments)
+                if register == protocol.NO_REGISTER:
+                    self.add_breakpoint(pc)
+                else:
+                    self.add_breakpoint(pc, register, protocol.COMPARISONS[comparison], value)
+                result = b""
+            elif command == protocol.CLEAR_BREAKPOINT:
+                self.remove_breakpoint(*protocol.U32.unpack(arguments))
+                result = b""
+            elif command == protocol.SET_WATCHPOINT:
+                start, end, flags = protocol.WATCHPOINT.unpack(arguments)
+                self.add_watchpoint(start, end, bool(flags & protocol.WATCH_READ), bool(flags & protocol.WATCH_WRITE))
+                result = b""
+            elif command == protocol.CLEAR_WATCHPOINT:
+                self.remove_watchpoint(*protocol.MEMORY_RANGE.unpack(arguments))
+                result = b""
+            elif command == protocol.STEP:
+                self.step(*protocol.U32.unpack(arguments))
+                result = protocol.U32.pack(self.pc)
+            elif command == protocol.GET_STOP_REASON:
+                reason, pc, address = self.stop_reason or (None, self.pc, 0)
+                result = protocol.STOP.pack(protocol.STOP_REASONS.index(reason), pc, address)
+            elif command == protocol.GET_TRACE:
+                if self.tracer is None:
+                    raise ValueError("Tracing is off")
+                result = self.tracer.raw(self.rom_base, self.wide_addresses)
+            elif command == protocol.BATCH:
+                result = protocol.encode_batch_results([self._debug_command(sub_command, sub_arguments) for sub_command, sub_arguments in protocol.decode_batch(arguments)])
             else:
-                response["error"] = "Unknown command"
-        except BaseException as e:
-            response["error"] = str(e)
-
-        client_socket.sendall(pickle.dumps(response))
+                raise ValueError(f"Unknown command {command}")
+        except Exception as e:
+            return protocol.ERROR, str(e).encode()
+        if self.recorder is not None and command in replay.DEBUG_WRITES:
+            self.recorder.event(command, bytes(arguments))
+        return protocol.OK, result
 
     def stop(self):
         self.stop_requested = True
-        self.debug_server_thread.join()
+        self._interrupted = True
+        if self.debug_server is not None:
+            self.debug_server.stop()
+            self.debug_server = None
+        if self._io_pool is not None:
+            self._io_pool.shutdown(wait=False, cancel_futures=True)
+            self._io_pool = None
+        self.stop_recording()
 
 def main():
+    import argparse
     from cpuio.test import TestDevice
 
+    parser = argparse.ArgumentParser(description="Run test.rom with the debug server")
+    parser.add_argument("--trace", type=int, default=0, metavar="N", help="keep the last N executed instructions for the debugger, off by default since it slows the CPU down")
+    args = parser.parse_args()
+
     cpu = CPU("test.rom", [TestDevice])#, ips_limit=1000)
+    if args.trace:
+        cpu.enable_tracer(args.trace)
+    cpu.start_debug_server()
 
     try:
-        while not cpu.halted:
-            cpu.cycle()
+        try:
+            while not cpu.halted:
+                if cpu.run(100000) == EXIT_PAUSED:
+                    time.sleep(0.01)
+        except Exception as e:
+            cpu.halt(str(e))
+            print(f"Exception: {e}")
+        # a halted guest stays inspectable while a debugger is attached
+        if cpu.debug_server.attached:
+            print("CPU halted, the debug server stays up until the debugger disconnects (Ctrl-C to quit)")
+            cpu.debug_server.wait_detached()
     except KeyboardInterrupt:
         print("Interrupt received. Stopping CPU...")
-        cpu.stop()
-    except Exception as e:
-        cpu.halt(str(e))
-        print(f"Exception: {e}")
-        cpu.stop()
+    cpu.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,110 @@
+"""Run one ROM many times in parallel, e.g. once per seed to fuzz a program.
+
+Every worker process gets the ROM (and the shared starting snapshot) once when
+it starts and builds a single CPU from it. Each run restores that CPU to its
+starting state, seeds the LCG and runs it for its instruction budget, so a
+worker never re-reads the ROM or rebuilds a CPU between runs.
+"""
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from emulator import CPU, IODevice
+from memorymap import MemoryMap
+
+class Job:
+    def __init__(self, seed: int, instructions: int, snapshot: bytes | None = None) -> None:
+        self.seed = seed
+        self.instructions = instructions
+        self.snapshot = snapshot # starts from this state instead of the fleet's
+
+    def __repr__(self) -> str:
+        return f"Job(seed={self.seed}, instructions={self.instructions}{', snapshot' if self.snapshot else ''})"
+
+# State of the current worker process, set up once by _start_worker
+_cpu: CPU | None = None
+_start_state: bytes | None = None
+
+def _start_worker(rom: bytes, devices: list[type[IODevice]], backend: str, snapshot: bytes | None, memory_map: MemoryMap | None) -> None:
+    global _cpu, _start_state
+    _cpu = CPU(rom, devices, backend=backend, debug_port=None, verbose=False, memory_map=memory_map)
+    if snapshot is not None:
+        _cpu.restore(snapshot)
+    _start_state = bytes(_cpu.snapshot())
+
+def digest(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def _run_job(job: Job) -> dict:
+    cpu = _cpu
+    cpu.restore(job.snapshot if job.snapshot is not None else _start_state)
+    cpu.set_random(job.seed)
+    before = cpu.instructions_executed
+    reason = cpu.run(job.instructions)
+
+    return {
+        "seed": job.seed,
+        "reason": reason,
+        "instructions": cpu.instructions_executed - before,
+        "pc": cpu.pc,
+        "registers": cpu.get_registers(),
+        "memory": digest(cpu.memory),
+        "framebuffer": digest(cpu.framebuffer.front),
+    }
+
+def run_fleet(rom: str | bytes, jobs: list[Job], devices: list[type[IODevice]] = [], snapshot: bytes | None = None,
+              workers: int | None = None, backend: str = "interpreter", memory_map: MemoryMap | None = None) -> list[dict]:
+    """Run every job on its own copy of the machine, results come back in job order.
+
+    rom is a filename or the ROM itself, snapshot is the state every job starts
+    from unless the job brings its own.
+    """
+    if isinstance(rom, str):
+        with open(rom, "rb") as f:
+            rom = f.read()
+    workers = workers or os.cpu_count() or 1
+    # a few chunks per worker keeps them all busy without a round trip per run
+    chunksize = max(1, len(jobs) // (workers * 4))
+
+    with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(bytes(rom), devices, backend, snapshot, memory_map)) as pool:
+        return list(pool.map(_run_job, jobs, chunksize=chunksize))
+
+def fuzz(rom: str | bytes, seeds, instructions: int, **kwargs) -> list[dict]:
+    """run_fleet with one job per seed, all with the same budget."""
+    return run_fleet(rom, [Job(seed, instructions) for seed in seeds], **kwargs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a ROM once per seed across a process pool")
+    parser.add_argument("rom")
+    parser.add_argument("--seeds", type=int, default=100, metavar="N", help="run seeds 0 to N-1")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--instructions", type=int, required=True, help="instruction budget of every run")
+    parser.add_argument("--workers", type=int, help="worker processes, defaults to the number of cores")
+    parser.add_argument("--snapshot", help="save state every run starts from")
+    parser.add_argument("--backend", choices=["interpreter", "blocks"], default="interpreter")
+    parser.add_argument("--json", metavar="FILE", help="write all results to FILE")
+    args = parser.parse_args()
+
+    snapshot = None
+    if args.snapshot:
+        with open(args.snapshot, "rb") as f:
+            snapshot = f.read()
+
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    results = fuzz(args.rom, seeds, args.instructions, snapshot=snapshot, workers=args.workers, backend=args.backend)
+
+    outcomes: dict[tuple[str, str], list[int]] = {}
+    for result in results:
+        outcomes.setdefault((result["reason"], result["framebuffer"]), []).append(result["seed"])
+    print(f"{len(results)} runs, {len(outcomes)} distinct outcomes")
+    for (reason, framebuffer), outcome_seeds in sorted(outcomes.items(), key=lambda item: -len(item[1])):
+        print(f"  {len(outcome_seeds):5d}x {reason:<11} framebuffer {framebuffer[:16]}  seeds {outcome_seeds[:8]}{' ...' if len(outcome_seeds) > 8 else ''}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
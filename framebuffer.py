@@ -0,0 +1,315 @@
+import threading
+from array import array
+
+DISPLAY_WIDTH  = 256
+DISPLAY_HEIGHT = 256
+
+PALETTE = [
+    (0, 0, 0),       # 00: Black
+    (29, 43, 83),    # 01: Dark Blue
+    (126, 37, 83),   # 02: Purple
+    (0, 135, 81),    # 03: Green
+    (171, 82, 54),   # 04: Brown
+    (95, 87, 79),    # 05: Dark Gray
+    (194, 195, 199), # 06: Light Gray
+    (255, 241, 232), # 07: White
+    (255, 0, 77),    # 08: Red
+    (255, 163, 0),   # 09: Orange
+    (255, 236, 39),  # 10: Yellow
+    (0, 228, 54),    # 11: Light Green
+    (41, 173, 255),  # 12: Light Blue
+    (131, 118, 156), # 13: Light Purple
+    (255, 119, 168), # 14: Pink
+    (255, 204, 170)  # 15: Peach
+]
+
+def palette_lut(palette: list[tuple[int, int, int]] = PALETTE, fallback: int = 15) -> bytes:
+    """RGB triplets for all 256 pixel values, values past the palette use the fallback colour."""
+    return bytes(channel for index in range(256) for channel in palette[index if index < len(palette) else fallback])
+
+Rect = tuple[int, int, int, int] # x, y, x_end, y_end
+
+def union(a: Rect | None, b: Rect | None) -> Rect | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def _same(a: memoryview, b: memoryview) -> bool:
+    """a == b without copying either, compared 8 bytes at a time, which is several times faster than byte by byte."""
+    words = len(a) // 8 * 8
+    return a[:words].cast("Q") == b[:words].cast("Q") and a[words:] == b[words:]
+
+# Header slots, int64 each, shared with the consumer when the framebuffer lives in shared memory
+_BACK     = 0 # buffer the CPU draws into
+_READY    = 1 # latest published frame, not picked up yet while _FRESH is set
+_FRONT    = 2 # buffer the consumer is presenting
+_FRESH    = 3
+_SEQUENCE = 4 # published frames
+_CLOSED   = 5 # the producer is done, no more frames will come
+_BOUNDS   = 8 # x, y, x_end, y_end for each buffer, x_end == 0 when the buffer is blank
+HEADER_SIZE = (_BOUNDS + 3 * 4) * 8
+
+class Framebuffer:
+    """Triple buffered indexed-colour display.
+
+    The CPU draws into the back buffer and RENDER publishes it (swap), the
+    frontend picks up the latest published frame with acquire. Publishing and
+    acquiring only exchange buffer indices under a lock, so neither side copies
+    pixels and the frame a consumer holds is never written to while it has it.
+    Pixels are stored row-major, index = y * width + x.
+
+    Each buffer remembers the bounding box of what was drawn into it on a blank
+    background, which keeps clears small and tells consumers which region of the
+    screen changed.
+
+    All three buffers and the indices live in one block of memory, pass buffer
+    (and a multiprocessing lock) to put that block in shared memory, see
+    create_shared and attach_shared.
+    """
+
+    def __init__(self, width: int = DISPLAY_WIDTH, height: int = DISPLAY_HEIGHT, buffer=None, lock=None, initialize: bool | None = None) -> None:
+        self.width = width
+        self.height = height
+        self.size = width * height
+
+        if initialize is None:
+            initialize = buffer is None
+        if buffer is None:
+            buffer = bytearray(HEADER_SIZE + 3 * self.size)
+        # the views keep the memory from being resized and make slice assignment about twice as fast
+        self._memory = memoryview(buffer).cast("B")
+        if len(self._memory) < HEADER_SIZE + 3 * self.size:
+            raise ValueError(f"Framebuffer memory is {len(self._memory)} bytes, expected {HEADER_SIZE + 3 * self.size}")
+        self._state = self._memory[:HEADER_SIZE].cast("q")
+        self._views = [self._memory[HEADER_SIZE + i * self.size:HEADER_SIZE + (i + 1) * self.size] for i in range(3)]
+        self._blank = memoryview(bytes(self.size))
+        self._lock = threading.Lock() if lock is None else lock
+
+        if initialize:
+            self._state[_BACK], self._state[_READY], self._state[_FRONT] = 0, 1, 2
+        self._back_view = self._views[self._state[_BACK]]
+        self.back_bounds: list[int] | None = self._get_bounds(self._state[_BACK])
+
+        self.frames = 0 # RENDERs, including ones that didn't change anything
+        self._shown_bounds: Rect | None = None
+        self._shown_all = False
+
+    # Shared memory
+    @classmethod
+    def create_shared(cls, width: int = DISPLAY_WIDTH, height: int = DISPLAY_HEIGHT):
+        """Create a framebuffer in a new shared memory block, returns (framebuffer, shared_memory, lock)."""
+        from multiprocessing import Lock, shared_memory
+
+        size = HEADER_SIZE + 3 * width * height
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        lock = Lock()
+        return cls(width, height, shm.buf, lock, initialize=True), shm, lock
+    @classmethod
+    def attach_shared(cls, name: str, lock, width: int = DISPLAY_WIDTH, height: int = DISPLAY_HEIGHT):
+        """Open a framebuffer made by create_shared in another process, returns (framebuffer, shared_memory)."""
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(width, height, shm.buf, lock), shm
+    def release(self) -> None:
+        """Drop the views into the memory so a SharedMemory block can be closed.
+
+        Frames returned by acquire must not be used (or referenced) anymore.
+        """
+        self._back_view = None
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._state.release()
+        self._memory.release()
+
+    # Save states
+    @property
+    def state_size(self) -> int:
+        return HEADER_SIZE + 3 * self.size
+    def save(self, into) -> None:
+        """Copy the indices, bounds and all three buffers into a writable buffer of state_size bytes."""
+        with self._lock:
+            self._set_bounds(self._state[_BACK], self.back_bounds)
+            memoryview(into).cast("B")[:] = self._memory[:self.state_size]
+    def restore(self, data) -> None:
+        """Go back to a state written by save, consumers get the whole screen again on their next acquire."""
+        data = memoryview(data).cast("B")
+        if len(data) != self.state_size:
+            raise ValueError(f"Framebuffer state is {len(data)} bytes, expected {self.state_size}")
+        with self._lock:
+            self._memory[:self.state_size] = data
+            self._back_view = self._views[self._state[_BACK]]
+            self.back_bounds = self._get_bounds(self._state[_BACK])
+        self._shown_bounds = None
+        self._shown_all = False
+
+    # Buffers
+    @property
+    def back(self) -> memoryview:
+        return self._back_view
+    @property
+    def front(self) -> memoryview:
+        """The latest published frame."""
+        with self._lock:
+            return self._views[self._state[_READY] if self._state[_FRESH] else self._state[_FRONT]]
+    @property
+    def generation(self) -> int:
+        return self._state[_SEQUENCE]
+    @property
+    def closed(self) -> bool:
+        return bool(self._state[_CLOSED])
+    def close(self) -> None:
+        """Tell consumers that no more frames will be published."""
+        self._state[_CLOSED] = 1
+
+    def _get_bounds(self, index: int) -> list[int] | None:
+        slot = _BOUNDS + index * 4
+        if self._state[slot + 2] == 0:
+            return None
+        return list(self._state[slot:slot + 4])
+    def _set_bounds(self, index: int, bounds: list[int] | None) -> None:
+        slot = _BOUNDS + index * 4
+        self._state[slot:slot + 4] = memoryview(bytes(32)).cast("q") if bounds is None else memoryview(array("q", bounds))
+
+    # Producer
+    def swap(self) -> bool:
+        """Publish the back buffer and start the next frame blank, returns False if the frame didn't change."""
+        self.frames += 1
+        state = self._state
+        with self._lock:
+            back = state[_BACK]
+            latest = state[_READY] if state[_FRESH] else state[_FRONT]
+            latest_bounds = self._get_bounds(latest)
+            region = union(self.back_bounds and tuple(self.back_bounds), latest_bounds and tuple(latest_bounds))
+            changed = False
+            if region is not None:
+                start, end = region[1] * self.width, region[3] * self.width
+                changed = not _same(self._back_view[start:end], self._views[latest][start:end])
+            if changed:
+                self._set_bounds(back, self.back_bounds)
+                # a frame that was never picked up is dropped, its buffer is reused for drawing
+                state[_BACK], state[_READY] = state[_READY], back
+                state[_FRESH] = 1
+                state[_SEQUENCE] += 1
+                self._back_view = self._views[state[_BACK]]
+                self.back_bounds = self._get_bounds(state[_BACK])
+        self.clear()
+        return changed
+
+    def clear(self) -> None:
+        bounds = self.back_bounds
+        if bounds is not None:
+            # clear whole rows, one contiguous run
+            start, end = bounds[1] * self.width, bounds[3] * self.width
+            self._back_view[start:end] = self._blank[:end - start]
+            self.back_bounds = None
+
+    # Consumer
+    def acquire(self) -> tuple[memoryview, Rect | None]:
+        """Pick up the latest published frame.
+
+        Returns the frame and the region that changed since the previous acquire,
+        None if nothing was published in between. The frame stays untouched until
+        the next acquire.
+        """
+        state = self._state
+        with self._lock:
+            if state[_FRESH]:
+                state[_READY], state[_FRONT] = state[_FRONT], state[_READY]
+                state[_FRESH] = 0
+                bounds = self._get_bounds(state[_FRONT])
+                bounds = bounds and tuple(bounds)
+                dirty = union(self._shown_bounds, bounds)
+                self._shown_bounds = bounds
+            else:
+                dirty = None
+            frame = self._views[state[_FRONT]]
+
+        if not self._shown_all:
+            # the consumer starts without any of the screen
+            self._shown_all = True
+            dirty = (0, 0, self.width, self.height)
+        return frame, dirty
+
+    # Drawing
+    def _touch(self, x: int, y: int, x_end: int, y_end: int) -> None:
+        bounds = self.back_bounds
+        if bounds is None:
+            self.back_bounds = [x, y, x_end, y_end]
+            return
+        if x < bounds[0]:
+            bounds[0] = x
+        if y < bounds[1]:
+            bounds[1] = y
+        if x_end > bounds[2]:
+            bounds[2] = x_end
+        if y_end > bounds[3]:
+            bounds[3] = y_end
+
+    def _clip(self, x: int, y: int, width: int, height: int) -> tuple[int, int, int, int] | None:
+        x_end = min(x + width, self.width)
+        y_end = min(y + height, self.height)
+        x = max(x, 0)
+        y = max(y, 0)
+        if x >= x_end or y >= y_end:
+            return None
+        return x, y, x_end, y_end
+
+    def plot(self, x: int, y: int, color: int) -> None:
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self._back_view[y * self.width + x] = min(color, 255)
+            self._touch(x, y, x + 1, y + 1)
+
+    def fill_rect(self, x: int, y: int, width: int, height: int, color: int) -> None:
+        clipped = self._clip(x, y, width, height)
+        if clipped is None:
+            return
+        x, y, x_end, y_end = clipped
+        self._touch(x, y, x_end, y_end)
+        color = min(color, 255)
+        stride = self.width
+        back = self._back_view
+
+        if x == 0 and x_end == stride:
+            # full rows are one contiguous run
+            back[y * stride:y_end * stride] = bytes((color,)) * ((y_end - y) * stride)
+            return
+        run = x_end - x
+        row = bytes((color,)) * run
+        for start in range(y * stride + x, y_end * stride, stride):
+            back[start:start + run] = row
+
+    def blit(self, x: int, y: int, width: int, height: int, source, offset: int = 0, source_stride: int | None = None) -> None:
+        """Copy a width x height block of pixels from source (any buffer), starting at offset."""
+        source_stride = width if source_stride is None else source_stride
+        clipped = self._clip(x, y, width, height)
+        if clipped is None:
+            return
+        cx, cy, x_end, y_end = clipped
+        offset += (cy - y) * source_stride + (cx - x)
+        run = x_end - cx
+
+        source = memoryview(source).cast("B")
+        if offset < 0 or offset + (y_end - cy - 1) * source_stride + run > len(source):
+            raise IndexError("Blit reads beyond the end of the source buffer")
+        self._touch(cx, cy, x_end, y_end)
+        back = self._back_view
+        stride = self.width
+        if cx == 0 and run == stride and source_stride == stride:
+            back[cy * stride:y_end * stride] = source[offset:offset + (y_end - cy) * stride]
+            return
+        for start in range(cy * stride + cx, y_end * stride, stride):
+            back[start:start + run] = source[offset:offset + run]
+            offset += source_stride
+
+    def load(self, frame) -> None:
+        """Replace the whole back buffer with a frame of the same size."""
+        frame = memoryview(frame).cast("B")
+        if len(frame) != self.size:
+            raise ValueError(f"Frame is {len(frame)} bytes, expected {self.size}")
+        self._back_view[:] = frame
+        self.back_bounds = [0, 0, self.width, self.height]
@@ -0,0 +1,227 @@
+"""Run a ROM without a window and capture its frames to disk.
+
+Frames go to a capture file, either raw (one indexed frame after the other,
+read back through mmap) or delta (only the region that changed since the
+previous frame, zlib compressed). PNGs can be exported from a capture with
+the palette from framebuffer.py. Nothing here imports pygame.
+"""
+import os
+import mmap
+import zlib
+import struct
+import argparse
+
+from emulator import CPU, EXIT_HALTED
+from framebuffer import DISPLAY_WIDTH, DISPLAY_HEIGHT, PALETTE, palette_lut
+
+MAGIC = b"ECFR"
+VERSION = 1
+FORMAT_RAW   = 0
+FORMAT_DELTA = 1
+FORMATS = {"raw": FORMAT_RAW, "delta": FORMAT_DELTA}
+
+HEADER = struct.Struct("<4sHBBHH")     # magic, version, format, reserved, width, height
+DELTA_RECORD = struct.Struct("<HHHHI") # x, y, x_end, y_end, compressed size; x_end == 0 means the frame didn't change
+
+class FrameWriter:
+    def __init__(self, filename: str, format: str = "delta", width: int = DISPLAY_WIDTH, height: int = DISPLAY_HEIGHT) -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Unknown capture format: {format}")
+        self.format = FORMATS[format]
+        self.width = width
+        self.height = height
+        self.frames = 0
+        self.file = open(filename, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.format, 0, width, height))
+
+    def write(self, frame, dirty: tuple[int, int, int, int] | None) -> None:
+        """Append a frame, dirty is the region that changed since the previous one."""
+        self.frames += 1
+        if self.format == FORMAT_RAW:
+            self.file.write(frame)
+            return
+
+        if dirty is None:
+            self.file.write(DELTA_RECORD.pack(0, 0, 0, 0, 0))
+            return
+        x, y, x_end, y_end = dirty
+        frame = memoryview(frame)
+        rows = b"".join(frame[row * self.width + x:row * self.width + x_end] for row in range(y, y_end))
+        data = zlib.compress(rows, 1)
+        self.file.write(DELTA_RECORD.pack(x, y, x_end, y_end, len(data)))
+        self.file.write(data)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+class FrameReader:
+    """Reads a capture file, raw captures are indexed through mmap without copying."""
+
+    def __init__(self, filename: str) -> None:
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.format, _, self.width, self.height = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a frame capture")
+        if version != VERSION:
+            raise ValueError(f"Unsupported capture version {version}")
+        self.frame_size = self.width * self.height
+
+        if self.format == FORMAT_RAW:
+            self.frames = (len(self.map) - HEADER.size) // self.frame_size
+        else:
+            self.frames = sum(1 for _ in self._records())
+
+    def _records(self):
+        offset = HEADER.size
+        while offset < len(self.map):
+            record = DELTA_RECORD.unpack_from(self.map, offset)
+            offset += DELTA_RECORD.size
+            yield record, offset
+            offset += record[4]
+
+    def __len__(self) -> int:
+        return self.frames
+
+    def __iter__(self):
+        if self.format == FORMAT_RAW:
+            for i in range(self.frames):
+                yield self[i]
+            return
+
+        frame = bytearray(self.frame_size)
+        for (x, y, x_end, y_end, size), offset in self._records():
+            if x_end:
+                rows = zlib.decompress(self.map[offset:offset + size])
+                run = x_end - x
+                for i, row in enumerate(range(y, y_end)):
+                    frame[row * self.width + x:row * self.width + x_end] = rows[i * run:(i + 1) * run]
+            yield bytes(frame)
+
+    def __getitem__(self, index: int):
+        if not (0 <= index < self.frames):
+            raise IndexError(f"Frame {index} out of range, the capture has {self.frames} frames")
+        if self.format == FORMAT_RAW:
+            start = HEADER.size + index * self.frame_size
+            return memoryview(self.map)[start:start + self.frame_size]
+        for i, frame in enumerate(self):
+            if i == index:
+                return frame
+
+    def close(self) -> None:
+        """Views returned for raw captures have to be released before closing."""
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def write_png(filename: str, frame, width: int = DISPLAY_WIDTH, height: int = DISPLAY_HEIGHT, palette: list[tuple[int, int, int]] = PALETTE) -> None:
+    """Write an indexed frame as a paletted PNG."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    frame = memoryview(frame)
+    # filter type 0 in front of every row
+    rows = b"".join(b"\x00" + frame[y * width:(y + 1) * width] for y in range(height))
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)))
+        f.write(chunk(b"PLTE", palette_lut(palette)))
+        f.write(chunk(b"IDAT", zlib.compress(rows)))
+        f.write(chunk(b"IEND", b""))
+
+def export_pngs(capture_filename: str, directory: str, every: int = 1, palette: list[tuple[int, int, int]] = PALETTE) -> int:
+    """Write every n-th frame of a capture to directory/frame_00000.png, returns how many were written."""
+    os.makedirs(directory, exist_ok=True)
+    written = 0
+    with FrameReader(capture_filename) as reader:
+        for i, frame in enumerate(reader):
+            if i % every == 0:
+                write_png(os.path.join(directory, f"frame_{i:05d}.png"), frame, reader.width, reader.height, palette)
+                written += 1
+            if isinstance(frame, memoryview):
+                frame.release()
+    return written
+
+def run_headless(rom_filename: str, output: str | None = None, instructions: int | None = None, frames: int | None = None,
+                 format: str = "delta", backend: str = "interpreter") -> dict:
+    """Run a ROM for a number of instructions and/or RENDERs, capturing every rendered frame to output.
+
+    Stops at whichever limit comes first, or when the program halts.
+    """
+    if instructions is None and frames is None:
+        raise ValueError("Give an instruction budget, a frame count or both")
+
+    cpu = CPU(rom_filename, [], backend=backend, debug_port=None, verbose=False)
+    writer = FrameWriter(output, format, cpu.framebuffer.width, cpu.framebuffer.height) if output else None
+    rendered = 0
+
+    def on_render(cpu: CPU) -> None:
+        nonlocal rendered
+        if frames is not None and rendered >= frames:
+            return # a block can render again before run() returns
+        rendered += 1
+        if writer is not None:
+            writer.write(*cpu.framebuffer.acquire())
+        if frames is not None and rendered >= frames:
+            cpu.interrupt()
+
+    cpu.on_render = on_render
+    executed = 0
+    try:
+        reason = EXIT_HALTED
+        while not cpu.halted:
+            budget = 1_000_000 if instructions is None else min(1_000_000, instructions - executed)
+            if budget <= 0:
+                break
+            before = cpu.instructions_executed
+            reason = cpu.run(budget)
+            executed += cpu.instructions_executed - before
+            if frames is not None and rendered >= frames:
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+        if not cpu.halted:
+            cpu.stop()
+
+    return {
+        "reason": reason,
+        "instructions": executed,
+        "frames": rendered,
+        "pc": cpu.pc,
+        "registers": cpu.get_registers(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a ROM headless and capture its frames")
+    parser.add_argument("rom")
+    parser.add_argument("--instructions", type=int, help="stop after this many instructions")
+    parser.add_argument("--frames", type=int, help="stop after this many RENDERs")
+    parser.add_argument("--out", help="capture file to write the frames to")
+    parser.add_argument("--format", choices=list(FORMATS), default="delta")
+    parser.add_argument("--backend", choices=["interpreter", "blocks"], default="interpreter")
+    parser.add_argument("--png", metavar="DIR", help="export the captured frames as PNGs into DIR at the end")
+    parser.add_argument("--png-every", type=int, default=1, metavar="N", help="only export every N-th frame")
+    args = parser.parse_args()
+
+    if args.png and not args.out:
+        parser.error("--png needs a capture file, pass --out")
+    if args.instructions is None and args.frames is None:
+        parser.error("pass --instructions, --frames or both")
+
+    result = run_headless(args.rom, args.out, args.instructions, args.frames, args.format, args.backend)
+    print(f"{result['reason']}: {result['instructions']} instructions, {result['frames']} frames")
+    if args.png:
+        print(f"Wrote {export_pngs(args.out, args.png, args.png_every)} PNGs to {args.png}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import struct
+
+ROM_BASE = 0x1000
+
+# The stack lives at the top of RAM, right below the ROM, and grows down
+STACK_TOP  = ROM_BASE
+STACK_SIZE = 64 # entries
+STACK_WORD = 4  # bytes per entry
+STACK_BASE = STACK_TOP - STACK_SIZE * STACK_WORD
+
+REGISTER_COUNT = 8
+
+# Operand kinds
+REG  = "r" # 1 byte register number
+IMM  = "i" # 2 byte immediate
+ADDR = "a" # 2 byte absolute memory address
+JUMP = "j" # 2 byte jump target, relative to ROM_BASE
+INT  = "d" # 4 byte integer
+
+OPERAND_FORMATS = {REG: "B", IMM: "H", ADDR: "H", JUMP: "H", INT: "I"}
+# addresses and jump targets are 4 bytes on CPUs with wide addresses, see memorymap.py
+WIDE_OPERAND_FORMATS = {**OPERAND_FORMATS, ADDR: "I", JUMP: "I"}
+
+class Instruction:
+    def __init__(self, opcode: int, mnemonic: str, operands: str) -> None:
+        self.opcode = opcode
+        self.mnemonic = mnemonic
+        self.operands = operands
+        self.struct = struct.Struct("<" + "".join(OPERAND_FORMATS[kind] for kind in operands))
+        self.size = 1 + self.struct.size
+        self.wide_struct = struct.Struct("<" + "".join(WIDE_OPERAND_FORMATS[kind] for kind in operands))
+        self.wide_size = 1 + self.wide_struct.size
+
+    def encoding(self, wide_addresses: bool = False) -> tuple[struct.Struct, int]:
+        """The operand struct and the instruction size."""
+        return (self.wide_struct, self.wide_size) if wide_addresses else (self.struct, self.size)
+
+    def __repr__(self) -> str:
+        return f"Instruction(0x{self.opcode:02X}, {self.mnemonic!r}, {self.operands!r})"
+
+INSTRUCTIONS = [
+    Instruction(0x00, "NOP",    ""),
+    Instruction(0x01, "MOV",    "ri"),    # MOV R, IMM
+    Instruction(0x02, "ADD",    "rr"),    # ADD R1, R2
+    Instruction(0x03, "SUB",    "rr"),    # SUB R1, R2
+    Instruction(0x04, "LOAD",   "ra"),    # LOAD R, ADDR
+    Instruction(0x05, "STR",    "ar"),    # STR ADDR, R
+    Instruction(0x06, "JMP",    "j"),     # JMP LABEL
+    Instruction(0x07, "CALL",   "j"),     # CALL LABEL
+    Instruction(0x08, "RET",    ""),
+    Instruction(0x09, "PUSH",   "r"),     # PUSH R
+    Instruction(0x0A, "POP",    "r"),     # POP R
+    Instruction(0x0B, "JZ",     "rj"),    # JZ R, LABEL
+    Instruction(0x0C, "JNZ",    "rj"),    # JNZ R, LABEL
+    Instruction(0x0D, "JG",     "rj"),    # JG R, LABEL
+    Instruction(0x0E, "JL",     "rj"),    # JL R, LABEL
+    Instruction(0x0F, "JEQ",    "rrj"),   # JEQ R1, R2, LABEL
+    Instruction(0x10, "JNE",    "rrj"),   # JNE R1, R2, LABEL
+    Instruction(0x11, "DRW",    "rrr"),   # DRW X, Y, COLOR
+    Instruction(0x12, "CLR",    ""),
+    Instruction(0x13, "RENDER", ""),
+    Instruction(0x14, "DIV",    "rr"),    # DIV R1, R2
+    Instruction(0x15, "MUL",    "rr"),    # MUL R1, R2
+    Instruction(0x16, "RECT",   "rrrrr"), # RECT X, Y, W, H, COLOR
+    Instruction(0x17, "RND",    "r"),     # RND R
+    Instruction(0x18, "SEED",   "d"),     # SEED INT
+    Instruction(0x19, "RNDMAP", "rii"),   # RNDMAP R, MIN, MAX
+    Instruction(0x1A, "IN",     "ia"),    # IN PORT, ADDR
+    Instruction(0x1B, "OUT",    "ia"),    # OUT PORT, ADDR
+    Instruction(0x1C, "IVEC",   "j"),     # IVEC LABEL, where interrupts go
+    Instruction(0x1D, "EI",     ""),      # enable interrupts
+    Instruction(0x1E, "DI",     ""),      # disable interrupts
+    Instruction(0x1F, "IRET",   ""),      # return from an interrupt and enable them again
+    Instruction(0x20, "IACK",   "r"),     # IACK R, the interrupt line being served
+    # fused loops and bulk memory, each replaces a run of the instructions above
+    Instruction(0x21, "DJNZ",   "rj"),    # DJNZ R, LABEL: R -= 1, jump unless R is now 0
+    Instruction(0x22, "JEQI",   "rij"),   # JEQI R, IMM, LABEL: jump if R holds what MOV R, IMM would put in it
+    Instruction(0x23, "JNEI",   "rij"),   # JNEI R, IMM, LABEL
+    Instruction(0x24, "MEMCPY", "rrr"),   # MEMCPY DEST, SRC, LENGTH: overlapping ranges copy like memmove
+    Instruction(0x25, "MEMSET", "rrr"),   # MEMSET DEST, VALUE, LENGTH: the low byte of VALUE
+    Instruction(0x26, "BLIT",   "rrrrr"), # BLIT X, Y, W, H, ADDR: draw the W x H pixels at ADDR, row by row, clipped like RECT
+    Instruction(0xFF, "HLT",    ""),
+]
+
+BY_OPCODE: list[Instruction | None] = [None] * 256
+BY_MNEMONIC: dict[str, Instruction] = {}
+for _instruction in INSTRUCTIONS:
+    BY_OPCODE[_instruction.opcode] = _instruction
+    BY_MNEMONIC[_instruction.mnemonic] = _instruction
+
+MAX_INSTRUCTION_SIZE = max(instruction.size for instruction in INSTRUCTIONS)
+MAX_WIDE_INSTRUCTION_SIZE = max(instruction.wide_size for instruction in INSTRUCTIONS)
@@ -1,79 +1,149 @@
 import pygame
 import numpy as np
-from emulator import CPU
+from emulator import CPU, EXIT_PAUSED
+from clock import FrameClock
+import argparse
+import multiprocessing
 import threading
+import time
 
 from cpuio.test import TestDevice
-
-DISPLAY_WIDTH = 256
-DISPLAY_HEIGHT = 256
-
-PALETTE = [
-    (0, 0, 0),       # 00: Black
-    (29, 43, 83),    # 01: Dark Blue
-    (126, 37, 83),   # 02: Purple
-    (0, 135, 81),    # 03: Green
-    (171, 82, 54),   # 04: Brown
-    (95, 87, 79),    # 05: Dark Gray
-    (194, 195, 199), # 06: Light Gray
-    (255, 241, 232), # 07: White
-    (255, 0, 77),    # 08: Red
-    (255, 163, 0),   # 09: Orange
-    (255, 236, 39),  # 10: Yellow
-    (0, 228, 54),    # 11: Light Green
-    (41, 173, 255),  # 12: Light Blue
-    (131, 118, 156), # 13: Light Purple
-    (255, 119, 168), # 14: Pink
-    (255, 204, 170)  # 15: Peach
-]
+from framebuffer import Framebuffer, DISPLAY_WIDTH, DISPLAY_HEIGHT, PALETTE, palette_lut
+
+def start_debug_server(cpu: CPU, debug: tuple[int, str | None] | None) -> None:
+    if debug is not None:
+        port, path = debug
+        cpu.start_debug_server(port=port, path=path)
+
+def cpu_process(rom_filename: str, shm_name: str, lock, stop_event, debug: tuple[int, str | None] | None = None, trace: int = 0,
+                record: str | None = None) -> None:
+    """Runs the CPU in its own process, drawing into the shared framebuffer."""
+    framebuffer, shm = Framebuffer.attach_shared(shm_name, lock)
+    cpu = CPU(rom_filename, [TestDevice], framebuffer=framebuffer)
+    if trace:
+        cpu.enable_tracer(trace)
+    if record:
+        cpu.start_recording(record)
+    start_debug_server(cpu, debug)
+    try:
+        while not cpu.halted and not stop_event.is_set():
+            if cpu.run(100000) == EXIT_PAUSED:
+                time.sleep(0.01)
+    finally:
+        if not cpu.halted:
+            cpu.halt("Window exit")
+        cpu.stop()
+        framebuffer.close()
+        framebuffer.release()
+        shm.close()
 
 class Main:
-    def __init__(self):
+    def __init__(self, instructions_per_frame: int | None = None, process: bool = False, debug: tuple[int, str | None] | None = (12345, None),
+                 trace: int = 0, record: str | None = None):
+        # debug is the (port, unix socket path) of the debug server, None to run without one
+        # trace is how many executed instructions to keep for tracebacks and the debugger, 0 for none, tracing costs about a third of the speed
+        # record is a file to log the run to for replay.py
+        if process and instructions_per_frame:
+            raise ValueError("Frame-locked mode runs the CPU on the render thread, it can't be used with a CPU process")
+
         pygame.init()
         self.screen = pygame.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT))
         pygame.display.set_caption("Emulator")
 
-        self.cpu = CPU("test.rom", [TestDevice])
-
         self.clock = pygame.time.Clock()
         self.running = True
 
         self.surface = pygame.Surface((DISPLAY_WIDTH, DISPLAY_HEIGHT))
-        self.palette_array = np.array(PALETTE, dtype=np.uint8)
-
-        self.cpu_thread = threading.Thread(target=self.cpu_cycle_thread, daemon=True)
-        self.cpu_thread.start()
+        # out of palette values are clamped to the last colour by the table itself
+        self.palette_lut = np.frombuffer(palette_lut(PALETTE), dtype=np.uint8).reshape((256, 3))
+
+        # frame-locked runs a fixed number of instructions per frame on this thread instead
+        self.frame_clock = FrameClock(instructions_per_frame) if instructions_per_frame else None
+        self.cpu = None
+        self.cpu_thread = None
+        self.cpu_process = None
+
+        if process:
+            # the CPU gets its own interpreter, frames come through shared memory
+            self.framebuffer, self.shm, lock = Framebuffer.create_shared()
+            self.stop_event = multiprocessing.Event()
+            self.cpu_process = multiprocessing.Process(target=cpu_process, args=("test.rom", self.shm.name, lock, self.stop_event, debug, trace, record), daemon=True)
+            self.cpu_process.start()
+        else:
+            self.cpu = CPU("test.rom", [TestDevice])
+            if trace:
+                self.cpu.enable_tracer(trace)
+            if record:
+                self.cpu.start_recording(record)
+            start_debug_server(self.cpu, debug)
+            self.framebuffer = self.cpu.framebuffer
+            if self.frame_clock is None:
+                self.cpu_thread = threading.Thread(target=self.cpu_cycle_thread, daemon=True)
+                self.cpu_thread.start()
 
     def cpu_cycle_thread(self):
         while not self.cpu.halted:
-            self.cpu.cycle()
+            if self.cpu.run(100000) == EXIT_PAUSED:
+                time.sleep(0.01)
+
+    def cpu_finished(self) -> bool:
+        if self.cpu is not None:
+            return self.cpu.halted
+        return self.framebuffer.closed
+
+    def update_display(self) -> bool:
+        frame, dirty = self.framebuffer.acquire()
+        if dirty is None:
+            return False
 
-    def update_display(self):
-        indexed_data = np.array(self.cpu.display, dtype=np.uint8).reshape((DISPLAY_HEIGHT, DISPLAY_WIDTH))
-        if np.any(indexed_data >= len(self.palette_array)):
-            print("Color doesn't fit in the palette!")
-            indexed_data[indexed_data >= len(self.palette_array)] = 15
-        rgb_array = self.palette_array[indexed_data]
+        x, y, x_end, y_end = dirty
+        indexed_data = np.frombuffer(frame, dtype=np.uint8).reshape((DISPLAY_HEIGHT, DISPLAY_WIDTH))
+        rgb_array = self.palette_lut[indexed_data[y:y_end, x:x_end]]
 
-        pygame.surfarray.blit_array(self.surface, rgb_array)
+        # the display is row-major, surfarray wants [x][y]
+        region = self.surface.subsurface((x, y, x_end - x, y_end - y))
+        pygame.surfarray.blit_array(region, rgb_array.swapaxes(0, 1))
+        return True
 
     def run(self):
-        while self.running and not self.cpu.halted:
+        while self.running and not self.cpu_finished():
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     self.running = False
 
-            self.update_display()
+            if self.frame_clock is not None:
+                self.frame_clock.run_frame(self.cpu)
 
-            self.screen.blit(self.surface, (0, 0))
-            pygame.display.flip()
+            if self.update_display():
+                self.screen.blit(self.surface, (0, 0))
+                pygame.display.flip()
 
             self.clock.tick(60)
 
-        self.cpu.halt("Window exit")
-        self.cpu_thread.join()
+        if self.cpu_process is not None:
+            self.stop_event.set()
+            self.cpu_process.join()
+            self.framebuffer.release()
+            self.shm.close()
+            self.shm.unlink()
+        else:
+            self.cpu.halt("Window exit")
+            if self.cpu_thread is not None:
+                self.cpu_thread.join()
+            self.cpu.stop()
         pygame.quit()
 
 if __name__ == "__main__":
-    main = Main()
+    parser = argparse.ArgumentParser(description="EasyCPU emulator")
+    parser.add_argument("--frame-locked", type=int, metavar="N", help="run exactly N instructions per displayed frame")
+    parser.add_argument("--process", action="store_true", help="run the CPU in a separate process, sharing the framebuffer")
+    parser.add_argument("--debug-port", type=int, default=12345, metavar="PORT", help="port of the debug server, 12345 by default")
+    parser.add_argument("--debug-socket", metavar="PATH", help="serve the debugger on a Unix socket instead")
+    parser.add_argument("--no-debug", action="store_true", help="don't start the debug server")
+    parser.add_argument("--record", metavar="FILE", help="record the run to FILE, replay it with replay.py")
+    parser.add_argument("--trace", type=int, default=0, metavar="N", help="keep the last N executed instructions for tracebacks and the debugger, off by default since it slows the CPU down")
+    args = parser.parse_args()
+
+    debug = None if args.no_debug else (args.debug_port, args.debug_socket)
+    main = Main(instructions_per_frame=args.frame_locked, process=args.process, debug=debug, trace=args.trace, record=args.record)
     main.run()
@@ -0,0 +1,71 @@
+"""Layout of a CPU's address space.
+
+RAM is one bytearray of MemoryMap.size bytes with the ROM loaded at rom_base
+and the stack right below it. Writes to read_only regions fault. Files can be
+mapped above RAM with CPU.map_file, they're mmapped rather than read so a
+multi-megabyte asset costs nothing until the guest touches it.
+
+With wide_addresses, ADDR and JUMP operands are 4 bytes instead of 2, so
+guests can reach past 64 KiB.
+"""
+import mmap
+
+from isa import ROM_BASE, STACK_SIZE, STACK_WORD
+
+DEFAULT_SIZE = 8192
+
+class MemoryMap:
+    def __init__(self, size: int = DEFAULT_SIZE, rom_base: int = ROM_BASE, read_only: list[tuple[int, int]] = (),
+                 wide_addresses: bool = False) -> None:
+        if size <= 0:
+            raise ValueError(f"Memory size must be positive, got {size}")
+        if not (STACK_SIZE * STACK_WORD <= rom_base <= size):
+            raise ValueError(f"ROM base 0x{rom_base:X} leaves no room for the stack below it or is outside memory")
+        for start, end in read_only:
+            if not (0 <= start < end <= size):
+                raise ValueError(f"Read-only region 0x{start:X}-0x{end:X} is outside memory")
+        self.size = size
+        self.rom_base = rom_base
+        self.read_only = list(read_only) # [start, end) ranges
+        self.wide_addresses = wide_addresses
+
+    @property
+    def stack_top(self) -> int:
+        return self.rom_base
+    @property
+    def stack_base(self) -> int:
+        return self.rom_base - STACK_SIZE * STACK_WORD
+    @property
+    def address_size(self) -> int:
+        return 4 if self.wide_addresses else 2
+
+    def is_read_only(self, start: int, end: int) -> bool:
+        for region_start, region_end in self.read_only:
+            if start < region_end and region_start < end:
+                return True
+        return False
+
+    def __repr__(self) -> str:
+        return f"MemoryMap(size=0x{self.size:X}, rom_base=0x{self.rom_base:X}, read_only={self.read_only}, wide_addresses={self.wide_addresses})"
+
+class MappedFile:
+    """A file mapped into the address space at [start, end).
+
+    Read-only unless writable, in which case writes go to a private copy and
+    never reach the file. Mapped files aren't part of snapshots.
+    """
+
+    def __init__(self, path: str, start: int, writable: bool = False) -> None:
+        with open(path, "rb") as f:
+            # mmap raises ValueError for an empty file
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY if writable else mmap.ACCESS_READ)
+        self.path = path
+        self.start = start
+        self.end = start + len(self.data)
+        self.writable = writable
+
+    def close(self) -> None:
+        self.data.close()
+
+    def __repr__(self) -> str:
+        return f"MappedFile({self.path!r}, 0x{self.start:X}-0x{self.end:X}{', writable' if self.writable else ''})"
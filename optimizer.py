@@ -0,0 +1,217 @@
+"""Peephole optimizer, run over each module between parsing and encoding by Compiler(optimize=True).
+
+A program is a list of (name, line) labels and Statements. These passes
+repeat until none of them changes anything:
+
+  dead code        instructions after JMP, RET, IRET or HLT up to the next label go
+  jump threading   jumps and calls to a JMP go straight to where that JMP goes
+  jumps to next    jumps to the instruction right after them go, as do PUSH R; POP R pairs
+  folding          ADD, SUB or MUL of registers with values known from MOVs becomes a MOV
+  redundant moves  MOVs of the value a register already holds, and MOVs overwritten
+                   before anything reads them, go
+
+Only straight-line code between labels is reasoned about, and labeled code
+is never removed since other modules can jump to it. Code from a label used
+as an address (by LOAD, STR, IN or OUT) to the next label is data and is
+left alone. A module that jumps to a number or uses a ROM address as a
+number isn't optimized at all, the code it points at would move. Neither is
+one with MEMCPY, MEMSET or BLIT that MOVs a ROM address into a register.
+"""
+import isa
+from isa import ROM_BASE
+
+# MOV takes any u16 and registers are at least 16 bits, so results in this range fold exactly
+IMMEDIATE_MAX = 0xFFFF
+
+TERMINATORS = {"JMP", "RET", "IRET", "HLT"}
+# jumps that touch neither registers nor the stack
+BRANCHES = {"JMP", "JZ", "JNZ", "JG", "JL", "JEQ", "JNE", "JEQI", "JNEI"}
+# instructions that never write a register, anything not listed here or below forgets every known value
+NO_REGISTER_WRITES = {"NOP", "STR", "PUSH", "JZ", "JNZ", "JG", "JL", "JEQ", "JNE", "JEQI", "JNEI", "DRW", "CLR", "RENDER",
+                      "RECT", "SEED", "IN", "OUT", "IVEC", "EI", "DI", "MEMCPY", "MEMSET", "BLIT"}
+FIRST_REGISTER_WRITES = {"LOAD", "POP", "RND", "RNDMAP", "DJNZ"}
+BULK_MEMORY = {"MEMCPY", "MEMSET", "BLIT"}
+ARITHMETIC = {"ADD": lambda a, b: a + b, "SUB": lambda a, b: a - b, "MUL": lambda a, b: a * b}
+IDENTITIES = {"ADD": 0, "SUB": 0, "MUL": 1} # second operand that leaves the first unchanged
+
+class Statement:
+    def __init__(self, line: int, mnemonic: str, operands: list[int | str]) -> None:
+        self.line = line
+        self.mnemonic = mnemonic
+        self.operands = operands # numbers, or label names for ADDR and JUMP operands
+
+    def __str__(self) -> str:
+        kinds = isa.BY_MNEMONIC[self.mnemonic].operands
+        return f"{self.mnemonic} {', '.join(f'R{value}' if kind == isa.REG else str(value) for kind, value in zip(kinds, self.operands))}".rstrip()
+
+def optimize(program: list, rom_base: int = ROM_BASE) -> list[tuple[int, str]]:
+    """Optimize program in place, returns (line, what changed) for every change."""
+    data = set() # labels used as addresses
+    statements = [statement for statement in program if isinstance(statement, Statement)]
+    # bulk memory instructions take addresses from registers, any big enough MOV could be one
+    addresses_in_registers = any(statement.mnemonic in BULK_MEMORY for statement in statements)
+    for statement in statements:
+        for kind, value in zip(isa.BY_MNEMONIC[statement.mnemonic].operands, statement.operands):
+            if kind == isa.ADDR and isinstance(value, str):
+                data.add(value)
+            elif isinstance(value, int) and (kind == isa.JUMP or kind == isa.ADDR and value >= rom_base
+                                             or addresses_in_registers and statement.mnemonic == "MOV" and kind == isa.IMM and value >= rom_base):
+                return [(statement.line, f"not optimized, {statement} points into the ROM by number")]
+
+    report = []
+    while (_remove_dead_code(program, data, report) | _thread_jumps(program, data, report)
+           | _remove_jumps_to_next(program, data, report) | _fold_straight_line(program, data, report)):
+        pass
+    report.sort(key=lambda change: change[0])
+    return report
+
+def _frozen(program: list, data: set) -> list[bool]:
+    """Whether each entry is in code that starts at a data label."""
+    frozen = []
+    inside = after_label = False
+    for entry in program:
+        if isinstance(entry, Statement):
+            after_label = False
+        else:
+            # several labels in a row name the same spot
+            inside = (inside and after_label) or entry[0] in data
+            after_label = True
+        frozen.append(inside)
+    return frozen
+
+def _remove_dead_code(program: list, data: set, report: list) -> bool:
+    kept = []
+    dead = False
+    for entry, frozen in zip(program, _frozen(program, data)):
+        if not isinstance(entry, Statement):
+            dead = False
+        elif dead:
+            report.append((entry.line, f"removed {entry}, nothing can reach it"))
+            continue
+        elif entry.mnemonic in TERMINATORS and not frozen:
+            dead = True
+        kept.append(entry)
+    changed = len(kept) != len(program)
+    program[:] = kept
+    return changed
+
+def _thread_jumps(program: list, data: set, report: list) -> bool:
+    # label -> index of the statement it names
+    positions = {}
+    waiting = []
+    for index, entry in enumerate(program):
+        if isinstance(entry, Statement):
+            for name in waiting:
+                positions[name] = index
+            waiting = []
+        else:
+            waiting.append(entry[0])
+
+    frozen = _frozen(program, data)
+    changed = False
+    for index, entry in enumerate(program):
+        if not isinstance(entry, Statement) or frozen[index]:
+            continue
+        for operand, kind in enumerate(isa.BY_MNEMONIC[entry.mnemonic].operands):
+            if kind != isa.JUMP:
+                continue
+            target = entry.operands[operand]
+            seen = set()
+            # follow JMPs until something else, a loop or code from another module
+            while target in positions and target not in seen:
+                seen.add(target)
+                at = positions[target]
+                if frozen[at] or program[at].mnemonic != "JMP":
+                    break
+                target = program[at].operands[0]
+            if target != entry.operands[operand]:
+                report.append((entry.line, f"{entry} now goes straight to {target}"))
+                entry.operands[operand] = target
+                changed = True
+    return changed
+
+def _remove_jumps_to_next(program: list, data: set, report: list) -> bool:
+    frozen = _frozen(program, data)
+    kept = []
+    for index, entry in enumerate(program):
+        if isinstance(entry, Statement) and entry.mnemonic in BRANCHES and not frozen[index]:
+            following = set()
+            after = index + 1
+            while after < len(program) and not isinstance(program[after], Statement):
+                following.add(program[after][0])
+                after += 1
+            if entry.operands[-1] in following:
+                report.append((entry.line, f"removed {entry}, it jumps to the next instruction"))
+                continue
+        kept.append(entry)
+    changed = len(kept) != len(program)
+    program[:] = kept
+    return changed
+
+def _fold_straight_line(program: list, data: set, report: list) -> bool:
+    frozen = _frozen(program, data)
+    removed = set()
+    changed = False
+    known = {}  # register -> value it holds
+    unread = {} # register -> index of the MOV that set it, while nothing has read it
+    for index, entry in enumerate(program):
+        if index in removed:
+            continue
+        if not isinstance(entry, Statement) or frozen[index]:
+            known.clear()
+            unread.clear()
+            continue
+        mnemonic, operands = entry.mnemonic, entry.operands
+
+        if mnemonic == "PUSH" and index + 1 < len(program):
+            following = program[index + 1]
+            if isinstance(following, Statement) and following.mnemonic == "POP" and following.operands == operands:
+                report.append((entry.line, f"removed {entry} and {following}, together they do nothing"))
+                removed.update((index, index + 1))
+                continue
+
+        if mnemonic in ARITHMETIC:
+            x, y = operands
+            if known.get(y) == IDENTITIES[mnemonic]:
+                report.append((entry.line, f"removed {entry}, R{y} is {known[y]}"))
+                removed.add(index)
+                continue
+            # only worth it when the MOV that set x goes, otherwise it's the same count and a byte longer
+            if x in known and y in known and x in unread:
+                result = ARITHMETIC[mnemonic](known[x], known[y])
+                if 0 <= result <= IMMEDIATE_MAX:
+                    report.append((entry.line, f"folded {entry} into MOV R{x}, {result}"))
+                    entry.mnemonic, entry.operands = mnemonic, operands = "MOV", [x, result]
+                    changed = True
+            if mnemonic != "MOV":
+                for register in (x, y):
+                    unread.pop(register, None)
+                known.pop(x, None)
+                continue
+
+        if mnemonic == "MOV":
+            x, value = operands
+            if known.get(x) == value:
+                report.append((entry.line, f"removed {entry}, R{x} already holds {value}"))
+                removed.add(index)
+                continue
+            if x in unread:
+                overwritten = program[unread[x]]
+                report.append((overwritten.line, f"removed {overwritten}, R{x} is set again before it's read"))
+                removed.add(unread[x])
+            known[x] = value
+            unread[x] = index
+            continue
+
+        if mnemonic == "NOP":
+            continue
+        # anything else may read any register or leave straight-line code
+        unread.clear()
+        if mnemonic in FIRST_REGISTER_WRITES:
+            known.pop(operands[0], None)
+        elif mnemonic not in NO_REGISTER_WRITES:
+            known.clear()
+
+    if removed:
+        program[:] = [entry for index, entry in enumerate(program) if index not in removed]
+    return changed or bool(removed)
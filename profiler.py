@@ -0,0 +1,175 @@
+"""Per-opcode and per-PC execution profiler.
+
+Enabled with CPU.enable_profiler, which makes the decoder wrap every
+instruction it decodes (the blocks backend falls back to the interpreter while
+profiling). Counts and host time live in preallocated arrays indexed by opcode
+and by PC. A shadow stack follows CALL/RET so the samples can also be exported
+as collapsed stacks for flamegraph.pl / speedscope.
+"""
+import json
+import time
+import argparse
+from array import array
+
+import isa
+
+class Profiler:
+    def __init__(self, cpu) -> None:
+        self.cpu = cpu
+        self.opcode_counts = array("Q", bytes(8 * 256))
+        self.opcode_ns = array("Q", bytes(8 * 256)) # time spent in the handler, e.g. drawing for DRW/RECT/RENDER
+        self.pc_hits = array("Q", bytes(8 * cpu.rom_size)) # indexed by pc - rom_base, grows with the ROM
+
+        # call paths, a path is a tuple of function addresses from the entry point down
+        self.path_ids: dict[tuple[int, ...], int] = {(cpu.rom_base,): 0}
+        self.paths: list[tuple[int, ...]] = [(cpu.rom_base,)]
+        self.path_counts = array("Q", [0]) # instructions executed in each path
+        self.path = 0
+        self._callers: list[int] = [] # path ids to go back to on RET
+
+    def reset(self) -> None:
+        self.__init__(self.cpu)
+
+    @property
+    def instructions(self) -> int:
+        return sum(self.opcode_counts)
+
+    # Shadow call stack
+    def _enter(self, target: int) -> None:
+        self._callers.append(self.path)
+        path = self.paths[self.path] + (target,)
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = self.path_ids[path] = len(self.paths)
+            self.paths.append(path)
+            self.path_counts.append(0)
+        self.path = path_id
+    def _leave(self) -> None:
+        # a RET without a CALL (the guest moved the stack by hand) stays at the top level
+        if self._callers:
+            self.path = self._callers.pop()
+
+    def wrap(self, pc: int, entry: tuple) -> tuple:
+        """Profiling version of a decoded (handler, operands, next_pc) entry."""
+        handler, operands, next_pc = entry
+        cpu = self.cpu
+        opcode = cpu.memory[pc]
+        index = pc - cpu.rom_base
+        if index >= len(self.pc_hits):
+            # the ROM was reloaded bigger, only instructions in it are wrapped
+            self.pc_hits.frombytes(bytes(8 * (cpu.rom_size - len(self.pc_hits))))
+        opcode_counts, opcode_ns, pc_hits, path_counts = self.opcode_counts, self.opcode_ns, self.pc_hits, self.path_counts
+        perf_counter_ns = time.perf_counter_ns
+
+        def profiled():
+            opcode_counts[opcode] += 1
+            pc_hits[index] += 1
+            path_counts[self.path] += 1
+            start = perf_counter_ns()
+            handler(*operands)
+            opcode_ns[opcode] += perf_counter_ns() - start
+
+        if handler == cpu._op_call:
+            def profiled_call():
+                profiled()
+                self._enter(cpu.pc)
+            return (profiled_call, (), next_pc)
+        if handler == cpu._op_ret:
+            def profiled_ret():
+                profiled()
+                self._leave()
+            return (profiled_ret, (), next_pc)
+        return (profiled, (), next_pc)
+
+    # Export
+    def opcodes(self) -> list[dict]:
+        result = []
+        for opcode, count in enumerate(self.opcode_counts):
+            if count:
+                instruction = isa.BY_OPCODE[opcode]
+                result.append({
+                    "opcode": opcode,
+                    "mnemonic": instruction.mnemonic if instruction else None,
+                    "count": count,
+                    "host_ns": self.opcode_ns[opcode],
+                })
+        return sorted(result, key=lambda entry: -entry["count"])
+
+    def hot_pcs(self, top: int | None = None) -> list[dict]:
+        hits = sorted(((count, index) for index, count in enumerate(self.pc_hits) if count), reverse=True)
+        if top is not None:
+            hits = hits[:top]
+        memory = self.cpu.memory
+        result = []
+        for count, index in hits:
+            pc = self.cpu.rom_base + index
+            instruction = isa.BY_OPCODE[memory[pc]] if pc < len(memory) else None
+            result.append({"pc": pc, "mnemonic": instruction.mnemonic if instruction else None, "count": count})
+        return result
+
+    def to_dict(self, top: int | None = None) -> dict:
+        return {
+            "instructions": self.instructions,
+            "opcodes": self.opcodes(),
+            "pcs": self.hot_pcs(top),
+            "paths": [
+                {"path": list(self.paths[path_id]), "count": count}
+                for path_id, count in enumerate(self.path_counts) if count
+            ],
+        }
+
+    def write_json(self, filename: str, top: int | None = None) -> None:
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(top), f, indent=4)
+
+    def collapsed(self, symbols: dict[int, str] | None = None) -> list[str]:
+        """Lines of "main;func_1040;func_10A2 count", symbols maps function addresses to names."""
+        symbols = symbols or {}
+        def name(address: int) -> str:
+            if address in symbols:
+                return symbols[address]
+            return "main" if address == self.cpu.rom_base else f"func_{address:04X}"
+
+        return [
+            ";".join(name(address) for address in self.paths[path_id]) + f" {count}"
+            for path_id, count in enumerate(self.path_counts) if count
+        ]
+
+    def write_collapsed(self, filename: str, symbols: dict[int, str] | None = None) -> None:
+        with open(filename, "w") as f:
+            for line in self.collapsed(symbols):
+                f.write(line + "\n")
+
+    def summary(self, top: int = 10) -> str:
+        total = self.instructions or 1
+        lines = [f"{self.instructions} instructions"]
+        lines.append("Opcodes:")
+        for entry in self.opcodes()[:top]:
+            lines.append(f"  {entry['mnemonic'] or hex(entry['opcode']):<7} {entry['count']:>10} {100 * entry['count'] / total:5.1f}%  {entry['host_ns'] / entry['count']:8.0f} ns each")
+        lines.append("Hot PCs:")
+        for entry in self.hot_pcs(top):
+            lines.append(f"  0x{entry['pc']:04X} {entry['mnemonic'] or '?':<7} {entry['count']:>10} {100 * entry['count'] / total:5.1f}%")
+        return "\n".join(lines)
+
+def main():
+    from emulator import CPU
+
+    parser = argparse.ArgumentParser(description="Profile a ROM")
+    parser.add_argument("rom")
+    parser.add_argument("--instructions", type=int, required=True)
+    parser.add_argument("--json", metavar="FILE", help="write the full profile as JSON")
+    parser.add_argument("--collapsed", metavar="FILE", help="write collapsed stacks for flamegraph.pl")
+    parser.add_argument("--top", type=int, default=10, help="entries in the printed summary")
+    args = parser.parse_args()
+
+    cpu = CPU(args.rom, [], verbose=False)
+    profiler = cpu.enable_profiler()
+    cpu.run(args.instructions)
+    print(profiler.summary(args.top))
+    if args.json:
+        profiler.write_json(args.json)
+    if args.collapsed:
+        profiler.write_collapsed(args.collapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Binary debug protocol spoken between the CPU's debug server and remote.py.
+
+Every message is a little-endian u32 length followed by that many bytes.
+Requests are a u32 request id, a u8 command and the command's arguments,
+responses are the request id, a u8 status and the result. A connection stays
+open for any number of requests and clients don't have to wait for a reply
+before sending the next request, replies come back in request order.
+
+BATCH carries several commands in one request and answers them all in one
+response, e.g. a few registers and a memory range in a single round trip.
+"""
+import struct
+
+LENGTH = struct.Struct("<I")
+REQUEST = struct.Struct("<IB")  # request id, command
+RESPONSE = struct.Struct("<IB") # request id, status
+
+MAX_MESSAGE = 16 * 1024 * 1024
+
+OK    = 0
+ERROR = 1 # the result is a UTF-8 error message
+
+# Commands
+GET_REGISTERS   = 0x01 # -> u32 per register
+SET_REGISTER    = 0x02 # u8 register, u32 value
+GET_MEMORY      = 0x03 # u32 address, u32 length -> raw bytes
+SET_MEMORY      = 0x04 # u32 address, raw bytes
+GET_STACK       = 0x05 # -> u32 per entry, top of the stack last
+SET_STACK       = 0x06 # u32 index, u32 value
+GET_PC          = 0x07 # -> u32
+SET_PC          = 0x08 # u32
+PAUSE           = 0x09
+RESUME          = 0x0A
+HALT            = 0x0B # UTF-8 message
+GET_FRAMEBUFFER = 0x0C # -> u16 width, u16 height, the latest published frame
+BATCH           = 0x0D # u16 count, then a u32 length + u8 command + arguments per command
+                       # -> u16 count, then a u8 status + u32 length + result per command
+SET_BREAKPOINT   = 0x0E # u32 pc, u8 register (NO_REGISTER for none), u8 comparison, u32 value
+CLEAR_BREAKPOINT = 0x0F # u32 pc
+SET_WATCHPOINT   = 0x10 # u32 start, u32 end, u8 WATCH_* flags
+CLEAR_WATCHPOINT = 0x11 # u32 start, u32 end
+STEP             = 0x12 # u32 count -> u32 pc
+GET_STOP_REASON  = 0x13 # -> u8 index into STOP_REASONS (0 when running), u32 pc, u32 address
+GET_TRACE        = 0x14 # -> the trace ring, see TraceRecorder.raw
+LOAD_ROM         = 0x15 # raw bytes, replaces the ROM like CPU.load_rom_bytes, registers and the rest of memory stay
+
+NO_REGISTER = 0xFF
+COMPARISONS = ("==", "!=", "<", ">", "<=", ">=")
+WATCH_READ  = 1
+WATCH_WRITE = 2
+STOP_REASONS = (None, "breakpoint", "watch_read", "watch_write", "step")
+
+# Fixed size arguments and results
+U32 = struct.Struct("<I")
+U16 = struct.Struct("<H")
+REGISTER_VALUE = struct.Struct("<BI")
+MEMORY_RANGE = struct.Struct("<II")
+STACK_VALUE = struct.Struct("<II")
+FRAME_SIZE = struct.Struct("<HH")
+BREAKPOINT = struct.Struct("<IBBI")
+WATCHPOINT = struct.Struct("<IIB")
+STOP = struct.Struct("<BII")
+BATCH_ENTRY = struct.Struct("<IB")   # length of command + arguments, command
+BATCH_RESULT = struct.Struct("<BI")  # status, length
+
+class ProtocolError(Exception):
+    pass
+
+def encode_request(request_id: int, command: int, arguments: bytes = b"") -> bytes:
+    return LENGTH.pack(REQUEST.size + len(arguments)) + REQUEST.pack(request_id, command) + arguments
+
+def encode_response(request_id: int, status: int, result: bytes = b"") -> bytes:
+    return LENGTH.pack(RESPONSE.size + len(result)) + RESPONSE.pack(request_id, status) + result
+
+def encode_batch(commands: list[tuple[int, bytes]]) -> bytes:
+    """Arguments of a BATCH request, commands are (command, arguments) pairs."""
+    parts = [U16.pack(len(commands))]
+    for command, arguments in commands:
+        parts.append(BATCH_ENTRY.pack(1 + len(arguments), command))
+        parts.append(arguments)
+    return b"".join(parts)
+
+def decode_batch(arguments: memoryview) -> list[tuple[int, memoryview]]:
+    (count,) = U16.unpack_from(arguments, 0)
+    offset = U16.size
+    commands = []
+    for _ in range(count):
+        if offset + BATCH_ENTRY.size > len(arguments):
+            raise ProtocolError("Truncated batch")
+        length, command = BATCH_ENTRY.unpack_from(arguments, offset)
+        start = offset + BATCH_ENTRY.size
+        offset += U32.size + length
+        if length < 1 or offset > len(arguments):
+            raise ProtocolError("Truncated batch")
+        commands.append((command, arguments[start:offset]))
+    return commands
+
+def encode_batch_results(results: list[tuple[int, bytes]]) -> bytes:
+    parts = [U16.pack(len(results))]
+    for status, result in results:
+        parts.append(BATCH_RESULT.pack(status, len(result)))
+        parts.append(result)
+    return b"".join(parts)
+
+def decode_batch_results(result: memoryview) -> list[tuple[int, memoryview]]:
+    (count,) = U16.unpack_from(result, 0)
+    offset = U16.size
+    results = []
+    for _ in range(count):
+        status, length = BATCH_RESULT.unpack_from(result, offset)
+        offset += BATCH_RESULT.size
+        results.append((status, result[offset:offset + length]))
+        offset += length
+    return results
+
+def runs_cpu(message: memoryview) -> bool:
+    """Whether a request executes guest code, a STEP or a BATCH holding one."""
+    if len(message) < REQUEST.size:
+        return False
+    _, command = REQUEST.unpack_from(message, 0)
+    if command == BATCH:
+        try:
+            return any(sub_command == STEP for sub_command, _ in decode_batch(message[REQUEST.size:]))
+        except (ProtocolError, struct.error):
+            return False # answered with an error
+    return command == STEP
+
+class MessageReader:
+    """Splits a byte stream into messages, however the bytes were chunked by recv."""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[memoryview]:
+        """Add received bytes and return the messages they complete."""
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= LENGTH.size:
+            (length,) = LENGTH.unpack_from(self.buffer, offset)
+            if length > MAX_MESSAGE:
+                raise ProtocolError(f"Message of {length} bytes is too large")
+            end = offset + LENGTH.size + length
+            if end > len(self.buffer):
+                break
+            # copied out so the buffer can be compacted below
+            messages.append(memoryview(bytes(self.buffer[offset + LENGTH.size:end])))
+            offset = end
+        del self.buffer[:offset]
+        return messages
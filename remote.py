@@ -2,8 +2,9 @@ HELP_MESSAGE = """
 EasyCPU Debugger Commands:
 r   - Get registers
 sr  $r $v - Set register $r to $v
-m   $a - Get memory at $a
+m   $a [$n] - Get $n bytes of memory at $a, 1 by default
 sm  $a $v - Set memory at $a to $v
+lr  $f - Load the ROM file $f into the running CPU
 s   - Get stack
 ss  $i $v - Set stack at $i to $v
 pc  - Get PC
@@ -11,43 +12,190 @@ spc $v - Set PC to $v
 p   - Pause
 rs  - Resume
 h   - Halt
+b   $a - Break at $a
+bif $a $r $c $v - Break at $a when register $r compares $c (==, !=, <, >, <=, >=) to $v
+bd  $a - Delete the breakpoints at $a
+w   $s $e [$rw] - Watch memory $s to $e (exclusive) for reads (r), writes (w, default) or both (rw)
+wd  $s $e - Delete the watchpoint $s to $e
+st  [$n] - Step $n instructions, 1 by default
+why - Show why the CPU stopped
+t   [$n] - Show the last $n executed instructions, 16 by default
 help - Show this help message
 exit - Exit the debugger
 """
 
 import socket
-import pickle
+import struct
 import inspect
+import argparse
 
-def send_command(command):
-    if command["type"] == "SET_REGISTER":
-        command["register"] = str(command["register"]).upper()
-        if not command["register"].startswith("R"):
-            command["register"] = f"R{command['register']}"
-    
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect(('localhost', 12345))
-        s.sendall(pickle.dumps(command))
-        response = s.recv(1024)
-        return pickle.loads(response)
-
-GET_REGISTERS = lambda: send_command({"type": "GET_REGISTERS"})
-SET_REGISTER = lambda r, v: send_command({"type": "SET_REGISTER", "register": r, "value": v})
-GET_MEMORY = lambda a: send_command({"type": "GET_MEMORY", "address": a})
-SET_MEMORY = lambda a, v: send_command({"type": "SET_MEMORY", "address": a, "value": v})
-GET_STACK = lambda: send_command({"type": "GET_STACK"})
-SET_STACK = lambda i, v: send_command({"type": "SET_STACK", "index": i, "value": v})
-GET_PC = lambda: send_command({"type": "PC"})
-SET_PC = lambda v: send_command({"type": "SET_PC", "value": v})
-PAUSE = lambda: send_command({"type": "PAUSE"})
-RESUME = lambda: send_command({"type": "RESUME"})
-HALT = lambda: send_command({"type": "HALT"})
+import isa
+import tracer
+import protocol
+
+class DebugError(Exception):
+    pass
+
+class DebugClient:
+    """Persistent connection to a CPU's debug server.
+
+    The typed methods send one request and wait for its reply. To pipeline,
+    send() several requests and receive() their replies afterwards, or put
+    several commands into one round trip with batch().
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 12345, path: str | None = None) -> None:
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(path)
+        else:
+            self.socket = socket.create_connection((host, port))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = protocol.MessageReader()
+        self.next_id = 1
+        self.replies: dict[int, tuple[int, memoryview]] = {}
+
+    def close(self) -> None:
+        self.socket.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def send(self, command: int, arguments: bytes = b"") -> int:
+        """Send a request without waiting for the reply, returns its request id."""
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.socket.sendall(protocol.encode_request(request_id, command, arguments))
+        return request_id
+
+    def receive(self, request_id: int) -> memoryview:
+        """Wait for the reply to a request, raises DebugError if the CPU reported an error."""
+        while request_id not in self.replies:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError("Debug server closed the connection")
+            for message in self.reader.feed(data):
+                reply_id, status = protocol.RESPONSE.unpack_from(message, 0)
+                self.replies[reply_id] = (status, message[protocol.RESPONSE.size:])
+        status, result = self.replies.pop(request_id)
+        if status != protocol.OK:
+            raise DebugError(bytes(result).decode())
+        return result
+
+    def call(self, command: int, arguments: bytes = b"") -> memoryview:
+        return self.receive(self.send(command, arguments))
+
+    def batch(self, commands: list[tuple[int, bytes]]) -> list[memoryview | DebugError]:
+        """Run several (command, arguments) in one round trip, failed commands come back as a DebugError."""
+        results = protocol.decode_batch_results(self.call(protocol.BATCH, protocol.encode_batch(commands)))
+        return [result if status == protocol.OK else DebugError(bytes(result).decode()) for status, result in results]
+
+    def get_registers(self) -> dict[str, int]:
+        result = self.call(protocol.GET_REGISTERS)
+        return {f"R{i}": value for i, value in enumerate(struct.unpack(f"<{len(result) // 4}I", result))}
+    def set_register(self, register: int | str, value: int) -> None:
+        self.call(protocol.SET_REGISTER, protocol.REGISTER_VALUE.pack(int(str(register).upper().removeprefix("R")), value))
+    def get_memory(self, addr: int, length: int = 1) -> bytes:
+        return bytes(self.call(protocol.GET_MEMORY, protocol.MEMORY_RANGE.pack(addr, length)))
+    def set_memory(self, addr: int, value: int | bytes) -> None:
+        self.call(protocol.SET_MEMORY, protocol.U32.pack(addr) + (bytes((value,)) if isinstance(value, int) else bytes(value)))
+    def load_rom_bytes(self, data: bytes) -> None:
+        """Replace the ROM of the running CPU, see build.py for reloading on every change."""
+        self.call(protocol.LOAD_ROM, bytes(data))
+    def get_stack(self) -> list[int]:
+        result = self.call(protocol.GET_STACK)
+        return list(struct.unpack(f"<{len(result) // 4}I", result))
+    def set_stack(self, index: int, value: int) -> None:
+        self.call(protocol.SET_STACK, protocol.STACK_VALUE.pack(index, value))
+    def get_pc(self) -> int:
+        return protocol.U32.unpack(self.call(protocol.GET_PC))[0]
+    def set_pc(self, value: int) -> None:
+        self.call(protocol.SET_PC, protocol.U32.pack(value))
+    def pause(self) -> None:
+        self.call(protocol.PAUSE)
+    def resume(self) -> None:
+        self.call(protocol.RESUME)
+    def halt(self, message: str = "Remote Debugger requested HLT") -> None:
+        self.call(protocol.HALT, message.encode())
+    def set_breakpoint(self, pc: int, register: int | str | None = None, comparison: str = "==", value: int = 0) -> None:
+        register = protocol.NO_REGISTER if register is None else int(str(register).upper().removeprefix("R"))
+        self.call(protocol.SET_BREAKPOINT, protocol.BREAKPOINT.pack(pc, register, protocol.COMPARISONS.index(comparison), value))
+    def clear_breakpoint(self, pc: int) -> None:
+        self.call(protocol.CLEAR_BREAKPOINT, protocol.U32.pack(pc))
+    def set_watchpoint(self, start: int, end: int, read: bool = False, write: bool = True) -> None:
+        flags = (protocol.WATCH_READ if read else 0) | (protocol.WATCH_WRITE if write else 0)
+        self.call(protocol.SET_WATCHPOINT, protocol.WATCHPOINT.pack(start, end, flags))
+    def clear_watchpoint(self, start: int, end: int) -> None:
+        self.call(protocol.CLEAR_WATCHPOINT, protocol.MEMORY_RANGE.pack(start, end))
+    def step(self, count: int = 1) -> int:
+        """Run count instructions on a paused CPU, returns the new PC."""
+        return protocol.U32.unpack(self.call(protocol.STEP, protocol.U32.pack(count)))[0]
+    def get_stop_reason(self) -> dict | None:
+        """Why the CPU is paused, None if it's running or was paused by hand."""
+        reason, pc, address = protocol.STOP.unpack(self.call(protocol.GET_STOP_REASON))
+        if reason == 0:
+            return None
+        return {"reason": protocol.STOP_REASONS[reason], "pc": pc, "address": address}
+    def get_trace(self, last: int | None = None) -> list[dict]:
+        """The last executed instructions, oldest first, see tracer.py."""
+        rom_base, wide_addresses, entries = tracer.from_raw(bytes(self.call(protocol.GET_TRACE)))
+        if not entries:
+            return []
+        # the instructions are read from the code the trace went through
+        pcs = [pc for pc, _, _ in entries]
+        largest = isa.MAX_WIDE_INSTRUCTION_SIZE if wide_addresses else isa.MAX_INSTRUCTION_SIZE
+        start, end = min(pcs), max(pcs) + largest
+        try:
+            memory = self.get_memory(start, end - start)
+        except DebugError:
+            # the last instruction sits at the end of memory
+            memory = self.get_memory(start, end - start - largest + 1)
+        return tracer.decode_records(entries, memory, last, rom_base, wide_addresses, memory_start=start)
+    def get_framebuffer(self) -> tuple[int, int, bytes]:
+        """The latest published frame as (width, height, pixels)."""
+        result = self.call(protocol.GET_FRAMEBUFFER)
+        width, height = protocol.FRAME_SIZE.unpack_from(result, 0)
+        return width, height, bytes(result[protocol.FRAME_SIZE.size:])
+
+_client: DebugClient | None = None
+
+def client() -> DebugClient:
+    global _client
+    if _client is None:
+        _client = DebugClient()
+    return _client
+
+GET_REGISTERS = lambda: client().get_registers()
+SET_REGISTER = lambda r, v: client().set_register(r, v)
+GET_MEMORY = lambda a, n=1: client().get_memory(a, n)
+SET_MEMORY = lambda a, v: client().set_memory(a, v)
+def LOAD_ROM(filename: str):
+    with open(filename, "rb") as f:
+        client().load_rom_bytes(f.read())
+    return "OK"
+GET_STACK = lambda: client().get_stack()
+SET_STACK = lambda i, v: client().set_stack(i, v)
+GET_PC = lambda: client().get_pc()
+SET_PC = lambda v: client().set_pc(v)
+PAUSE = lambda: client().pause() or "OK"
+RESUME = lambda: client().resume() or "OK"
+HALT = lambda: client().halt() or "OK"
+BREAK = lambda a: client().set_breakpoint(a) or "OK"
+BREAK_IF = lambda a, r, c, v: client().set_breakpoint(a, r, c, v) or "OK"
+DELETE_BREAK = lambda a: client().clear_breakpoint(a) or "OK"
+WATCH = lambda s, e, rw="w": client().set_watchpoint(s, e, "r" in rw, "w" in rw) or "OK"
+DELETE_WATCH = lambda s, e: client().clear_watchpoint(s, e) or "OK"
+STEP = lambda n=1: client().step(n)
+TRACE = lambda n=16: print(tracer.format_records(client().get_trace(n)))
+WHY = lambda: client().get_stop_reason() or "Not stopped at a breakpoint"
 
 commands = {
     "r": GET_REGISTERS,
     "sr": SET_REGISTER,
     "m": GET_MEMORY,
     "sm": SET_MEMORY,
+    "lr": LOAD_ROM,
     "s": GET_STACK,
     "ss": SET_STACK,
     "pc": GET_PC,
@@ -55,6 +203,14 @@ commands = {
     "p": PAUSE,
     "rs": RESUME,
     "h": HALT,
+    "b": BREAK,
+    "bif": BREAK_IF,
+    "bd": DELETE_BREAK,
+    "w": WATCH,
+    "wd": DELETE_WATCH,
+    "st": STEP,
+    "why": WHY,
+    "t": TRACE,
     "help": lambda: print(HELP_MESSAGE),
     "exit": lambda: exit(0)
 }
@@ -62,8 +218,9 @@ commands = {
 def parse_args(func, args):
     sig = inspect.signature(func)
     params = sig.parameters
-    if len(params) != len(args):
-        raise ValueError(f"Command expects {len(params)} arguments but got {len(args)}")
+    required = sum(1 for param in params.values() if param.default is inspect.Parameter.empty)
+    if not (required <= len(args) <= len(params)):
+        raise ValueError(f"Command expects {required} arguments but got {len(args)}")
     
     parsed_args = []
     for param, arg in zip(params.values(), args):
@@ -85,6 +242,14 @@ def parse_args(func, args):
 import json
 
 def main():
+    global _client
+    parser = argparse.ArgumentParser(description="EasyCPU remote debugger")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--socket", metavar="PATH", help="connect to a debug server on a Unix socket")
+    args = parser.parse_args()
+    _client = DebugClient(args.host, args.port, args.socket)
+
     while True:
         user_input = input("Enter command: ")
         parts = user_input.split()
@@ -97,17 +262,17 @@ def main():
             func = commands[cmd]
             try:
                 parsed_args = parse_args(func, args)
-                result = func(*parsed_args)
-                if result:
-                    data = result.get("data", None)
-                    if isinstance(data, (int, float)):
-                        print(f"{data} (0x{data:x})")
-                    elif isinstance(data, (dict, list)):
-                        print(json.dumps(data, indent=4))
-                    elif result.get("error", None):
-                        print(result.get("error"))
-                    else:
-                        print(f"{data}")
+                data = func(*parsed_args)
+                if isinstance(data, (int, float)):
+                    print(f"{data} (0x{data:x})")
+                elif isinstance(data, (dict, list)):
+                    print(json.dumps(data, indent=4))
+                elif isinstance(data, bytes):
+                    print(data.hex(" "))
+                elif data is not None:
+                    print(f"{data}")
+            except DebugError as e:
+                print(e)
             except Exception as e:
                 print(f"Error: {e}")
         else:
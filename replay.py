@@ -0,0 +1,174 @@
+"""Record everything that reaches a CPU from outside and replay it bit for bit.
+
+Guest code is deterministic on its own: RND is an LCG and SEED by the guest
+replays itself. What isn't are the changes made from outside (debug server
+writes, set_random, restoring a snapshot), the instruction count they land at
+(which depends on host timing and ips_limit), device input, when
+asynchronous device work finishes, and files mapped into memory (by path,
+the file has to be there with the same contents on replay). A recording
+is an append-only file holding the starting snapshot followed by those events,
+each stamped with the CPU's instruction_count. Replaying restores the snapshot and
+runs unthrottled to each stamp before applying the event.
+
+Debug server writes are stored as the protocol command that made them, so
+replay applies them through the same code.
+"""
+import hashlib
+import argparse
+import struct
+from collections import deque
+
+import protocol
+
+MAGIC = b"ECRR"
+VERSION = 2
+HEADER = struct.Struct("<4sH")  # magic, version
+EVENT = struct.Struct("<BQI")   # kind, instruction count, payload size
+
+# Event kinds, protocol commands (SET_MEMORY, SET_REGISTER, ...) are kinds too
+START   = 0xF0 # snapshot the recording starts from
+RESTORE = 0xF1 # snapshot restored during the run
+SEED    = 0xF2 # u64 seed from set_random
+INPUT   = 0xF3 # bytes a device read from outside, consumed in order rather than at their stamp
+END     = 0xF4 # sha256 of the final state, see state_digest
+COMPLETE = 0xF5 # u32 sequence number of device work delivered, see CPU.run_async
+MAP      = 0xF6 # u64 start, u8 writable, UTF-8 path, see CPU.map_file
+UNMAP    = 0xF7 # u64 start
+
+DEBUG_WRITES = (protocol.SET_REGISTER, protocol.SET_MEMORY, protocol.SET_STACK, protocol.SET_PC, protocol.HALT, protocol.LOAD_ROM)
+SEED_VALUE = struct.Struct("<Q")
+SEQUENCE = struct.Struct("<I")
+MAPPING = struct.Struct("<QB")
+UNMAPPING = struct.Struct("<Q")
+
+def state_digest(cpu) -> bytes:
+    digest = hashlib.sha256(cpu.memory)
+    digest.update(struct.pack(f"<{len(cpu.registers)}I", *cpu.registers))
+    digest.update(struct.pack("<IIQ?", cpu.pc, cpu.sp, cpu.rng.state, cpu.halted))
+    digest.update(struct.pack("<I?HB", cpu.interrupt_vector, cpu.interrupts_enabled, cpu.interrupt_pending, cpu.interrupt_line))
+    return digest.digest()
+
+class Recorder:
+    def __init__(self, cpu, filename: str) -> None:
+        self.cpu = cpu
+        self.events = 0
+        self.file = open(filename, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.event(START, cpu.snapshot())
+        for mapped in cpu.mapped_files:
+            self.event(MAP, MAPPING.pack(mapped.start, mapped.writable) + mapped.path.encode())
+
+    def event(self, kind: int, payload: bytes = b"") -> None:
+        self.file.write(EVENT.pack(kind, self.cpu.instruction_count, len(payload)))
+        self.file.write(payload)
+        self.events += 1
+        if kind != INPUT:
+            # external events are rare, keep the file usable if the emulator dies
+            self.file.flush()
+
+    def close(self) -> None:
+        self.event(END, state_digest(self.cpu))
+        self.file.close()
+
+def read_events(filename: str):
+    """Yield (kind, instruction count, payload) for every event in a recording."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    magic, version = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a recording")
+    if version != VERSION:
+        raise ValueError(f"Unsupported recording version {version}")
+
+    offset = HEADER.size
+    view = memoryview(data)
+    while offset + EVENT.size <= len(data):
+        kind, count, size = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        if offset + size > len(data):
+            break # cut off by a crash while writing
+        yield kind, count, view[offset:offset + size]
+        offset += size
+
+def replay(filename: str, devices: list = [], backend: str = "interpreter", memory_map=None):
+    """Replay a recording on a new CPU, returns (cpu, verified).
+
+    verified is None when the recording has no END event (the recorded run
+    didn't stop cleanly), otherwise whether the final state matches. Without a
+    memory_map the layout comes from the snapshot, read-only regions have to be
+    passed in like devices.
+    """
+    from emulator import CPU, SNAPSHOT_HEADER, SNAPSHOT_SECTION, SNAPSHOT_WIDE_ADDRESSES
+    from memorymap import MemoryMap
+
+    events = iter(read_events(filename))
+    kind, _, snapshot = next(events, (None, 0, b""))
+    if kind != START:
+        raise ValueError(f"{filename} doesn't start with a snapshot")
+
+    header = SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+    word_bits, flags, rom_base = header[2], header[8], header[12]
+    if memory_map is None:
+        (memory_size,) = SNAPSHOT_SECTION.unpack_from(snapshot, SNAPSHOT_HEADER.size)
+        memory_map = MemoryMap(memory_size, rom_base, wide_addresses=bool(flags & SNAPSHOT_WIDE_ADDRESSES))
+    cpu = CPU(b"", devices, backend=backend, word_bits=word_bits, verbose=False, memory_map=memory_map)
+    cpu.restore(snapshot)
+    cpu.paused = False # pauses are timing, not state
+
+    stamped = []
+    inputs = deque()
+    for kind, count, payload in events:
+        if kind == INPUT:
+            inputs.append(bytes(payload))
+        else:
+            stamped.append((kind, count, payload))
+    cpu.replay_inputs = inputs
+
+    verified = None
+    for kind, count, payload in stamped:
+        while cpu.instructions_executed < count and not cpu.halted:
+            cpu.paused = False
+            cpu.run(count - cpu.instructions_executed)
+
+        if kind == END:
+            verified = state_digest(cpu) == bytes(payload)
+            break
+        if kind == RESTORE:
+            cpu.restore(payload)
+            cpu.paused = False
+        elif kind == COMPLETE:
+            # the device work was submitted again by the replayed guest, wait for it
+            (sequence,) = SEQUENCE.unpack(payload)
+            if sequence not in cpu._io_operations:
+                raise ValueError(f"Recorded device operation {sequence} was never submitted on replay")
+            cpu.complete_io(sequence)
+        elif kind == MAP:
+            start, writable = MAPPING.unpack_from(payload, 0)
+            cpu.map_file(bytes(payload[MAPPING.size:]).decode(), start, bool(writable))
+        elif kind == UNMAP:
+            cpu.unmap_file(*UNMAPPING.unpack(payload))
+        elif kind == SEED:
+            cpu.set_random(*SEED_VALUE.unpack(payload))
+        elif kind in DEBUG_WRITES:
+            status, result = cpu._debug_command(kind, payload)
+            if status != protocol.OK:
+                raise ValueError(f"Recorded debug command 0x{kind:02X} failed on replay: {bytes(result).decode()}")
+        else:
+            raise ValueError(f"Unknown event 0x{kind:02X} in {filename}")
+    return cpu, verified
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded run")
+    parser.add_argument("recording")
+    parser.add_argument("--backend", choices=["interpreter", "blocks"], default="interpreter")
+    args = parser.parse_args()
+
+    cpu, verified = replay(args.recording, backend=args.backend)
+    print(f"Replayed {cpu.instructions_executed} instructions, PC 0x{cpu.pc:04X}{', halted' if cpu.halted else ''}")
+    if verified is None:
+        print("The recording has no END event, the final state can't be checked")
+    else:
+        print("Final state matches the recording" if verified else "Final state DIFFERS from the recording")
+
+if __name__ == "__main__":
+    main()
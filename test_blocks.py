@@ -0,0 +1,74 @@
+import pytest
+
+from compiler import assemble
+from emulator import CPU
+
+BACKENDS = ["interpreter", "blocks"]
+
+def run(source: str, backend: str, instructions: int = 1000) -> CPU:
+    cpu = CPU(assemble(source), [], backend=backend, verbose=False)
+    cpu.run(instructions)
+    return cpu
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_store_patches_next_instruction(backend):
+    cpu = run("""
+        MOV R3, 0xFF
+        STR patched, R3
+    patched:
+        MOV R1, 5
+        MOV R2, 6
+        HLT
+    """, backend)
+    assert cpu.halted
+    assert (cpu.registers[1], cpu.registers[2]) == (0, 0)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_memset_patches_next_instruction(backend):
+    cpu = run("""
+        MOV R1, 0x1010
+        MOV R2, 0xFF
+        MOV R3, 1
+        MEMSET R1, R2, R3
+        MOV R4, 5
+        HLT
+    """, backend)
+    assert cpu.halted
+    assert cpu.pc == 0x1011
+    assert cpu.registers[4] == 0
+
+def test_backends_agree_on_self_modifying_loop():
+    # rewrites the immediate of the MOV at 0x100C every iteration
+    source = """
+        MOV R1, 10
+        MOV R2, 0
+        MOV R5, 1
+    loop:
+        MOV R4, 1
+        ADD R2, R4
+        LOAD R3, 0x100E
+        ADD R3, R5
+        STR 0x100E, R3
+        SUB R1, R5
+        JNZ R1, loop
+        HLT
+    """
+    results = []
+    for backend in BACKENDS:
+        cpu = run(source, backend)
+        assert cpu.halted
+        results.append((list(cpu.registers), bytes(cpu.memory)))
+    assert results[0] == results[1]
+    assert results[0][0][2] == sum(range(1, 11))
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_fault_keeps_registers_assigned_later(backend):
+    cpu = CPU(assemble("""
+        MOV R1, 3
+        DIV R1, R3
+        MOV R2, 5
+        HLT
+    """), [], backend=backend, verbose=False)
+    with pytest.raises(ZeroDivisionError):
+        cpu.run(100)
+    assert (cpu.registers[1], cpu.registers[2]) == (3, 0)
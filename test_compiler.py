@@ -0,0 +1,72 @@
+import os
+import struct
+
+import pytest
+
+import isa
+from compiler import AssemblyError, Compiler, assemble
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SAMPLES = {isa.REG: ("R3", 3), isa.IMM: ("0x1234", 0x1234), isa.ADDR: ("0x0456", 0x456), isa.JUMP: ("12", 12),
+           isa.INT: ("-1", 0xFFFFFFFF)}
+
+@pytest.mark.parametrize("wide_addresses", [False, True])
+def test_every_instruction_encodes_from_its_isa_entry(wide_addresses):
+    formats = isa.WIDE_OPERAND_FORMATS if wide_addresses else isa.OPERAND_FORMATS
+    for instruction in isa.INSTRUCTIONS:
+        text = " ".join([instruction.mnemonic] + [SAMPLES[kind][0] for kind in instruction.operands])
+        expected = bytes((instruction.opcode,)) + struct.pack("<" + "".join(formats[kind] for kind in instruction.operands),
+                                                               *(SAMPLES[kind][1] for kind in instruction.operands))
+        assert assemble(text, wide_addresses=wide_addresses) == expected, text
+        assert len(expected) == (instruction.wide_size if wide_addresses else instruction.size)
+
+def test_labels():
+    compiler = Compiler()
+    rom = compiler.compile("""
+    start:
+        JMP end        ; forward
+        LOAD R1, data  ; address labels are addresses in memory
+    end:
+        JNZ R1, start  ; backward
+    data: NOP
+    """)
+    assert compiler.labels == {"start": 0, "end": 7, "data": 11}
+    jmp, load, jnz = (bytes((isa.BY_MNEMONIC[mnemonic].opcode,)) for mnemonic in ("JMP", "LOAD", "JNZ"))
+    assert rom == (jmp + struct.pack("<H", 7) + load + struct.pack("<BH", 1, isa.ROM_BASE + 11)
+                   + jnz + struct.pack("<BH", 1, 0) + bytes((isa.BY_MNEMONIC["NOP"].opcode,)))
+
+def test_syntax():
+    assert assemble("mov r1, 5") == assemble("MOV R1 5") == assemble("  MOV R1,5 ; five") == assemble("MOV R1, 0b101")
+    assert assemble("MOV R1, -1") == assemble("MOV R1, 0xFFFF")
+    assert assemble("; only a comment\n\nlabel:\n") == b""
+
+@pytest.mark.parametrize("source, line, message", [
+    ("NOP\nFOO R1", 2, "unknown instruction"),
+    ("MOV R1", 1, "takes 2 operands"),
+    ("MOV R9, 1", 1, "unknown register"),
+    ("MOV R1, 0x10000", 1, "doesn't fit"),
+    ("MOV R1, five", 1, "expected a number"),
+    ("a:\nNOP\na:", 3, "already defined"),
+    ("NOP\nJMP nowhere", 2, "unknown label"),
+    ("include \"other.s\"", 1, "include"),
+    ("MOV R1, 1 2", 1, "takes 2 operands"),
+])
+def test_errors_name_the_line(source, line, message):
+    with pytest.raises(AssemblyError) as error:
+        assemble(source)
+    assert error.value.line == line
+    assert message in error.value.message
+
+def test_wide_addresses_reach_far_labels():
+    source = "JMP far\n" + "NOP\n" * 0x10000 + "far: HLT"
+    with pytest.raises(AssemblyError, match="out of reach"):
+        assemble(source)
+    rom = assemble(source, wide_addresses=True)
+    assert struct.unpack_from("<I", rom, 1)[0] == 5 + 0x10000
+
+def test_example_rom_is_up_to_date():
+    with open(os.path.join(HERE, "test.s")) as f:
+        source = f.read()
+    with open(os.path.join(HERE, "test.rom"), "rb") as f:
+        assert assemble(source) == f.read()
@@ -0,0 +1,157 @@
+import threading
+from concurrent.futures import wait
+
+import pytest
+
+from compiler import assemble
+from cpuio.disk import Disk, DISK_READY
+from cpuio.test import TestDevice as FixedBytes # aliased so pytest doesn't collect it
+from emulator import CPU, IODevice
+
+BACKENDS = ["interpreter", "blocks"]
+
+class Patcher(IODevice):
+    """OUT writes a HLT over the instruction at ADDR."""
+    port = 7
+    def _out(self, addr: int) -> None:
+        self.cpu.dma_write(addr, bytes([0x00]))
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_in_and_out_move_data_by_dma(backend):
+    cpu = CPU(assemble("""
+        IN 0, 0x100
+        OUT 0, 0x200
+        LOAD R1, 0x101
+        LOAD R2, 0x203
+        HLT
+    """), [FixedBytes], backend=backend, verbose=False)
+    cpu.run(100)
+    assert cpu.halted
+    assert bytes(cpu.memory[0x100:0x104]) == bytes([69, 42, 69, 42])
+    assert bytes(cpu.memory[0x200:0x204]) == bytes([42, 69, 42, 69])
+    assert (cpu.registers[1], cpu.registers[2]) == (42, 69)
+
+def test_devices_get_the_lowest_free_port_or_their_own():
+    cpu = CPU(assemble("HLT"), [FixedBytes, Patcher, FixedBytes], verbose=False)
+    assert [port for port, device in enumerate(cpu.ports) if device is not None] == [0, 1, 7]
+    assert isinstance(cpu.ports[7], Patcher)
+    with pytest.raises(ValueError):
+        cpu.attach_device(FixedBytes, 7)
+    with pytest.raises(IndexError):
+        cpu.attach_device(FixedBytes, 0x10000)
+    cpu.detach_device(7)
+    assert cpu.attach_device(FixedBytes, 7).port == 7
+
+def test_no_device_on_port_halts():
+    cpu = CPU(assemble("OUT 3, 0x100\nMOV R1, 1\nHLT"), [], verbose=False)
+    cpu.run(100)
+    assert cpu.halted
+    assert cpu.registers[1] == 0
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_dma_into_code_is_seen(backend):
+    # the OUT overwrites the MOV after it before it runs
+    cpu = CPU(assemble("""
+        OUT 7, patched
+    patched:
+        MOV R1, 5
+        HLT
+    """), [Patcher], backend=backend, verbose=False)
+    cpu.run(100)
+    assert cpu.halted
+    assert cpu.registers[1] == 0
+
+def test_dma_bounds():
+    cpu = CPU(assemble("HLT"), [], verbose=False)
+    with pytest.raises(IndexError):
+        cpu.dma_read(len(cpu.memory) - 2, 4)
+    with pytest.raises(IndexError):
+        cpu.dma_write(-1, b"\0")
+    cpu.dma_write(0x300, b"abc")
+    assert bytes(cpu.dma_read(0x300, 3)) == b"abc"
+
+class Raiser(IODevice):
+    """OUT raises interrupt line 2 right away."""
+    def _out(self, addr: int) -> None:
+        self.cpu.raise_interrupt(2)
+
+class Slow(IODevice):
+    """OUT submits work that finishes when release is set."""
+    interrupt = 1
+    def __init__(self, cpu) -> None:
+        super().__init__(cpu)
+        self.release = threading.Event()
+        self.cancelled = []
+    def _out(self, addr: int) -> None:
+        self.submit(self.release.wait, lambda result: self.cpu.dma_write(addr, b"\1"))
+    def cancel(self, future) -> None:
+        self.cancelled.append(future)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_interrupts_wait_for_ei(backend):
+    cpu = CPU(assemble("""
+        IVEC handler
+        OUT 0, 0x100
+        MOV R2, 2
+        EI
+        MOV R3, 3
+        HLT
+    handler:
+        IACK R6
+        ADD R5, R2
+        IRET
+    """), [Raiser], backend=backend, verbose=False)
+    cpu.run(100)
+    assert cpu.halted
+    # taken once, after EI and before the MOV after it
+    assert (cpu.registers[5], cpu.registers[6], cpu.registers[3]) == (2, 2, 3)
+    assert cpu.interrupts_enabled
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_disk_completion_interrupt(tmp_path, backend):
+    path = tmp_path / "disk"
+    path.write_bytes(bytes(range(1, 11)))
+    cpu = CPU(assemble("""
+        IVEC handler
+        EI
+        MOV R1, 1
+        STR 0x200, R1
+        MOV R1, 3
+        STR 0x204, R1
+        OUT 0, 0x200
+    wait:
+        JEQI R7, 0, wait
+        LOAD R2, 0x300
+        LOAD R3, 0x309
+        IN 0, 0x210
+        LOAD R4, 0x210
+        HLT
+    handler:
+        IACK R6
+        MOV R7, 1
+        IRET
+    """), [], backend=backend, verbose=False)
+    cpu.attach_device(Disk, path=str(path))
+    for _ in range(1000):
+        if cpu.halted:
+            break
+        cpu.run(10000)
+    cpu.stop()
+    assert cpu.halted
+    assert (cpu.registers[2], cpu.registers[3], cpu.registers[4], cpu.registers[6]) == (1, 10, DISK_READY, 0)
+
+def test_restore_drops_work_in_flight():
+    cpu = CPU(assemble("OUT 0, 0x100\nloop:\nJMP loop"), [Slow], verbose=False)
+    device = cpu.ports[0]
+    snapshot = cpu.snapshot()
+    cpu.run(10)
+    assert len(cpu._io_operations) == 1
+    cpu.restore(snapshot)
+    assert len(device.cancelled) == 1
+    # finishing afterwards neither completes into the restored machine nor interrupts it
+    device.release.set()
+    wait(device.cancelled)
+    cpu.run(100)
+    cpu.stop()
+    assert cpu.memory[0x100] == 0
+    assert not cpu.interrupt_pending
@@ -0,0 +1,117 @@
+import pytest
+
+import isa
+import protocol
+from compiler import assemble
+from emulator import CPU
+from memorymap import MemoryMap
+
+BACKENDS = ["interpreter", "blocks"]
+
+def cpu_with(source: str, backend: str = "interpreter", **memory_map) -> CPU:
+    memory_map = MemoryMap(**memory_map)
+    return CPU(assemble(source, memory_map.rom_base, memory_map.wide_addresses), [], backend=backend, verbose=False,
+               memory_map=memory_map)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_store_into_read_only_faults(backend):
+    cpu = cpu_with("""
+        MOV R1, 7
+        STR 0x1FF, R1
+        STR 0x200, R1
+        MOV R2, 1
+        HLT
+    """, backend, read_only=[(0x200, 0x300)])
+    with pytest.raises(IndexError):
+        cpu.run(100)
+    assert (cpu.memory[0x1FF], cpu.memory[0x200]) == (7, 0)
+    assert cpu.registers[2] == 0
+    # past the faulting STR, like any other fault
+    assert cpu.pc == cpu.rom_base + isa.BY_MNEMONIC["MOV"].size + 2 * isa.BY_MNEMONIC["STR"].size
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("source", ["MOV R1, 1\nPUSH R1\nHLT", "CALL function\nHLT\nfunction:\nRET"])
+def test_stack_write_into_read_only_faults(backend, source):
+    rom_base = MemoryMap().rom_base
+    cpu = cpu_with(source, backend, read_only=[(rom_base - 4, rom_base)])
+    with pytest.raises(IndexError):
+        cpu.run(100)
+    assert cpu.sp == cpu.stack_top
+    assert bytes(cpu.memory[rom_base - 4:rom_base]) == bytes(4)
+
+def test_bulk_and_debug_writes_into_read_only_fault():
+    cpu = cpu_with("""
+        MOV R1, 0x1F0
+        MOV R2, 0xAA
+        MOV R3, 0x20
+        MEMSET R1, R2, R3
+        HLT
+    """, read_only=[(0x200, 0x210)])
+    with pytest.raises(IndexError):
+        cpu.run(100)
+    with pytest.raises(IndexError):
+        cpu.dma_write(0x20F, b"\1\2")
+    with pytest.raises(IndexError):
+        cpu.set_memory(0x205, 1)
+    assert bytes(cpu.memory[0x200:0x210]) == bytes(16)
+
+    cpu = cpu_with("MOV R1, 1\nPUSH R1\nPUSH R1\nHLT")
+    cpu.run(100)
+    cpu.memory_map.read_only.append((cpu.sp, cpu.sp + 4))
+    with pytest.raises(IndexError):
+        cpu.set_stack(0, 5)
+    cpu.set_stack(1, 5)
+    status, _ = cpu._debug_command(protocol.SET_STACK, protocol.STACK_VALUE.pack(0, 5))
+    assert status == protocol.ERROR
+    assert cpu.stack == [5, 1]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_wide_addresses_reach_past_64k(backend):
+    cpu = cpu_with("""
+        MOV R1, 9
+        STR 0x1FFFF, R1
+        LOAD R2, 0x1FFFF
+        JMP far
+        HLT
+    far:
+        MOV R3, 1
+        HLT
+    """, backend, size=0x30000, rom_base=0x20000, wide_addresses=True)
+    cpu.run(100)
+    assert cpu.halted
+    assert (cpu.registers[2], cpu.registers[3]) == (9, 1)
+
+def test_mapped_files(tmp_path):
+    path = tmp_path / "asset"
+    path.write_bytes(bytes(range(16)))
+    source = """
+        LOAD R1, 0x2005
+        MOV R2, 0x77
+        STR 0x2006, R2
+        LOAD R3, 0x2006
+        HLT
+    """
+    cpu = cpu_with(source)
+    assert cpu.map_file(str(path)).start == 0x2000
+    with pytest.raises(IndexError):
+        cpu.run(100)
+    assert cpu.registers[1] == 5
+
+    cpu = cpu_with(source)
+    cpu.map_file(str(path), writable=True)
+    cpu.run(100)
+    assert (cpu.registers[1], cpu.registers[3]) == (5, 0x77)
+    # writes stay in the mapping's private copy
+    assert path.read_bytes() == bytes(range(16))
+    with pytest.raises(ValueError):
+        cpu.map_file(str(path), 0x2008)
+    cpu.unmap_file(0x2000)
+    assert cpu.mapped_file(0x2005, 1) is None
+
+def test_bad_maps():
+    with pytest.raises(ValueError):
+        MemoryMap(0)
+    with pytest.raises(ValueError):
+        MemoryMap(0x2000, rom_base=0x10)
+    with pytest.raises(ValueError):
+        MemoryMap(0x2000, read_only=[(0x1F00, 0x2100)])
@@ -0,0 +1,103 @@
+import pytest
+
+from compiler import Compiler, assemble
+from emulator import CPU
+
+PROGRAMS = {
+    "folding": """
+        MOV R1, 3
+        MOV R2, 4
+        ADD R1, R2
+        MUL R1, R2
+        SUB R2, R2
+        MOV R3, 7
+        MOV R3, 8
+        MOV R4, 1
+        MOV R4, 1
+        HLT
+    """,
+    "jumps": """
+        MOV R1, 5
+        JMP hop
+        MOV R1, 6
+    hop:
+        JMP next
+    next:
+        CALL function
+        PUSH R1
+        POP R1
+        JMP done
+    function:
+        MOV R2, 9
+        RET
+        MOV R2, 10
+    done:
+        HLT
+    """,
+    "loop": """
+        MOV R1, 10
+        MOV R2, 0
+        MOV R5, 1
+    loop:
+        MOV R3, 2
+        MOV R4, 3
+        ADD R3, R4
+        ADD R2, R3
+        STR 0x100, R2
+        SUB R1, R5
+        JNZ R1, loop
+        JMP end
+    end:
+        LOAD R6, 0x100
+        HLT
+    """,
+    "data": """
+        LOAD R1, table
+        MOV R2, 1
+        ADD R1, R2
+        STR table, R1
+        LOAD R3, table
+        HLT
+    table:
+        NOP
+        HLT
+    """,
+    "graphics": """
+        MOV R1, 2
+        MOV R2, 3
+        MOV R3, 5
+        DRW R1, R2, R3
+        MOV R1, 0x100
+        MOV R2, 0x55
+        MOV R3, 16
+        MEMSET R1, R2, R3
+        RND R4
+        RNDMAP R4, 0, 9
+        RENDER
+        HLT
+    """,
+}
+
+def final_state(rom: bytes, backend: str) -> tuple:
+    cpu = CPU(rom, [], backend=backend, verbose=False)
+    cpu.run(10000)
+    assert cpu.halted
+    # the ROM itself differs and so do return addresses left below the stack pointer, nothing else may
+    memory = bytes(cpu.memory[:cpu.stack_base]) + bytes(cpu.memory[cpu.sp:cpu.rom_base])
+    return list(cpu.registers), memory, bytes(cpu.display), cpu.sp, cpu.rng.state
+
+@pytest.mark.parametrize("backend", ["interpreter", "blocks"])
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_optimized_programs_behave_the_same(name, backend):
+    source = PROGRAMS[name]
+    plain, optimized = assemble(source), assemble(source, optimize=True)
+    assert final_state(optimized, backend) == final_state(plain, backend)
+
+@pytest.mark.parametrize("name", ["folding", "jumps", "loop"])
+def test_optimizer_changes_something(name):
+    module = Compiler(optimize=True).compile_module(PROGRAMS[name])
+    assert module.optimizations
+    assert len(assemble(PROGRAMS[name], optimize=True)) < len(assemble(PROGRAMS[name]))
+
+def test_code_used_as_data_is_left_alone():
+    assert assemble(PROGRAMS["data"], optimize=True) == assemble(PROGRAMS["data"])
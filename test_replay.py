@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import protocol
+import replay
+from compiler import assemble
+from emulator import CPU, IODevice
+
+BACKENDS = ["interpreter", "blocks"]
+
+class Sensor(IODevice):
+    """IN writes a byte from outside the machine, different on every run."""
+    def _in(self, addr: int) -> None:
+        self.cpu.dma_write(addr, self.cpu.external_input(lambda: os.urandom(1)))
+
+class Doubler(IODevice):
+    """OUT doubles the byte at ADDR on the I/O threads and writes it to ADDR + 1."""
+    def _out(self, addr: int) -> None:
+        value = self.cpu.dma_read(addr, 1)[0]
+        self.submit(lambda: bytes([value * 2 & 0xFF]),
+                    lambda result: self.cpu.dma_write(addr + 1, self.cpu.external_input(lambda: result)))
+
+SOURCE = """
+    MOV R1, 0
+loop:
+    IN 0, 0x100
+    LOAD R2, 0x100
+    ADD R1, R2
+    STR 0x110, R2
+    OUT 1, 0x110
+    LOAD R4, 0x111
+    ADD R5, R4
+    RND R3
+    RENDER
+    JMP loop
+"""
+
+def devices() -> list:
+    return [Sensor, Doubler]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_replay_matches_recording(tmp_path, backend):
+    path = str(tmp_path / "run.rec")
+    cpu = CPU(assemble(SOURCE), devices(), backend=backend, verbose=False)
+    cpu.run(200)
+    snapshot = cpu.snapshot()
+    cpu.start_recording(path)
+
+    # everything from outside lands in the middle of a batch
+    renders = 0
+    def on_render(cpu):
+        nonlocal renders
+        renders += 1
+        if renders in (5, 60):
+            cpu.restore(snapshot)
+        elif renders == 20:
+            cpu.set_random(1234)
+        elif renders == 30:
+            request = protocol.encode_request(1, protocol.SET_REGISTER, protocol.REGISTER_VALUE.pack(6, 99))
+            cpu.submit_debug_request(memoryview(request), process=False)
+    cpu.on_render = on_render
+    cpu.run(5000)
+    count, digest = cpu.instructions_executed, replay.state_digest(cpu)
+    cpu.stop_recording()
+    cpu.stop()
+
+    for replay_backend in BACKENDS:
+        replayed, verified = replay.replay(path, devices(), backend=replay_backend)
+        assert verified
+        assert replayed.instructions_executed == count
+        assert replay.state_digest(replayed) == digest
+        replayed.stop()
+
+def test_replay_detects_divergence(tmp_path):
+    path = str(tmp_path / "run.rec")
+    cpu = CPU(assemble(SOURCE), devices(), verbose=False)
+    cpu.start_recording(path)
+    cpu.run(1000)
+    cpu.stop_recording()
+    cpu.stop()
+
+    # a different program replays the same events to a different state
+    events = list(replay.read_events(path))
+    kind, count, snapshot = events[0]
+    other = CPU(assemble(SOURCE.replace("ADD R5, R4", "SUB R5, R4")), devices(), verbose=False)
+    other.restore(snapshot)
+    other.run(1000)
+    assert replay.state_digest(other) != events[-1][2]
@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from compiler import assemble
+from cpuio.rng import RandomDevice, RANDOM_COMMAND, FILL_RANGE, FILL_BYTES, FILL_WORDS, generate, mapped
+from emulator import CPU, LCG, map_to_range, map_to_range_int
+
+M = 2**32
+
+def test_map_to_range_int_matches_the_float_version():
+    values = [0, 1, M // 2, M - 2, M - 1] + random.Random(1).sample(range(M), 2000)
+    ranges = [(0, 1), (0, 7), (1, 6), (0, 255), (100, 200), (0, 0xFFFF), (3, 3)]
+    for min_val, max_val in ranges:
+        for value in values:
+            assert map_to_range_int(value, min_val, max_val) == int(map_to_range(value, min_val, max_val)), (value, min_val, max_val)
+    # exact points, where the float version can land just below a whole number
+    for value in range(0, M, (M - 1) // 15):
+        assert map_to_range_int(value, 0, 15) == int(map_to_range(value, 0, 15))
+
+def test_generate_matches_next():
+    one, block = LCG(1234), LCG(1234)
+    expected = [one.next() for _ in range(1000)]
+    assert [int(value) for value in generate(block, 1000)] == expected
+    assert block.state == one.state
+    assert [int(value) for value in mapped(expected[:50], 0, 9)] == [map_to_range_int(value, 0, 9) for value in expected[:50]]
+
+def device_cpu(word_bits: int, operation: int, count: int) -> CPU:
+    cpu = CPU(assemble("OUT 0, 0x200\nHLT"), [RandomDevice], word_bits=word_bits, verbose=False)
+    cpu.memory[0x200:0x200 + RANDOM_COMMAND.size + FILL_RANGE.size] = RANDOM_COMMAND.pack(operation, 2, 9) + FILL_RANGE.pack(0x100, count)
+    cpu.run(10)
+    assert cpu.halted
+    return cpu
+
+@pytest.mark.parametrize("word_bits", [32, 16])
+def test_fill_bytes_matches_rnd_and_rndmap(word_bits):
+    guest = CPU(assemble("".join(f"RND R1\nRNDMAP R1, 2, 9\nSTR 0x{0x100 + i:X}, R1\n" for i in range(8)) + "HLT"), [],
+                word_bits=word_bits, verbose=False)
+    guest.run(100)
+    cpu = device_cpu(word_bits, FILL_BYTES, 8)
+    assert bytes(cpu.memory[0x100:0x108]) == bytes(guest.memory[0x100:0x108])
+    assert cpu.rng.state == guest.rng.state
+
+def test_fill_words_matches_rnd():
+    rng = LCG(42)
+    expected = [rng.next() for _ in range(16)]
+    cpu = device_cpu(32, FILL_WORDS, 16)
+    assert [int.from_bytes(cpu.memory[0x100 + 4 * i:0x104 + 4 * i], "little") for i in range(16)] == expected
+    assert cpu.rng.state == rng.state
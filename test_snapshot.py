@@ -0,0 +1,83 @@
+import pytest
+
+from compiler import assemble
+from emulator import CPU
+
+BACKENDS = ["interpreter", "blocks"]
+
+# touches registers, memory, the stack, the LCG and the framebuffer every iteration
+SOURCE = """
+    MOV R1, 0
+    MOV R2, 1
+    MOV R5, 3
+loop:
+    ADD R1, R2
+    RND R3
+    RNDMAP R3, 0, 7
+    STR 0x100, R1
+    PUSH R3
+    POP R4
+    DRW R3, R5, R1
+    RENDER
+    JMP loop
+"""
+
+def state(cpu: CPU) -> tuple:
+    return (bytes(cpu.memory), list(cpu.registers), cpu.pc, cpu.sp, cpu.rng.state, cpu.instructions_executed,
+            bytes(cpu.display), cpu.halted)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_restore_round_trip(backend):
+    cpu = CPU(assemble(SOURCE), [], backend=backend, verbose=False)
+    cpu.run(500)
+    snapshot = cpu.snapshot()
+    before = state(cpu)
+
+    cpu.run(1234)
+    after = state(cpu)
+    assert after != before
+
+    cpu.restore(snapshot)
+    assert state(cpu) == before
+    # and it runs on exactly as it did
+    cpu.run(1234)
+    assert state(cpu) == after
+
+def test_restore_into_another_cpu(tmp_path):
+    cpu = CPU(assemble(SOURCE), [], verbose=False)
+    cpu.run(777)
+    path = str(tmp_path / "state")
+    cpu.save_state(path)
+
+    other = CPU(assemble("HLT"), [], verbose=False)
+    other.load_state(path)
+    assert state(other) == state(cpu)
+    cpu.run(100)
+    other.run(100)
+    assert state(other) == state(cpu)
+
+def test_restore_mid_batch_keeps_the_count():
+    cpu = CPU(assemble(SOURCE), [], verbose=False)
+    cpu.run(50)
+    snapshot = cpu.snapshot()
+    renders = []
+    def on_render(cpu):
+        renders.append(cpu.instruction_count)
+        if len(renders) == 3:
+            cpu.restore(snapshot)
+    cpu.on_render = on_render
+    cpu.run(1000)
+    # what ran before the restore is gone, the rest of the budget ran from the snapshot
+    assert cpu.instructions_executed == 50 + 1000 - (renders[2] - 50)
+
+def test_rejects_bad_snapshots():
+    cpu = CPU(assemble(SOURCE), [], verbose=False)
+    snapshot = cpu.snapshot()
+    with pytest.raises(ValueError):
+        cpu.restore(snapshot[:10])
+    with pytest.raises(ValueError):
+        cpu.restore(b"XXXX" + bytes(snapshot[4:]))
+    with pytest.raises(ValueError):
+        cpu.restore(snapshot[:-1])
+    with pytest.raises(ValueError):
+        CPU(assemble(SOURCE), [], word_bits=16, verbose=False).restore(snapshot)
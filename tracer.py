@@ -0,0 +1,158 @@
+"""Ring buffer of the last executed instructions.
+
+Enabled with CPU.enable_tracer. Every record is one u64 in a preallocated
+array: the PC, with the number of instructions the record covers minus one
+above bit 32 (compiled blocks record once per block). Every REGISTER_INTERVAL
+records the registers are copied into a second ring too, so recording an
+instruction is one store and the occasional slice copy.
+
+Opcodes and operands are read back from memory when the trace is formatted,
+so the CPU clears the ring when its ROM is replaced. Register deltas come from
+comparing neighbouring snapshots.
+"""
+import sys
+import struct
+from array import array
+
+import isa
+from isa import ROM_BASE, REGISTER_COUNT
+
+REGISTER_INTERVAL = 16
+COUNT_SHIFT = 32
+PC_MASK = (1 << COUNT_SHIFT) - 1
+HAS_REGISTERS = 1 << 63 # set on raw records followed by a snapshot
+# GET_TRACE result: ROM base, address size and record count, then a u64 per record and REGISTER_COUNT u32s per snapshot
+RAW_HEADER = struct.Struct("<IBI")
+
+class TraceRecorder:
+    def __init__(self, size: int = 4096, typecode: str = "I") -> None:
+        if size <= 0:
+            raise ValueError(f"Trace size must be positive, got {size}")
+        # whole intervals, snapshot n always belongs to the record in slot (n + 1) * REGISTER_INTERVAL - 1
+        self.size = -(-size // REGISTER_INTERVAL) * REGISTER_INTERVAL
+        self.ring = array("Q", bytes(8 * self.size))
+        # typecode has to match the CPU's registers for the slice copy
+        self.registers = array(typecode, bytes(array(typecode).itemsize * REGISTER_COUNT * (self.size // REGISTER_INTERVAL)))
+        self.position = 0 # slot the next record goes into
+        self.recorded = 0 # records written so far, including overwritten ones
+
+    def clear(self) -> None:
+        self.position = 0
+        self.recorded = 0
+
+    def record(self, pc: int, count: int, registers) -> None:
+        position = self.position
+        self.ring[position] = pc | (count - 1) << COUNT_SHIFT
+        position += 1
+        if not position % REGISTER_INTERVAL:
+            start = (position // REGISTER_INTERVAL - 1) * REGISTER_COUNT
+            self.registers[start:start + REGISTER_COUNT] = registers
+            if position == self.size:
+                position = 0
+        self.position = position
+        self.recorded += 1
+
+    def entries(self) -> list[tuple[int, int, list[int] | None]]:
+        """(pc, instructions covered, registers after it or None) for the records still in the ring, oldest first."""
+        count = min(self.recorded, self.size)
+        first = self.position - count
+        entries = []
+        for index in range(first, first + count):
+            slot = index % self.size
+            word = self.ring[slot]
+            registers = None
+            if slot % REGISTER_INTERVAL == REGISTER_INTERVAL - 1:
+                start = slot // REGISTER_INTERVAL * REGISTER_COUNT
+                registers = list(self.registers[start:start + REGISTER_COUNT])
+            entries.append((word & PC_MASK, (word >> COUNT_SHIFT) + 1, registers))
+        return entries
+
+    def raw(self, rom_base: int = ROM_BASE, wide_addresses: bool = False) -> bytes:
+        """entries() as sent by the debug server, with the memory map they decode against."""
+        entries = self.entries()
+        words = array("Q", (pc | (covered - 1) << COUNT_SHIFT | (HAS_REGISTERS if registers is not None else 0)
+                            for pc, covered, registers in entries))
+        snapshots = array("I", (value for _, _, registers in entries if registers is not None for value in registers))
+        if sys.byteorder != "little":
+            words.byteswap()
+            snapshots.byteswap()
+        return RAW_HEADER.pack(rom_base, 4 if wide_addresses else 2, len(entries)) + words.tobytes() + snapshots.tobytes()
+
+    def records(self, memory, last: int | None = None, rom_base: int = ROM_BASE, wide_addresses: bool = False) -> list[dict]:
+        return decode_records(self.entries(), memory, last, rom_base, wide_addresses)
+
+    def format(self, memory, last: int | None = None, rom_base: int = ROM_BASE, wide_addresses: bool = False) -> str:
+        return format_records(self.records(memory, last, rom_base, wide_addresses))
+
+def from_raw(data: bytes) -> tuple[int, bool, list[tuple[int, int, list[int] | None]]]:
+    """Undo TraceRecorder.raw, returns (rom_base, wide_addresses, entries)."""
+    rom_base, address_size, count = RAW_HEADER.unpack_from(data, 0)
+    words = array("Q")
+    words.frombytes(data[RAW_HEADER.size:RAW_HEADER.size + 8 * count])
+    snapshots = array("I")
+    snapshots.frombytes(data[RAW_HEADER.size + 8 * count:])
+    if sys.byteorder != "little":
+        words.byteswap()
+        snapshots.byteswap()
+
+    entries = []
+    offset = 0
+    for word in words:
+        registers = None
+        if word & HAS_REGISTERS:
+            registers = list(snapshots[offset:offset + REGISTER_COUNT])
+            offset += REGISTER_COUNT
+        entries.append((word & PC_MASK, ((word & ~HAS_REGISTERS) >> COUNT_SHIFT) + 1, registers))
+    return rom_base, address_size == 4, entries
+
+def decode_records(entries: list[tuple[int, int, list[int] | None]], memory, last: int | None = None, rom_base: int = ROM_BASE,
+                   wide_addresses: bool = False, memory_start: int = 0) -> list[dict]:
+    """Turn entries into dicts, opcodes and operands come from memory so they show the code as it is now.
+
+    rom_base and wide_addresses have to match the CPU's memory map to decode jumps
+    and addresses. memory holds the bytes from memory_start on.
+    """
+    first = 0 if last is None else max(0, len(entries) - last)
+    previous = None # the last snapshot before the first record shown
+    for _, _, registers in entries[:first]:
+        if registers is not None:
+            previous = registers
+
+    records = []
+    for pc, covered, registers in entries[first:]:
+        at = pc - memory_start
+        opcode = memory[at] if 0 <= at < len(memory) else None
+        instruction = isa.BY_OPCODE[opcode] if opcode is not None else None
+        operands = []
+        operand_struct, size = instruction.encoding(wide_addresses) if instruction is not None else (None, 0)
+        if instruction is not None and at + size <= len(memory):
+            for kind, value in zip(instruction.operands, operand_struct.unpack_from(memory, at + 1)):
+                operands.append(f"R{value}" if kind == isa.REG else f"0x{value + rom_base if kind == isa.JUMP else value:04X}")
+
+        changed = {}
+        if registers is not None:
+            if previous is not None:
+                changed = {f"R{i}": (old, new) for i, (old, new) in enumerate(zip(previous, registers)) if old != new}
+            previous = registers
+
+        records.append({
+            "pc": pc,
+            "opcode": opcode,
+            "mnemonic": instruction.mnemonic if instruction else None,
+            "operands": operands,
+            "count": covered,
+            "registers": registers, # None between snapshots
+            "changed": changed,     # since the previous snapshot
+        })
+    return records
+
+def format_records(records: list[dict]) -> str:
+    lines = []
+    for record in records:
+        text = f"0x{record['pc']:04X}: {record['mnemonic'] or record['opcode']} {', '.join(record['operands'])}".rstrip()
+        if record["count"] > 1:
+            text += f"  [block of {record['count']}]"
+        if record["changed"]:
+            text = f"{text:<32} " + " ".join(f"{name}: 0x{old:X} -> 0x{new:X}" for name, (old, new) in record["changed"].items())
+        lines.append("  " + text)
+    return "\n".join(lines)